@@ -0,0 +1,279 @@
+import io
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import time
+import uuid
+
+from voice_activity import SAMPLE_WIDTH, SilenceTrimmer
+
+CHANNELS = 1
+HEADER_SIZE = 44
+
+
+# 单声道 16 位 PCM 的 WAV 文件头，data_size 为 PCM 数据的字节数
+def wav_header(rate, data_size):
+    return struct.pack("<4sI4s4sIHHIIHH4sI", b"RIFF", 36 + data_size, b"WAVE", b"fmt ", 16, 1, CHANNELS, rate,
+                       rate * CHANNELS * SAMPLE_WIDTH, CHANNELS * SAMPLE_WIDTH, SAMPLE_WIDTH * 8, b"data", data_size)
+
+
+def recording_name():
+    return f"recording-{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}.wav"
+
+
+# 预先分配的环形缓冲：录音回调(PortAudio 的线程)写入，录音线程取出；回调中只复制内存，不做任何可能阻塞的事
+# 取出的速度跟不上时丢弃新来的数据并计数，内存不会增长
+class RingBuffer:
+    def __init__(self, size):
+        self._data = bytearray(size)
+        self._view = memoryview(self._data)
+        self._start = 0
+        self._length = 0
+        self.dropped = 0    # 因缓冲已满丢弃的字节数
+        self._cond = threading.Condition()
+
+    def write(self, data):
+        size = len(self._data)
+        with self._cond:
+            free = size - self._length
+            if len(data) > free:
+                self.dropped += len(data) - free
+                data = data[:free]
+            end = (self._start + self._length) % size
+            first = min(len(data), size - end)
+            self._view[end:end + first] = data[:first]
+            self._view[:len(data) - first] = data[first:]
+            self._length += len(data)
+            self._cond.notify()
+
+    # 取出缓冲中的全部数据；没有数据时最多等待 timeout 秒
+    def read(self, timeout=None):
+        size = len(self._data)
+        with self._cond:
+            if not self._length and timeout != 0:
+                self._cond.wait(timeout)
+            first = min(self._length, size - self._start)
+            data = bytes(self._view[self._start:self._start + first]) + bytes(self._view[:self._length - first])
+            self._start = (self._start + self._length) % size
+            self._length = 0
+            return data
+
+
+# 边录边写的 WAV：先写一个长度为 0 的文件头，PCM 数据追加在后面，结束时补上长度
+# 不超过 max_memory 字节时留在内存中，超过后整体移到临时文件(关闭时删除)；上传时直接从这里读取，不经过磁盘上的中间文件
+class WavSpool:
+    def __init__(self, rate, max_memory=8 * 1024 * 1024, name=None):
+        self.rate = rate
+        self.max_memory = max_memory
+        self.name = name or recording_name()
+        self.data_size = 0
+        self.original_size = None       # 去掉静音之前的大小和时长，没有去掉静音时为 None
+        self.original_duration = None
+        self.file = io.BytesIO()
+        self.file.write(wav_header(rate, 0))
+
+    @property
+    def in_memory(self):
+        return isinstance(self.file, io.BytesIO)
+
+    @property
+    def duration(self):
+        return self.data_size / (self.rate * CHANNELS * SAMPLE_WIDTH)
+
+    @property
+    def size(self):
+        return HEADER_SIZE + self.data_size
+
+    def write(self, pcm):
+        if self.in_memory and self.size + len(pcm) > self.max_memory:
+            spilled = tempfile.TemporaryFile(prefix="recording-", suffix=".wav")
+            spilled.write(self.file.getbuffer())
+            self.file = spilled
+        self.file.write(pcm)
+        self.data_size += len(pcm)
+
+    # 录音结束：补上文件头中的长度
+    def finish(self):
+        self.file.seek(0)
+        self.file.write(wav_header(self.rate, self.data_size))
+        self.file.seek(0, os.SEEK_END)
+
+    # 上传用的 (文件名, 文件对象, 类型)；每次调用都从头读起，限流重试时可以再次上传
+    def upload(self):
+        self.file.seek(0)
+        return self.name, self.file, "audio/wav"
+
+    # 保存一份到 folder 中，文件名每次录音不同
+    def save(self, folder):
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, self.name)
+        self.file.seek(0)
+        with open(path, "wb") as f:
+            shutil.copyfileobj(self.file, f)
+        self.file.seek(0, os.SEEK_END)
+        return path
+
+    def close(self):
+        self.file.close()
+
+
+# 压缩过的录音，和 WavSpool 一样可以直接上传
+class EncodedRecording:
+    def __init__(self, name, file, mime_type, duration, original_size=None, original_duration=None):
+        self.name = name
+        self.file = file
+        self.mime_type = mime_type
+        self.duration = duration
+        self.original_size = original_size
+        self.original_duration = original_duration
+
+    @property
+    def size(self):
+        return self.file.seek(0, os.SEEK_END)
+
+    def upload(self):
+        self.file.seek(0)
+        return self.name, self.file, self.mime_type
+
+    def close(self):
+        self.file.close()
+
+
+# 把录好的 WAV 无损压缩成 FLAC(需要 soundfile)，按 block_seconds 秒一块编码，然后关闭原来的录音
+# 原来的录音在内存中时结果也在内存中，否则写到临时文件
+def encode_flac(spool, block_seconds=10):
+    import numpy as np
+    import soundfile
+
+    output = io.BytesIO() if spool.in_memory else tempfile.TemporaryFile(prefix="recording-", suffix=".flac")
+    block = spool.rate * CHANNELS * SAMPLE_WIDTH * block_seconds
+    original_size = spool.original_size or spool.size
+    try:
+        with soundfile.SoundFile(output, "w", spool.rate, CHANNELS, "PCM_16", format="FLAC", closefd=False) as f:
+            spool.file.seek(HEADER_SIZE)
+            while True:
+                data = spool.file.read(block)
+                if not data:
+                    break
+                f.write(np.frombuffer(data, dtype="<i2"))
+    except BaseException:
+        output.close()
+        raise
+    spool.close()
+    return EncodedRecording(os.path.splitext(spool.name)[0] + ".flac", output, "audio/flac", spool.duration,
+                            original_size, spool.original_duration or spool.duration)
+
+
+# 录音上传后的说明：去掉了多少静音、少传了多少字节，以及按这次请求的耗时估计省下的时间；什么都没省时返回 None
+# 上传和转写的时间大致和音频长度成正比，省下的时间按 elapsed * 去掉的时长 / 上传的时长估计
+def describe_savings(recording, elapsed):
+    original_size = recording.original_size or recording.size
+    original_duration = recording.original_duration or recording.duration
+    removed = original_duration - recording.duration
+    if original_size <= recording.size and removed <= 0:
+        return None
+    parts = []
+    if removed > 0:
+        parts.append(f"removed {removed:.1f}s of silence from {original_duration:.1f}s")
+    parts.append(f"uploaded {recording.size / 1024:.0f} KB instead of {original_size / 1024:.0f} KB "
+                 f"({1 - recording.size / original_size:.0%} smaller)")
+    if removed > 0 and recording.duration > 0:
+        parts.append(f"about {elapsed * removed / recording.duration:.1f}s faster")
+    return "Audio: " + ", ".join(parts) + "."
+
+
+# 从麦克风录音：PortAudio 在自己的线程中调用回调把数据放进环形缓冲，capture() 所在的线程把数据写进 WavSpool
+# 内存最多是环形缓冲加上 max_memory；keep_folder 不为空时每次录音另存一份
+# trim 不为 None 时边录边去掉长的静音(参数见 voice_activity.SilenceTrimmer)；compress="flac" 时录完压缩成 FLAC
+# 边录边转写时在停顿处切段：一段满 min_segment 秒后遇到停顿就结束，最长 max_segment 秒
+class Recorder:
+    def __init__(self, rate=10000, frames_per_buffer=2048, ring_seconds=10, max_memory=8 * 1024 * 1024,
+                 keep_folder=None, trim=None, compress=None, min_segment=3.0, max_segment=30.0):
+        self.rate = rate
+        self.frames_per_buffer = frames_per_buffer
+        self.ring_seconds = ring_seconds
+        self.max_memory = max_memory
+        self.keep_folder = keep_folder
+        self.trim = trim
+        self.compress = compress
+        self.min_segment = min_segment
+        self.max_segment = max_segment
+        self.dropped = 0    # 上次录音中因环形缓冲已满丢弃的秒数
+        self.compress_error = None  # 上次录音没能压缩的原因(例如没有安装 soundfile)，这时上传 WAV
+
+    # 录音直到 stop_event 被设置，返回录好的 WavSpool(或压缩后的 EncodedRecording)；去掉静音后什么都不剩时时长为 0
+    # on_segment 不为 None 时边录边切段，每切出一段就在录音线程中调用 on_segment(录音)，返回的是最后一段；
+    # 切段要靠判断停顿，没有设置 trim 时按默认的参数去掉静音
+    def capture(self, stop_event, on_segment=None):
+        import pyaudio  # 只在第一次录音时加载
+
+        ring = RingBuffer(self.rate * CHANNELS * SAMPLE_WIDTH * self.ring_seconds)
+
+        def callback(in_data, frame_count, time_info, status):
+            ring.write(in_data)
+            return None, pyaudio.paContinue
+
+        trim = self.trim if self.trim is not None or on_segment is None else {}
+        trimmer = SilenceTrimmer(self.rate, **trim) if trim is not None else None
+        spool = WavSpool(self.rate, self.max_memory)
+        segment_start = 0   # 这一段开始时 trimmer 已经读入的字节数
+        self.compress_error = None
+
+        def cut():
+            nonlocal spool, segment_start
+            if spool.data_size:
+                on_segment(self._finish(spool, trimmer, segment_start))
+                spool = WavSpool(self.rate, self.max_memory)
+                segment_start = trimmer.input_bytes
+
+        def write(pcm):
+            if trimmer is None:
+                spool.write(pcm)
+                return
+            for i, piece in enumerate(trimmer.split(pcm)):
+                if i and on_segment and spool.duration >= self.min_segment:
+                    cut()
+                spool.write(piece)
+                if on_segment and spool.duration >= self.max_segment:
+                    cut()
+
+        audio = pyaudio.PyAudio()
+        try:
+            stream = audio.open(format=pyaudio.paInt16, channels=CHANNELS, rate=self.rate, input=True,
+                                frames_per_buffer=self.frames_per_buffer, stream_callback=callback)
+            try:
+                stream.start_stream()
+                while not stop_event.is_set():
+                    write(ring.read(timeout=0.1))
+                stream.stop_stream()
+            finally:
+                stream.close()
+            write(ring.read(timeout=0))
+            if trimmer:
+                spool.write(trimmer.finish())
+            spool = self._finish(spool, trimmer, segment_start)
+        except BaseException:
+            spool.close()
+            raise
+        finally:
+            audio.terminate()
+            self.dropped = ring.dropped / (self.rate * CHANNELS * SAMPLE_WIDTH)
+        return spool
+
+    # 一段录音结束：补上文件头，记下去掉静音之前的大小，按设置另存和压缩
+    def _finish(self, spool, trimmer, segment_start):
+        if trimmer:
+            original = trimmer.input_bytes - segment_start
+            spool.original_size = HEADER_SIZE + original
+            spool.original_duration = original / (self.rate * CHANNELS * SAMPLE_WIDTH)
+        spool.finish()
+        if self.keep_folder and spool.data_size:
+            spool.save(self.keep_folder)
+        if self.compress == "flac" and spool.data_size:
+            try:
+                return encode_flac(spool)
+            except (ImportError, OSError) as e:     # 没有 soundfile 或 libsndfile
+                self.compress_error = e
+        return spool
@@ -0,0 +1,270 @@
+import asyncio
+import math
+import re
+import threading
+import wave
+
+from audio_capture import HEADER_SIZE, WavSpool, encode_flac
+from request_engine import engine
+from search_index import CJK_RUN
+from voice_activity import SAMPLE_WIDTH, SilenceTrimmer, frame_energy
+
+TARGET_RATE = 16000     # Whisper 按 16 kHz 处理，更高的采样率只会让上传变大
+AUDIO_FILE_TYPES = "*.wav *.flac *.ogg *.oga *.mp3 *.aiff *.aif *.au *.caf"
+
+# 拼接时比较的词：中日韩文字一个字算一个词，其余按空格分开
+TOKEN = re.compile(CJK_RUN.pattern.rstrip("+") + r"|[^\s]+")
+
+
+# 从磁盘读取音频文件，读出的是单声道 int16 数组；PCM 的 WAV 用标准库的 wave 读取，
+# 其他格式(FLAC、OGG、MP3 等)和浮点 WAV 需要 soundfile(libsndfile)，在本地解码
+class AudioFile:
+    def __init__(self, path):
+        self.path = path
+        self._wave = None
+        self._sound = None
+        try:
+            self._wave = wave.open(path, "rb")
+            self.rate = self._wave.getframerate()
+            self.channels = self._wave.getnchannels()
+            self.frames = self._wave.getnframes()
+            self._width = self._wave.getsampwidth()
+        except (wave.Error, EOFError):
+            if self._wave is not None:
+                self._wave.close()
+                self._wave = None
+            self._open_sound_file(path)
+
+    def _open_sound_file(self, path):
+        try:
+            import soundfile
+        except (ImportError, OSError):
+            raise ValueError("Only PCM WAV files can be read without the soundfile package "
+                             "(pip install soundfile).") from None
+        try:
+            self._sound = soundfile.SoundFile(path)
+        except RuntimeError as e:   # libsndfile 不认识的格式
+            raise ValueError(f"Unsupported audio file: {e}") from None
+        self.rate = self._sound.samplerate
+        self.channels = self._sound.channels
+        self.frames = self._sound.frames
+
+    @property
+    def duration(self):
+        return self.frames / self.rate if self.rate else 0
+
+    # 从第 start 帧开始读 count 帧，多声道取平均
+    def read(self, start, count):
+        import numpy as np
+
+        if self._wave is not None:
+            self._wave.setpos(start)
+            data = self._wave.readframes(count)
+            if self._width == 1:
+                samples = (np.frombuffer(data, dtype=np.uint8).astype(np.int16) - 128) << 8
+            elif self._width == 3:
+                samples = np.frombuffer(data, dtype=np.uint8).reshape(-1, 3)[:, 1:].copy().view("<i2").ravel()
+            elif self._width == 4:
+                samples = (np.frombuffer(data, dtype="<i4") >> 16).astype(np.int16)
+            else:
+                samples = np.frombuffer(data, dtype="<i2")
+            samples = samples.reshape(-1, self.channels)
+        else:
+            # 按 float32 读再换算：libsndfile 把浮点数据直接读成 int16 时不缩放，得到的全是 0
+            self._sound.seek(start)
+            samples = self._sound.read(count, dtype="float32", always_2d=True)
+            samples = np.clip(np.round(samples * 32768), -32768, 32767).astype(np.int16)
+        if self.channels > 1:
+            return samples.mean(axis=1).astype(np.int16)
+        return samples[:, 0]
+
+    def close(self):
+        if self._wave is not None:
+            self._wave.close()
+        if self._sound is not None:
+            self._sound.close()
+
+
+# 用 FFT 把采样率降到 target(只降不升)，不会混叠
+# 长度有大的质因数时 FFT 又慢又占内存，所以补零到只含 2、3、5、7 因数的长度再变换
+def resample(samples, rate, target):
+    import numpy as np
+
+    if target >= rate or not len(samples):
+        return samples
+    step = rate // math.gcd(rate, target)
+    size = step * _smooth_number(-(-len(samples) // step))
+    count = size * target // rate
+    spectrum = np.fft.rfft(samples.astype(np.float64), size)[:count // 2 + 1]
+    output = np.fft.irfft(spectrum, count)[:round(len(samples) * target / rate)] * (count / size)
+    return np.clip(np.round(output), -32768, 32767).astype("<i2")
+
+
+# 读出第 start 到 end 帧并降到 target 采样率，按 block_seconds 秒一块产出，内存只和块的大小有关
+# 每块前后多读 context_seconds 秒一起变换再去掉，块与块之间没有接缝；块的边界对齐到两个采样率的公倍数，输出的长度是准确的
+def read_resampled(audio, start, end, target, block_seconds=10.0, context_seconds=0.1):
+    step = audio.rate // math.gcd(audio.rate, target)
+    block = max(1, int(block_seconds * audio.rate) // step) * step
+    context = max(1, int(context_seconds * audio.rate) // step) * step
+    for position in range(start, end, block):
+        read_start = max(start, position - context)
+        read_end = min(end, position + block + context)
+        samples = resample(audio.read(read_start, read_end - read_start), audio.rate, target)
+        if target >= audio.rate:
+            yield samples[position - read_start:position - read_start + block]
+            continue
+        offset = (position - read_start) * target // audio.rate
+        yield samples[offset:offset + round(min(block, end - position) * target / audio.rate)]
+
+
+# 不小于 n、只含 2、3、5、7 因数的最小的数
+def _smooth_number(n):
+    while True:
+        m = n
+        for factor in (2, 3, 5, 7):
+            while m % factor == 0:
+                m //= factor
+        if m == 1:
+            return n
+        n += 1
+
+
+# 把音频切成大约 chunk_seconds 秒的段，产出 (开始帧, 结束帧)
+# 切点选在每段结尾前 search_seconds 秒内最安静的一帧；下一段从切点之前 overlap 秒开始，
+# 切点落在词中间时两段都有完整的这个词，拼接时去掉重复。只读取切点附近的音频
+def plan_chunks(audio, chunk_seconds=120.0, overlap=2.0, search_seconds=10.0, frame_ms=30):
+    import numpy as np
+
+    chunk = int(chunk_seconds * audio.rate)
+    overlap = int(overlap * audio.rate)
+    search = min(int(search_seconds * audio.rate), chunk - overlap - 1)
+    frame = max(1, audio.rate * frame_ms // 1000)
+    start = 0
+    while True:
+        end = start + chunk
+        if end >= audio.frames:
+            yield start, audio.frames
+            return
+        window_start = end - search
+        samples = audio.read(window_start, search)
+        count = len(samples) // frame
+        if count:
+            quietest = int(np.argmin(frame_energy(samples[:count * frame].reshape(count, frame))))
+            end = window_start + quietest * frame + frame // 2
+        yield start, end
+        start = end - overlap
+
+
+# 从音频文件中切出的段交给 chat_session.stream_segment_transcription：按顺序读出、降采样、去掉长的静音后放进内存中的 WAV
+# 最多 limit 段同时在内存中(已经切好还没有转写完)，多长的文件内存都不会随之增长；全是静音的段跳过
+class AudioFileFeed:
+    def __init__(self, path, chunk_seconds=120.0, overlap=2.0, limit=4, trim=None, compress=None):
+        self.audio = AudioFile(path)
+        self.trim = trim
+        self.compress = compress
+        self.ends = []          # 每段在文件中结束的位置(秒)，用来显示进度
+        self.segments = 0
+        self.uploaded = 0       # 上传的字节数
+        self._chunks = plan_chunks(self.audio, chunk_seconds, overlap)
+        self._slots = asyncio.Semaphore(limit)
+        self._lock = threading.Lock()   # 读取在线程池中进行，关闭文件要等正在进行的读取结束
+        self._stopped = False
+
+    @property
+    def rate(self):
+        return min(self.audio.rate, TARGET_RATE)
+
+    def progress(self, index):
+        return self.ends[index] / self.audio.duration if self.audio.duration else 1.0
+
+    async def get(self):
+        await self._slots.acquire()
+        try:
+            recording = await engine.run_blocking(self._next)
+        except BaseException:
+            self._slots.release()
+            raise
+        if recording is None:
+            self._slots.release()
+            return None
+        return _Chunk(recording, self._slots.release)
+
+    def stop(self):
+        with self._lock:
+            self._stopped = True
+            self.audio.close()
+
+    def _next(self):
+        while True:
+            with self._lock:
+                if self._stopped:
+                    return None
+                span = next(self._chunks, None)
+                if span is None:
+                    return None
+                recording = self._encode(read_resampled(self.audio, span[0], span[1], self.rate))
+            if recording.duration:
+                self.ends.append(span[1] / self.audio.rate)
+                self.segments += 1
+                self.uploaded += recording.size
+                return recording
+            recording.close()
+
+    # blocks 为一段的各块 PCM，写进内存中的 WAV，按设置去掉长的静音和压缩
+    def _encode(self, blocks):
+        spool = WavSpool(self.rate, max_memory=float("inf"))
+        trimmer = SilenceTrimmer(self.rate, **self.trim) if self.trim is not None else None
+        for samples in blocks:
+            pcm = samples.tobytes()
+            spool.write(trimmer.feed(pcm) if trimmer else pcm)
+        if trimmer:
+            spool.original_size = HEADER_SIZE + trimmer.input_bytes
+            spool.original_duration = trimmer.input_bytes / (self.rate * SAMPLE_WIDTH)
+        spool.finish()
+        if self.compress == "flac" and spool.data_size:
+            try:
+                return encode_flac(spool)
+            except (ImportError, OSError):
+                self.compress = None    # 没有 soundfile 时上传 WAV
+        return spool
+
+
+# 切好的一段，关闭时让出内存中的名额
+class _Chunk:
+    def __init__(self, recording, release):
+        self.recording = recording
+        self._release = release
+
+    @property
+    def duration(self):
+        return self.recording.duration
+
+    def upload(self):
+        return self.recording.upload()
+
+    def close(self):
+        if self._release is not None:
+            self.recording.close()
+            self._release()
+            self._release = None
+
+
+# 去掉 text 开头和 previous 结尾重复的部分(相邻两段重叠的音频被转写了两次)
+# 比较时忽略大小写和标点，只在 previous 最后 max_tokens 个词中查找；
+# 一段开头可能是半个词，转写得不对，所以重复的部分可以从 text 的第 skip 个词之内开始，前面的词一起去掉，
+# 这时至少要有 min_tokens 个词相同；重叠的部分落在长的停顿中时可能只有一个词，只有一个词时必须从 text 的开头开始
+def remove_overlap(previous, text, max_tokens=40, min_tokens=2, skip=2):
+    tail = [word for word in (_normalize(match.group()) for match in TOKEN.finditer(previous)) if word][-max_tokens:]
+    head = [(match.start(), _normalize(match.group())) for match in TOKEN.finditer(text)]
+    head = [(position, word) for position, word in head if word][:max_tokens + skip]
+    words = [word for _, word in head]
+    for count in range(min(len(tail), len(words)), 0, -1):
+        for start in range(min(skip, len(words) - count) + 1 if count >= min_tokens else 1):
+            if tail[-count:] == words[start:start + count]:
+                end = start + count
+                return text[head[end][0]:] if end < len(head) else ""
+    return text
+
+
+def _normalize(word):
+    return re.sub(r"[^\w]", "", word.lower())
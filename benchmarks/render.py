@@ -0,0 +1,126 @@
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PySide6 import QtCore, QtWidgets
+
+from chat_tab import ChatTab
+from qt_bridge import QtBridge
+from request_engine import engine
+
+
+# 流式渲染基准：模拟生成极快的本地模型，在若干个标签页中同时流式输出
+# direct 为每个片段向GUI线程发一个事件、更新一次聊天记录(改动之前的做法)，buffered 经过 RenderBuffer；
+# 报告每 10k 个token的GUI事件数和GUI线程CPU时间
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Measure chat log rendering cost while streaming.")
+    parser.add_argument("--tokens", type=int, default=10000, help="tokens streamed into each tab (default: 10000)")
+    parser.add_argument("--tabs", type=int, default=1, help="tabs streaming at the same time (default: 1)")
+    parser.add_argument("--chunk", default="tok ", help="text of one streamed token")
+    parser.add_argument("--fps", type=int, default=30, help="render frame rate for the buffered mode")
+    parser.add_argument("--offscreen", action="store_true", help="use the offscreen Qt platform (no display)")
+    return parser.parse_args(argv)
+
+
+# 和 ChatTab 一样输出：direct 每个片段一次 update_chat_log，buffered 全部经过渲染缓冲；结束后在GUI线程调用 finished
+async def produce(tab, mode, tokens, chunk, finished):
+    write = (lambda kind, text: engine.dispatch(tab.update_chat_log, text, kind)) if mode == "direct" \
+        else tab.chat_buffer.push
+    write("gpt-start", "")
+    for _ in range(tokens):
+        if mode == "direct":
+            write("gpt", chunk)
+        else:
+            await tab.chat_buffer.put("gpt", chunk)
+        await asyncio.sleep(0)
+    write("gpt-end", "")
+    engine.dispatch(finished, tab)
+
+
+# 统计投递到GUI线程的事件：经过 QtBridge 的回调和渲染缓冲的定时器
+def count_events(bridge, tabs, counter):
+    dispatch = bridge.dispatch
+
+    def counted_dispatch(callback, args):
+        counter[0] += 1
+        dispatch(callback, args)
+    engine.dispatcher = counted_dispatch
+    for tab in tabs:
+        schedule = tab.chat_buffer.scheduler
+
+        def counted_schedule(delay, callback, schedule=schedule):
+            counter[0] += 1
+            schedule(delay, callback)
+        tab.chat_buffer.scheduler = counted_schedule
+
+
+# 在若干个新标签页中同时流式输出，全部结束后以 (统计, 第一个标签页的文本) 调用 on_done
+def run_mode(bridge, mode, args, on_done):
+    tabs = [ChatTab("benchmark", render_fps=args.fps) for _ in range(args.tabs)]
+    counter = [0]
+    remaining = [len(tabs)]
+    started = (time.thread_time(), time.perf_counter())
+
+    def finished(tab):
+        tab.chat_buffer.flush()  # 最后一帧
+        remaining[0] -= 1
+        if remaining[0]:
+            return
+        cpu = time.thread_time() - started[0]
+        wall = time.perf_counter() - started[1]
+        scale = 10000 / (args.tokens * len(tabs))
+        # direct 模式每个片段都更新一次聊天记录
+        renders = sum(tab.chat_buffer.flushes if mode == "buffered" else args.tokens + 2 for tab in tabs)
+        text = "".join(tabs[0].transcript.iter_text())
+        for tab in tabs:
+            tab.deleteLater()
+        on_done(dict(events=counter[0] * scale, cpu_ms=cpu * 1000 * scale, wall_ms=wall * 1000, renders=renders * scale),
+                text)
+
+    count_events(bridge, tabs, counter)
+    for tab in tabs:
+        engine.submit(produce(tab, mode, args.tokens, args.chunk, finished))
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.offscreen:
+        os.environ["QT_QPA_PLATFORM"] = "offscreen"
+    app = QtWidgets.QApplication(sys.argv)
+    bridge = QtBridge()
+    modes = ["direct", "buffered"]
+    texts = {}
+    print(f"{args.tokens} tokens x {args.tabs} tab(s); figures per 10k tokens")
+    print(f"{'mode':>10} {'events':>10} {'GUI CPU ms':>12} {'wall ms':>10} {'renders':>8}")
+
+    # 两种模式在同一个事件循环中依次运行
+    def run_next(index=0):
+        if index == len(modes):
+            app.quit()
+            return
+        mode = modes[index]
+
+        def done(stats, text):
+            texts[mode] = text
+            print(f"{mode:>10} {stats['events']:>10.0f} {stats['cpu_ms']:>12.1f} {stats['wall_ms']:>10.0f} "
+                  f"{stats['renders']:>8.0f}")
+            QtCore.QTimer.singleShot(0, lambda: run_next(index + 1))
+        run_mode(bridge, mode, args, done)
+
+    QtCore.QTimer.singleShot(0, run_next)
+    try:
+        app.exec()
+    finally:
+        engine.stop()
+    if texts["direct"] != texts["buffered"]:
+        print("Rendered text differs between modes", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,76 @@
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from search_index import SearchIndex
+
+ENGLISH = ("translate model context window latency token stream cache session journal export search history "
+           "segment document audio record whisper network proxy schedule priority budget memory layout").split()
+CHINESE = "翻译模型上下文窗口延迟流式缓存会话日志导出搜索历史分段文档音频录制网络代理调度优先级预算内存排版中文日本语言风格"
+JAPANESE = "ほんやくもでるのけんさくきろくおんせいにゅうりょくしゅつりょくかいわ"
+QUERIES = ["latency", "cache sess", "翻译", "流式缓存", "会话日志导出", "搜", "ほんやく", "model 翻译", "nothingmatches"]
+
+
+# 全文索引基准：写入大量中英日混合的合成消息，测量后台建索引的速度和各类查询的延迟(中位数和 p95)
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Measure full-text indexing and search latency.")
+    parser.add_argument("-m", "--messages", type=int, default=300000, help="messages to index (default: 300000)")
+    parser.add_argument("-n", "--repeat", type=int, default=20, help="runs of each query (default: 20)")
+    parser.add_argument("--max-ms", type=float, default=100, help="fail when a query's p95 is slower than this")
+    return parser.parse_args(argv)
+
+
+def make_message(rng):
+    parts = []
+    for _ in range(rng.randint(3, 12)):
+        kind = rng.random()
+        if kind < 0.5:
+            parts.append(" ".join(rng.choices(ENGLISH, k=rng.randint(2, 8))))
+        elif kind < 0.85:
+            parts.append("".join(rng.choices(CHINESE, k=rng.randint(4, 20))) + "。")
+        else:
+            parts.append("".join(rng.choices(JAPANESE, k=rng.randint(4, 15))) + "。")
+    return " ".join(parts)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    rng = random.Random(0)
+    failed = False
+    with tempfile.TemporaryDirectory() as folder:
+        index = SearchIndex(os.path.join(folder, "search.db"))
+        started = time.perf_counter()
+        submit_time = 0
+        for i in range(args.messages):
+            text = make_message(rng)
+            submit_started = time.perf_counter()
+            index.add("Chat 1", 1, i, "user" if i % 2 == 0 else "gpt", text)
+            submit_time += time.perf_counter() - submit_started
+        index.flush(timeout=None)
+        elapsed = time.perf_counter() - started
+        size = os.path.getsize(os.path.join(folder, "search.db")) + os.path.getsize(os.path.join(folder, "search.db-wal"))
+        print(f"indexed {args.messages} messages in {elapsed:.1f} s ({args.messages / elapsed:.0f}/s), "
+              f"{submit_time / args.messages * 1e6:.1f} us per add() on the caller's thread, {size / 2 ** 20:.0f} MB")
+
+        print(f"{'query':>16} {'hits':>6} {'median ms':>10} {'p95 ms':>8}")
+        for query in QUERIES:
+            times = []
+            for _ in range(args.repeat):
+                query_started = time.perf_counter()
+                hits = index.search(query, 50)
+                times.append((time.perf_counter() - query_started) * 1000)
+            p95 = sorted(times)[int(len(times) * 0.95) - 1]
+            print(f"{query:>16} {len(hits):>6} {statistics.median(times):>10.1f} {p95:>8.1f}")
+            failed = failed or p95 > args.max_ms
+        index.close()
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,145 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 核心模块：不能导入任何界面代码，也不能在导入时加载可选的重型后端
+CORE_MODULES = ["request_engine", "hedging", "scheduler", "key_pool", "chat_session", "document_translation",
+                "job_queue", "translation_cache", "transcript", "session_journal", "session_store", "search_index",
+                "audio_capture", "voice_activity", "audio_import", "config", "translate_cli"]
+FORBIDDEN_MODULES = ["PySide6", "openai", "httpx", "chatglm_cpp", "pyaudio", "numpy"]
+PHASES = ["interpreter", "import_core", "import_gui", "first_window"]
+
+# 在新的解释器中运行：依次导入核心模块、导入界面、创建主窗口并进入事件循环，打印各阶段结束的时间
+CHILD = """
+import json, sys, time
+marks = {"interpreter": time.time()}
+for name in CORE_MODULES:
+    __import__(name)
+marks["import_core"] = time.time()
+loaded = [name for name in FORBIDDEN_MODULES if name in sys.modules]
+from PySide6 import QtCore, QtWidgets
+from chat_window import ChatWindow
+from config import Configuration
+marks["import_gui"] = time.time()
+app = QtWidgets.QApplication(sys.argv)
+window = ChatWindow(Configuration(CONFIG))
+window.show()
+def shown():
+    marks["first_window"] = time.time()
+    app.quit()
+QtCore.QTimer.singleShot(0, shown)
+app.exec()
+print(json.dumps({"marks": marks, "core_loaded": loaded}))
+"""
+
+
+# 冷启动基准：从启动解释器到主窗口显示出来的时间，分阶段取多次运行的中位数
+# --save 把结果追加到 JSON Lines 文件中跟踪变化，--baseline 和文件中最近一次结果比较，变慢超过 --tolerance 时失败
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Measure cold start to first window.")
+    parser.add_argument("-n", "--runs", type=int, default=5, help="number of cold starts (default: 5)")
+    parser.add_argument("--offscreen", action="store_true", help="use the offscreen Qt platform (no display)")
+    parser.add_argument("--save", help="append the result to this JSON Lines file")
+    parser.add_argument("--baseline", help="compare with the last result in this JSON Lines file")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown against the baseline")
+    parser.add_argument("--saved-tabs", type=int, default=0,
+                        help="start with this many tabs saved from the last session (default: 0)")
+    parser.add_argument("--saved-messages", type=int, default=1000,
+                        help="chat log messages in each saved tab (default: 1000)")
+    return parser.parse_args(argv)
+
+
+def write_config(folder):
+    path = os.path.join(folder, "config.ini")
+    with open(path, "w") as f:
+        f.write("[API]\nkey = benchmark\n\n[Network]\nwarm_up = false\n\n"
+                f"[Cache]\npath = {os.path.join(folder, 'translations.db')}\n\n"
+                f"[Jobs]\npath = {os.path.join(folder, 'jobs.db')}\n\n"
+                f"[Journal]\nfolder = {os.path.join(folder, 'sessions')}\n\n"
+                f"[Session]\npath = {os.path.join(folder, 'tabs.db')}\n\n"
+                f"[Search]\npath = {os.path.join(folder, 'search.db')}\n")
+    return path
+
+
+# 模拟上次退出时保存的标签页，每个标签页有 messages 条聊天记录和同样长的对话历史
+def write_saved_tabs(folder, tabs, messages):
+    sys.path.insert(0, ROOT)
+    from session_store import SessionStore
+
+    store = SessionStore(os.path.join(folder, "tabs.db"))
+    rows = [("user", f"Question {i}: " + "lorem ipsum " * 10) if i % 2 == 0 else ("gpt", "dolor sit amet " * 40)
+            for i in range(messages)]
+    history = [[{"role": "user" if role == "user" else "assistant", "content": text}, False, len(text) // 4 + 4]
+               for role, text in rows]
+    saved = []
+    for number in range(tabs):
+        tab_id = store.new_tab()
+        store.archive(tab_id).extend(rows)
+        saved.append(dict(id=tab_id, title=f"Chat {number + 1}", settings=dict(model="gpt-4", language="Japanese"),
+                          journal=None, history=history, count=messages))
+    store.save(saved, current=tabs - 1)
+    store.close()
+
+
+def run_once(config_path, offscreen):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.environ.get("PYTHONPATH")])))
+    if offscreen:
+        env["QT_QPA_PLATFORM"] = "offscreen"
+    code = (f"CORE_MODULES = {CORE_MODULES!r}\nFORBIDDEN_MODULES = {FORBIDDEN_MODULES!r}\n"
+            f"CONFIG = {config_path!r}\n" + CHILD)
+    started = time.time()
+    output = subprocess.run([sys.executable, "-c", code], cwd=ROOT, env=env, capture_output=True, text=True,
+                            check=True).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    marks = result["marks"]
+    # 每个阶段记录从进程启动到该阶段结束的累计时间(毫秒)
+    return {phase: (marks[phase] - started) * 1000 for phase in PHASES}, result["core_loaded"]
+
+
+def last_result(path):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        lines = [line for line in f if line.strip()]
+    return json.loads(lines[-1]) if lines else None
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    runs = []
+    with tempfile.TemporaryDirectory() as folder:
+        config_path = write_config(folder)
+        if args.saved_tabs:
+            write_saved_tabs(folder, args.saved_tabs, args.saved_messages)
+        for _ in range(args.runs):
+            timings, core_loaded = run_once(config_path, args.offscreen)
+            if core_loaded:
+                print(f"Core modules loaded {', '.join(core_loaded)} at import time", file=sys.stderr)
+                return 1
+            runs.append(timings)
+
+    result = {phase: round(statistics.median(run[phase] for run in runs), 1) for phase in PHASES}
+    for phase in PHASES:
+        print(f"{phase:>14}: {result[phase]:8.1f} ms")
+
+    failed = False
+    baseline = last_result(args.baseline) if args.baseline else None
+    if baseline is not None:
+        limit = baseline["first_window"] * (1 + args.tolerance)
+        print(f"      baseline: {baseline['first_window']:8.1f} ms (limit {limit:.1f} ms)")
+        failed = result["first_window"] > limit
+    if args.save:
+        with open(args.save, "a") as f:
+            f.write(json.dumps(dict(result, time=time.strftime("%Y-%m-%d %H:%M:%S"), runs=args.runs)) + "\n")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
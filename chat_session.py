@@ -0,0 +1,176 @@
+import asyncio
+import time
+
+from context_window import ContextWindow, prompt_budget
+from local_session import LOCAL_CONTEXT_LENGTH, LocalChatSession, stream_local_reply
+from openai_client import create_chat_completion, stream_text, transcribe_file
+from request_engine import engine
+from scheduler import PRIORITY_INTERACTIVE, request_tokens, scheduler
+
+
+# 一个多轮对话：按token预算截取的历史、本地模型的KV缓存状态，以及向模型发出请求的逻辑
+# 不依赖任何界面代码；GUI标签页只负责显示，脚本也可以直接使用
+# prepare/finish 修改历史，应在同一个线程(GUI线程)中调用；stream_reply 在请求引擎中运行
+class ChatSession:
+    def __init__(self):
+        self.history = ContextWindow()
+        self.local_session = LocalChatSession()
+        self.awaiting_reply = False  # prepare 已加入用户消息，finish 还没有加入回复
+
+    def clear(self):
+        self.history.clear()
+        self.local_session.invalidate()
+        self.awaiting_reply = False
+
+    # 保存和恢复对话历史：[[消息, 是否固定, token数], ...]，可以直接转成JSON
+    # 还没有回复的用户消息不保存，否则恢复后本地模型的历史(用户、回复交替的字符串列表)会错位
+    def saved_history(self):
+        saved = [list(entry) for entry in zip(self.history.messages, self.history.pinned, self.history.token_counts)]
+        return saved[:-1] if self.awaiting_reply else saved
+
+    def restore_history(self, saved):
+        self.clear()
+        for message, pinned, tokens in saved:
+            self.history.append(message, pinned, tokens)
+
+    # 把用户消息加入历史，返回 (要发送的历史, 是否有更早的消息因超出预算不再发送)
+    def prepare(self, params, message):
+        dropped_before = self.history.dropped_messages
+        self.awaiting_reply = True
+        if params.model == "local model":
+            self.history.append(message)
+            messages = self.history.select(LOCAL_CONTEXT_LENGTH, align=2)
+        else:
+            self.history.append({"role": "user", "content": message})
+            messages = self.history.select(prompt_budget(params.model, params.max_tokens))
+        return messages, self.history.dropped_messages > dropped_before
+
+    # 把回复(被停止时为已生成的部分)加入历史，和 prepare 成对调用
+    def finish(self, params, reply):
+        self.awaiting_reply = False
+        if params.model == "local model":
+            self.history.append(reply)
+        else:
+            self.history.append({"role": "assistant", "content": reply})
+
+    # 流式产出回复片段
+    # OpenAI 请求经过全局调度器排队限流并分配密钥；本地模型从全局注册表租用，复用本会话的KV缓存
+    async def stream_reply(self, params, messages, owner=None, priority=PRIORITY_INTERACTIVE, max_length=2048,
+                           top_k=0, top_p=0.7, repeat_penalty=1.0):
+        if params.model == "local model":
+            generation_kwargs = dict(
+                max_length=min(max_length, LOCAL_CONTEXT_LENGTH + params.max_tokens),
+                max_context_length=LOCAL_CONTEXT_LENGTH,
+                do_sample=params.temperature > 0,
+                top_k=top_k,
+                top_p=top_p,
+                temperature=params.temperature,
+                repetition_penalty=repeat_penalty,
+            )
+            async for chunk in stream_local_reply(params.model_path, messages, session=self.local_session,
+                                                  **generation_kwargs):
+                yield chunk
+            return
+
+        response = await scheduler.call(
+            params.model,
+            create_chat_completion,
+            api_key=params.api_key,
+            model=params.model,
+            messages=messages,
+            temperature=params.temperature,
+            max_tokens=params.max_tokens,
+            stream=True,
+            tokens=request_tokens(messages, params.max_tokens),
+            priority=priority,
+            owner=owner,
+        )
+        async for chunk in engine.iterate(stream_text, response, abort=response.close):
+            yield chunk
+
+
+# 语音转文字，translate=True 时直接翻译成英文；audio 为文件路径或录音(WavSpool)
+async def transcribe_audio(api_key, audio, translate=False, owner=None, priority=PRIORITY_INTERACTIVE):
+    return await scheduler.call("whisper-1", transcribe_file, audio, translate=translate,
+                                api_key=api_key, priority=priority, owner=owner)
+
+
+# 边录边转写时录音线程交给转写协程的录音段：录音线程调用 put()，录音结束时调用 close()
+# 转写结束(或被停止)后还送来的录音段直接关闭
+class SegmentFeed:
+    def __init__(self):
+        self.segments = 0
+        self.closed_at = None   # 录音结束的时间(time.monotonic())
+        self.notices = []       # 录音线程留下的 (消息类型, 提示)，转写结束后写入聊天记录
+        self._queue = asyncio.Queue()
+        self._stopped = False
+
+    def put(self, recording):
+        self.segments += 1
+        engine.call_soon(self._put, recording)
+
+    def close(self):
+        self.closed_at = time.monotonic()
+        engine.call_soon(self._put, None)
+
+    async def get(self):
+        return await self._queue.get()
+
+    # 只在事件循环中调用
+    def stop(self):
+        self._stopped = True
+        while not self._queue.empty():
+            recording = self._queue.get_nowait()
+            if recording is not None:
+                recording.close()
+
+    def _put(self, recording):
+        if not self._stopped:
+            self._queue.put_nowait(recording)
+        elif recording is not None:
+            recording.close()
+
+
+# 分段转写：feed 送来一段就开始转写一段，最多 concurrency 段同时进行；按段的顺序产出 (段号, 文字)
+# feed 是边录边切段的 SegmentFeed，或者从音频文件中切段的 audio_import.AudioFileFeed，都有 get() 和 stop()
+# feed 送完之后等最后几段转写完成就结束；有一段出错时抛出异常，其余的段被取消
+async def stream_segment_transcription(api_key, feed, translate=False, concurrency=3, owner=None,
+                                    priority=PRIORITY_INTERACTIVE):
+    semaphore = asyncio.Semaphore(concurrency)
+    tasks = []
+    done = 0
+    getter = asyncio.ensure_future(feed.get())
+    try:
+        while getter is not None or done < len(tasks):
+            waiting = [getter] if getter is not None else []
+            if done < len(tasks):
+                waiting.append(tasks[done])
+            await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+            if getter is not None and getter.done():
+                recording = getter.result()
+                getter = None
+                if recording is not None:
+                    tasks.append(asyncio.ensure_future(
+                        _transcribe_segment(api_key, recording, translate, semaphore, owner, priority)))
+                    getter = asyncio.ensure_future(feed.get())
+            while done < len(tasks) and tasks[done].done():
+                yield done, tasks[done].result()
+                done += 1
+    finally:
+        feed.stop()
+        if getter is not None:
+            getter.cancel()
+            if getter.done() and not getter.cancelled() and getter.exception() is None:
+                if getter.result() is not None:
+                    getter.result().close()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def _transcribe_segment(api_key, recording, translate, semaphore, owner, priority):
+    try:
+        async with semaphore:
+            return await transcribe_audio(api_key, recording, translate=translate, owner=owner, priority=priority)
+    finally:
+        recording.close()
@@ -1,46 +1,95 @@
+import asyncio
 import os
 import threading
-import wave
 from datetime import datetime
 
-import chatglm_cpp
-import openai
-from openai import OpenAI
-import pyaudio
 from PySide6 import QtWidgets, QtGui
 from PySide6.QtCore import Signal
 from PySide6.QtCore import Slot
 from PySide6.QtGui import QIcon
-from PySide6.QtCore import Qt, QTimer
+from PySide6.QtCore import QTimer
 import time
 
+from audio_capture import Recorder, describe_savings
+from audio_import import AudioFileFeed, remove_overlap
+from chat_session import ChatSession, SegmentFeed, stream_segment_transcription, transcribe_audio
+from context_window import estimate_tokens
+from document_translation import stream_document_translation
+from hedging import hedge_router
+from model_registry import registry
+from prompts import build_translation_prompt
+from qt_bridge import render_scheduler
+from render_buffer import RenderBuffer
+from request_engine import RequestParams, engine
+from scheduler import PRIORITY_BACKGROUND
+from session_journal import export_messages, export_session
+from transcript import Transcript
+from transcript_view import TranscriptView
+from translation_cache import cache_model_name, translation_cache
+
+EXPORT_FILTERS = "Text (*.txt);;Markdown (*.md);;JSON (*.json)"
+
+
+# 记入会话日志的请求信息：模型和参数
+def request_details(params, **details):
+    details.update(model=params.model, temperature=params.temperature, max_tokens=params.max_tokens)
+    if params.model == "local model":
+        details["model_path"] = params.model_path
+    return details
+
+
+# 记入会话日志的耗时(毫秒)：从开始请求到收到第一个片段、到回复结束
+def reply_timing(started, first_chunk, **details):
+    details["latency_ms"] = round((time.monotonic() - started) * 1000)
+    if first_chunk is not None:
+        details["first_token_ms"] = round((first_chunk - started) * 1000)
+    return details
+
 # 管理主应用程序窗口，处理与GPT模型的消息交换
 class ChatTab(QtWidgets.QWidget):
     update_chat_log_signal = Signal(str, str)    # 传递聊天信息更新的信号，包括内容和发送者
     set_button_state_signal = Signal(bool)       # 传递按钮状态的信号
     set_api_button_state_signal = Signal(bool)   # 传递api状态的信号
     recording_state_signal = Signal(bool)        # 传递录制状态的信号
+    model_load_progress_signal = Signal(int)     # 传递本地模型加载进度的信号
+    model_loaded_signal = Signal(str, bool, str) # 传递本地模型加载结果的信号，包括路径、是否成功和错误信息
 
-    def __init__(self, api_key):
+    def __init__(self, api_key, document_concurrency=4, segment_tokens=800, render_fps=30, render_backlog=65536,
+                 transcript_messages=500, journal=None, archive=None, search=None, audio_settings=None,
+                 live_transcription=None, audio_file_settings=None):
         super().__init__()
+        # 流式回复先进入缓冲，按帧率合并后一次写入聊天记录
+        self.chat_buffer = RenderBuffer(self.render_chat_log, render_fps, render_backlog)
+        self.chat_buffer.scheduler = render_scheduler(self)
+        self.document_concurrency = document_concurrency  # 长文本分段翻译时同时翻译的段数
+        self.segment_tokens = segment_tokens              # 超过这个长度的输入按段翻译
         self.model_path = ""
-        self.conversation_history = []
+        self.model_ready = False          # 本地模型是否已加载完毕并由本标签页持有
+        self.model_cancel_event = None
+        self.restore_local_model = False  # 恢复的标签页上次用的是本地模型，加载完成后选中它
+        self.tab_id = None                # 在 session_store 中的编号，退出时据此保存
+        self.session = ChatSession()  # 对话历史和本地模型的KV缓存状态
+        self.request_future = None  # 正在请求引擎中运行的任务
         self.record_thread = None
         self.selected_api = "gpt-3.5-turbo"
         self.api_key = api_key
         self.sender_button = 1
+        self.audio_settings = audio_settings or {}  # 录音的参数，见 audio_capture.Recorder
+        self.live_transcription = live_transcription or {}  # 边录边转写：enabled 和 concurrency
+        self.audio_file_settings = audio_file_settings or {}  # 导入音频文件：分段长度、重叠和并发数
 
         # 创建一个计时器
         self.recording_timer = QTimer(self)  # 创建一个计时器
         self.recording_start_time = None
         self.recording_timer.timeout.connect(self.update_recording_time)  # 连接信号
 
-        # 用于显示聊天记录的文本框
-        self.chat_log = QtWidgets.QTextEdit(self)
-        self.chat_log.setReadOnly(True)
+        # 显示聊天记录：消息保存在 transcript 中，视图只排版可见的部分；journal 为本会话的日志，可以为 None
+        # archive 存放移出内存的消息，恢复的标签页用 session_store 中保存的聊天记录；search 为全文索引的来源
+        self.journal = journal
+        self.transcript = Transcript(transcript_messages, journal, archive, search)
+        self.chat_log = TranscriptView(self.transcript, parent=self)
         normal_height_log = self.chat_log.sizeHint().height()
         self.chat_log.setFixedHeight(normal_height_log * 1.6)
-        self.chat_log.setTextInteractionFlags(Qt.NoTextInteraction)  # 禁止文本交互
 
         # 用户输入信息的文本框
         self.chat_input = QtWidgets.QTextEdit(self)
@@ -63,9 +112,15 @@ class ChatTab(QtWidgets.QWidget):
         self.api_gpt35_radio_button = QtWidgets.QRadioButton("GPT-3.5")
         self.api_gpt4_radio_button = QtWidgets.QRadioButton("GPT-4")
         self.api_local_model_radio_button = QtWidgets.QRadioButton("Local Model")
+        self.api_local_model_radio_button.setDisabled(True)  # 本地模型加载完毕后才可选
+        self.model_status_label = QtWidgets.QLabel("No local model")
+        self.cancel_load_button = QtWidgets.QPushButton("Cancel Loading", self)
+        self.cancel_load_button.hide()
         self.api_group_box_layout.addWidget(self.api_gpt35_radio_button)
         self.api_group_box_layout.addWidget(self.api_gpt4_radio_button)
         self.api_group_box_layout.addWidget(self.api_local_model_radio_button)
+        self.api_group_box_layout.addWidget(self.model_status_label)
+        self.api_group_box_layout.addWidget(self.cancel_load_button)
         self.api_gpt35_radio_button.toggled.connect(self.api_radio_button_toggled)
         self.api_gpt4_radio_button.toggled.connect(self.api_radio_button_toggled)
         self.api_local_model_radio_button.toggled.connect(self.api_radio_button_toggled)
@@ -123,8 +178,14 @@ class ChatTab(QtWidgets.QWidget):
         style_layout.addWidget(self.style_combobox)
         style_layout.addStretch(1)
         
+        # 翻译缓存：跳过缓存的选项(只对下一次翻译生效)和命中统计
+        self.bypass_cache_checkbox = QtWidgets.QCheckBox("Bypass cache")
+        self.cache_stats_label = QtWidgets.QLabel("Cache: 0 hits / 0 misses")
+
         self.trans_layout.addLayout(language_layout)
         self.trans_layout.addLayout(style_layout)
+        self.trans_layout.addWidget(self.bypass_cache_checkbox)
+        self.trans_layout.addWidget(self.cache_stats_label)
 
         self.config_layout.addWidget(self.api_group_box)
         self.config_layout.addWidget(self.par_group_box)
@@ -135,6 +196,8 @@ class ChatTab(QtWidgets.QWidget):
 
         # 功能按钮
         self.send_button = QtWidgets.QPushButton("Send", self)
+        self.stop_button = QtWidgets.QPushButton("Stop", self)
+        self.stop_button.setDisabled(True)  # 只在请求进行中可用
         self.translate_button = QtWidgets.QPushButton("Translate", self)
         self.export_button = QtWidgets.QPushButton("Export", self)
         self.record_translate_button = QtWidgets.QPushButton("Record to Translate", self)
@@ -149,6 +212,7 @@ class ChatTab(QtWidgets.QWidget):
 
         self.button_layout = QtWidgets.QHBoxLayout()
         self.button_layout.addWidget(self.send_button)
+        self.button_layout.addWidget(self.stop_button)
         self.button_layout.addWidget(self.translate_button)
         self.button_layout.addWidget(self.export_button)
         self.layout.addLayout(self.button_layout)
@@ -163,6 +227,7 @@ class ChatTab(QtWidgets.QWidget):
         self.demo_ui()
 
         self.send_button.clicked.connect(self.send)
+        self.stop_button.clicked.connect(self.stop)
         self.translate_button.clicked.connect(self.translate)
         self.update_chat_log_signal.connect(self.update_chat_log)
         self.set_button_state_signal.connect(self.set_button_state)
@@ -172,6 +237,9 @@ class ChatTab(QtWidgets.QWidget):
         self.record_send_button.clicked.connect(self.start_recording)
         self.record_translate_button.clicked.connect(self.start_recording)
         self.clear_button.clicked.connect(self.clear)
+        self.cancel_load_button.clicked.connect(self.cancel_model_loading)
+        self.model_load_progress_signal.connect(self.update_model_progress)
+        self.model_loaded_signal.connect(self.on_model_loaded)
 
         self.recording = threading.Event()
 
@@ -184,44 +252,36 @@ class ChatTab(QtWidgets.QWidget):
         self.translate_button.setDisabled(bool)
         self.record_send_button.setDisabled(bool)
         self.record_translate_button.setDisabled(bool)
+        self.stop_button.setDisabled(not bool)
+
+    # 边录边转写时只留下停止录音的按钮和停止按钮
+    def set_live_button_state(self):
+        self.set_button_disabled(True)
+        button = self.record_send_button if self.sender_button == 1 else self.record_translate_button
+        button.setDisabled(False)
 
     # 禁用api选择按钮
     @Slot()
     def set_api_button_disabled(self, bool):
         self.api_gpt35_radio_button.setDisabled(bool)
         self.api_gpt4_radio_button.setDisabled(bool)
-        self.api_local_model_radio_button.setDisabled(bool)
+        self.api_local_model_radio_button.setDisabled(bool or not self.model_ready)
 
     # 更新聊天记录并设置外观颜色
     @Slot(str, str)
     def update_chat_log(self, message, message_type):
-        # This slot function updates the chat log with the message
-        # message_type is either 'user' or 'gpt' to differentiate the source of the message
-        response_cursor = self.chat_log.textCursor()
-        if message_type == "user":
-            response_cursor.insertHtml("<span style='color: black; font-style: italic;'>You: </span>")
-            response_cursor.insertText(f"{message}\n\n")
-        elif message_type == "gpt-start":
-            response_cursor.insertHtml("<span style='color: green;'>GPT: </span>")
-            response_cursor.insertText(f"{message}")
-        elif message_type == "gpt":
-            response_cursor.insertHtml("<span style='color: green;'> </span>")
-            response_cursor.insertText(f"{message}")
-        elif message_type == "gpt-end":
-            response_cursor.insertHtml("<span style='color: green;'> </span>")
-            response_cursor.insertText(f"{message}\n\n")
-        elif message_type == "gpt-start-translation":
-            response_cursor.insertHtml("<span style='color: blue;'>GPT: </span>")
-            response_cursor.insertText(f"{message}")
-        elif message_type == "gpt-translation":
-            response_cursor.insertHtml("<span style='color: blue;'> </span>")
-            response_cursor.insertText(f"{message}")
-        elif message_type == "gpt-end-translation":
-            response_cursor.insertHtml("<span style='color: blue;'> </span>")
-            response_cursor.insertText(f"{message}\n\n")
-        elif message_type == "error":
-            response_cursor.insertHtml("<span style='color: red;'>ERROR: </span>")
-            response_cursor.insertText(f"{message}\n\n")
+        self.chat_buffer.flush()  # 先显示缓冲中还没渲染的片段
+        self.render_chat_log([(message_type, message)])
+
+    # 写入多条 (message_type, message)，视图只重绘一次
+    # 开始和结束标记的 message_type 可以是 (message_type, 记入会话日志的附加信息)
+    def render_chat_log(self, items):
+        for message_type, message in items:
+            if isinstance(message_type, tuple):
+                self.transcript.write(message_type[0], message, message_type[1])
+            else:
+                self.transcript.write(message_type, message)
+        self.chat_log.refresh()
 
     @Slot(bool)
     def set_button_state(self, state):
@@ -231,6 +291,52 @@ class ChatTab(QtWidgets.QWidget):
     def set_api_button_state(self, state):
         self.set_api_button_disabled(state)
 
+    # 在GUI线程中读取请求参数，后台任务只使用这份快照
+    def snapshot_params(self):
+        return RequestParams(
+            model=self.selected_api,
+            api_key=self.api_key,
+            model_path=self.model_path,
+            temperature=float(self.temperature_input.text()),
+            max_tokens=int(self.max_tokens_input.text()),
+        )
+
+    # 读取参数失败时在聊天记录中报错并恢复按钮
+    def try_snapshot_params(self):
+        try:
+            return self.snapshot_params()
+        except ValueError as e:
+            self.update_chat_log_signal.emit(f"Error: {str(e)}", "error")
+            self.set_button_state_signal.emit(False)
+            return None
+
+    # 把请求交给全局请求引擎；请求还在排队时就被停止，则在GUI线程中调用 on_cancel
+    def start_request(self, coro, on_cancel=None):
+        self.request_future = engine.submit(coro, on_cancel=on_cancel or self.request_stopped)
+
+    # 停止正在生成的回复
+    @Slot()
+    def stop(self):
+        self.cancel_requests()
+
+    # 翻译或语音请求被停止
+    def request_stopped(self):
+        self.update_chat_log("Generation stopped.", "notice")
+        self.set_button_state(False)
+
+    # 一轮对话结束(正常完成或被停止)：把回复(被停止时为已生成的部分)记入历史并恢复按钮
+    def finish_reply(self, params, reply, stopped=False):
+        self.session.finish(params, reply)
+        if stopped:
+            self.update_chat_log("Generation stopped.", "notice")
+        self.set_button_state(False)
+
+    # 取消本标签页正在进行的请求(标签页关闭时)
+    def cancel_requests(self):
+        if self.request_future is not None:
+            self.request_future.cancel()
+            self.request_future = None
+
     # 发送信息的功能
     @Slot()
     def send(self):
@@ -242,79 +348,53 @@ class ChatTab(QtWidgets.QWidget):
         if not message:
             self.set_button_state_signal.emit(False)
             return  # If there is no input, return
+        params = self.try_snapshot_params()
+        if params is None:
+            return
 
         self.chat_input.clear()  # Clear the input box
         self.update_chat_log_signal.emit(message, "user")  # Update the chat log with the user message
 
-        if self.selected_api == "local model":
-            message_thread = threading.Thread(target=self.local_process_message, args=(message,))
-        else:
-            message_thread = threading.Thread(target=self.process_message, args=(message,))
-        message_thread.start()
-
-    # 通过api和gpt通信
-    def process_message(self, message):
+        messages, trimmed = self.session.prepare(params, message)
+        if trimmed:
+            # 有更早的消息被丢弃时在聊天记录中提示
+            self.update_chat_log_signal.emit(
+                f"Context limit reached: {self.session.history.dropped_messages} earlier messages "
+                f"(~{self.session.history.dropped_tokens} tokens) are no longer sent to the model.",
+                "notice")
+        self.start_request(self.process_message(params, messages),
+                           on_cancel=lambda: self.finish_reply(params, "", stopped=True))
+
+    # 和gpt或部署在本地的ChatGLM-3 模型通信，回复逐段显示
+    async def process_message(self, params, messages):
+        collected_messages = ""
+        started = False
+        request_started, first_chunk = time.monotonic(), None
         try:
-            user_message = {"role": "user", "content": message}
-            self.conversation_history.append(user_message)
-            client = OpenAI(api_key=self.api_key) 
-            response = client.chat.completions.create(
-                model=self.selected_api,
-                messages=self.conversation_history,  # Use the conversation history
-                temperature=float(self.temperature_input.text()),
-                stream=True
-            )
-
-            collected_messages = ""
-            self.update_chat_log_signal.emit("", "gpt-start")
-            for chunk in response:  # 遍历数据流的事件
-                chunk_message = chunk.choices[0].delta.content # 提取消息
-                if chunk_message is not None:
-                    collected_messages += chunk_message  # 保存消息
-                    self.update_chat_log_signal.emit(chunk_message, "gpt")
-            self.update_chat_log_signal.emit("", "gpt-end")
-            self.conversation_history.append({"role": "assistant", "content": collected_messages})
+            async for chunk_message in self.session.stream_reply(params, messages, owner=self):
+                if not started:
+                    first_chunk = time.monotonic()
+                    self.chat_buffer.push(("gpt-start", request_details(params)), "")
+                    started = True
+                collected_messages += chunk_message  # 保存消息
+                await self.chat_buffer.put("gpt", chunk_message)
+            if not started:
+                self.chat_buffer.push(("gpt-start", request_details(params)), "")
+            self.chat_buffer.push(("gpt-end", reply_timing(request_started, first_chunk)), "")
             # Re-enable the send button once message processing is complete
-            self.set_button_state_signal.emit(False)
-
+            engine.dispatch(self.finish_reply, params, collected_messages)
+
+        except asyncio.CancelledError:
+            # 被停止：保留已经生成的部分回复
+            if started:
+                self.chat_buffer.push(("gpt-end", reply_timing(request_started, first_chunk, stopped=True)), "")
+            engine.dispatch(self.finish_reply, params, collected_messages, True)
+            raise
         except Exception as e:
             error_msg = f"Error: {str(e)}"
             # Emit the signal to update the chat log with the error message
-            self.update_chat_log_signal.emit(error_msg, "error")
-            self.set_button_state_signal.emit(False)
-
-    # 和部署在本地的ChatGLM-3 模型通信
-    def local_process_message(self, message, max_length=2048, max_context_length=512, top_k=0, top_p=0.7, temp=0.95,
-                              repeat_penalty=1.0):
-        try:
-            pipeline = chatglm_cpp.Pipeline(self.model_path)
-            self.conversation_history.append(message)
-            print(float(self.temperature_input.text()))
-            # 2. 定义生成参数
-            generation_kwargs = dict(
-                max_length=max_length,
-                max_context_length=max_context_length,
-                do_sample=float(self.temperature_input.text()) > 0,
-                top_k=top_k,
-                top_p=top_p,
-                temperature=float(self.temperature_input.text()),
-                repetition_penalty=repeat_penalty,
-                stream=True,
-            )
-
-            collected_messages = ""
-            self.update_chat_log_signal.emit("", "gpt-start")
-            for response_text in pipeline.chat(self.conversation_history, **generation_kwargs):
-                collected_messages += response_text
-                self.update_chat_log_signal.emit(response_text, "gpt")
-            self.update_chat_log_signal.emit("", "gpt-end")
-            self.conversation_history.append(collected_messages)
-            self.set_button_state_signal.emit(False)
-        except Exception as e:
-            error_msg = f"Error: {str(e)}"
-            # Emit the signal to update the chat log with the error message
-            self.update_chat_log_signal.emit(error_msg, "error")
-            self.set_button_state_signal.emit(False)
+            self.chat_buffer.push("error", error_msg)
+            engine.dispatch(self.set_button_state, False)
 
     # 翻译功能
     @Slot()
@@ -327,85 +407,102 @@ class ChatTab(QtWidgets.QWidget):
         if not message:
             self.set_button_state_signal.emit(False)
             return  # If there is no input, return
+        params = self.try_snapshot_params()
+        if params is None:
+            return
         self.chat_input.clear()  # Clear the input box
 
         selected_language = self.language_combobox.currentText()
         selected_style = self.style_combobox.currentText()
-        if selected_style == "interesting":
-            style_text = "Use a relaxed, playful and cute translation style that needs to be distinguished from normal translation"
-        elif selected_style == "academic":
-            style_text = "Use a rigorous and academic translation style that needs to be distinguished from normal translation"
-        elif selected_style == "simple":
-            style_text = "Use a simple and concise translation style, only translate the general meaning, and need to be different from normal translation."
-        else:
-            style_text = " "
-        request = f"Please translate the following sentence to {selected_language}，{style_text}, and give me translation outcome without anything else: {message}"
+        request = build_translation_prompt(message, selected_language, selected_style)
         self.update_chat_log_signal.emit(message, "user")
 
-        if self.selected_api == "local model":
-            message_thread = threading.Thread(target=self.local_translate_message, args=(request,))
-        else:
-            message_thread = threading.Thread(target=self.translate_message, args=(request,))
-        message_thread.start()
+        cache_key = (message, selected_language, selected_style, cache_model_name(params))
+        bypass_cache = self.bypass_cache_checkbox.isChecked()
+        self.bypass_cache_checkbox.setChecked(False)
+        if estimate_tokens(message) > self.segment_tokens:
+            # 长文本分段并行翻译，每段单独查缓存
+            self.start_request(self.translate_document(params, message, selected_language, selected_style,
+                                                       bypass_cache))
+            return
+        self.start_request(self.translate_message(params, request, cache_key, bypass_cache))
 
-    # 调用api让gpt翻译
-    def translate_message(self, message):
+    @Slot()
+    def update_cache_stats(self):
+        hits, misses = translation_cache.stats()
+        self.cache_stats_label.setText(f"Cache: {hits} hits / {misses} misses")
+
+    # 完整的翻译结果写入缓存
+    async def store_translation(self, cache_key, translation):
+        await engine.run_blocking(translation_cache.put, *cache_key, translation)
+        engine.dispatch(self.update_cache_stats)
+
+    # 让gpt或部署在本地的ChatGLM-3 模型翻译；开启对冲时由路由器在多个后端之间选择先返回的一个
+    # 先在线程池中查缓存(SQLite 读写不放在GUI线程)，命中时直接显示，不再请求模型
+    async def translate_message(self, params, message, cache_key, bypass_cache=False):
+        details = request_details(params, language=cache_key[1], style=cache_key[2])
         try:
-            user_message = {"role": "user", "content": message}
-            # openai.api_key = self.api_key  # Set the OpenAI API key
-            client = OpenAI(api_key = self.api_key)
-            response = client.chat.completions.create(
-                model=self.selected_api,
-                messages=[user_message],  # Use the conversation history
-                stream=True
-            )
-
-            self.update_chat_log_signal.emit("", "gpt-start-translation")
-            for chunk in response:  # 遍历数据流的事件
-                chunk_message = chunk.choices[0].delta.content # 提取消息
-                if chunk_message is not None:
-                    self.update_chat_log_signal.emit(chunk_message, "gpt-translation")
-            # response_text = response.choices[0].message.content
-            # self.update_chat_log_signal.emit(response_text, "gpt-translation")
-            self.update_chat_log_signal.emit("", "gpt-end-translation")
+            cached = None if bypass_cache else await engine.run_blocking(translation_cache.get, *cache_key)
+            engine.dispatch(self.update_cache_stats)
+            if cached is not None:
+                self.chat_buffer.push(("gpt-start-translation", dict(details, cached=True)), "")
+                self.chat_buffer.push("gpt-translation", cached)
+                self.chat_buffer.push("gpt-end-translation", "")
+                engine.dispatch(self.set_button_state, False)
+                return
+
+            translation = ""
+            backend = params
+            request_started, first_chunk = time.monotonic(), None
+            self.chat_buffer.push(("gpt-start-translation", details), "")
+            async for backend, chunk_message in hedge_router.stream(params, message, owner=self):
+                first_chunk = first_chunk or time.monotonic()
+                translation += chunk_message
+                await self.chat_buffer.put("gpt-translation", chunk_message)
+            self.chat_buffer.push(("gpt-end-translation", reply_timing(request_started, first_chunk,
+                                                                       answered_by=backend.model)), "")
+            if backend.model != params.model:
+                self.chat_buffer.push("notice", f"Answered by {backend.model}.")
+            # 缓存记在实际回答的模型名下
+            await self.store_translation(cache_key[:3] + (cache_model_name(backend),), translation)
 
             # Re-enable the send button once message processing is complete
-            self.set_button_state_signal.emit(False)
+            engine.dispatch(self.set_button_state, False)
 
+        except asyncio.CancelledError:
+            engine.dispatch(self.request_stopped)  # 不完整的翻译不写入缓存
+            raise
         except Exception as e:
             error_msg = f"Error: {str(e)}"
             # Emit the signal to update the chat log with the error message
-            self.update_chat_log_signal.emit(error_msg, "error")
-            self.set_button_state_signal.emit(False)
+            self.chat_buffer.push("error", error_msg)
+            engine.dispatch(self.set_button_state, False)
 
-    # 让部署在本地的ChatGLM-3 模型翻译
-    def local_translate_message(self, message, max_length=2048, max_context_length=512, top_k=0, top_p=0.7, temp=0.95,
-                                repeat_penalty=1.0):
+    # 分段并行翻译长文本，译文按原文顺序显示
+    async def translate_document(self, params, message, language, style, bypass_cache):
+        # 本地模型一次只能生成一段，并行只会占用线程池
+        concurrency = 1 if params.model == "local model" else self.document_concurrency
         try:
-            pipeline = chatglm_cpp.Pipeline(self.model_path)
-            # 2. 定义生成参数
-            generation_kwargs = dict(
-                max_length=max_length,
-                max_context_length=max_context_length,
-                do_sample=temp > 0,
-                top_k=top_k,
-                top_p=top_p,
-                temperature=temp,
-                repetition_penalty=repeat_penalty,
-                stream=True,
-            )
-
-            self.update_chat_log_signal.emit("", "gpt-start-translation")
-            for response_text in pipeline.chat([message], **generation_kwargs):
-                self.update_chat_log_signal.emit(response_text, "gpt")
-            self.update_chat_log_signal.emit("", "gpt-end-translation")
-            self.set_button_state_signal.emit(False)
-
+            request_started, first_chunk = time.monotonic(), None
+            self.chat_buffer.push(("gpt-start-translation", request_details(params, language=language, style=style,
+                                                                            segmented=True)), "")
+            async for _, chunk_message in stream_document_translation(
+                    params, message, language, style, concurrency=concurrency, segment_tokens=self.segment_tokens,
+                    bypass_cache=bypass_cache, owner=self):
+                first_chunk = first_chunk or time.monotonic()
+                await self.chat_buffer.put("gpt-translation", chunk_message)
+            self.chat_buffer.push(("gpt-end-translation", reply_timing(request_started, first_chunk)), "")
+            engine.dispatch(self.update_cache_stats)
+            engine.dispatch(self.set_button_state, False)
+
+        except asyncio.CancelledError:
+            engine.dispatch(self.request_stopped)
+            raise
         except Exception as e:
             error_msg = f"Error: {str(e)}"
             # Emit the signal to update the chat log with the error message
-            self.update_chat_log_signal.emit(error_msg, "error")
-            self.set_button_state_signal.emit(False)
+            self.chat_buffer.push("error", error_msg)
+            engine.dispatch(self.set_button_state, False)
 
     # 切换API版本
     @Slot()
@@ -415,7 +512,7 @@ class ChatTab(QtWidgets.QWidget):
         elif self.api_gpt4_radio_button.isChecked():
             self.selected_api = "gpt-4"
         elif self.api_local_model_radio_button.isChecked():
-            if self.model_path:
+            if self.model_ready:
                 self.selected_api = "local model"
             else:
                 QtWidgets.QMessageBox.critical(
@@ -425,74 +522,197 @@ class ChatTab(QtWidgets.QWidget):
                 )
                 self.api_gpt35_radio_button.click()
 
-    # 导出聊天记录为.txt文件
+    # 在后台加载导入的本地模型，加载完成前本地模型选项不可用
+    def load_model(self, model_path):
+        self.cancel_model_loading()
+        self.release_model()
+        self.model_path = model_path
+        self.model_cancel_event = threading.Event()
+        self.model_status_label.setText("Loading... 0%")
+        self.cancel_load_button.show()
+        load_thread = threading.Thread(target=self.preload_model, args=(model_path, self.model_cancel_event),
+                                       daemon=True)
+        load_thread.start()
+
+    def preload_model(self, model_path, cancel_event):
+        try:
+            loaded = registry.preload(
+                model_path,
+                progress=lambda fraction: self.model_load_progress_signal.emit(int(fraction * 100)),
+                cancel_event=cancel_event,
+            )
+            self.model_loaded_signal.emit(model_path, loaded, "" if loaded else "Cancelled")
+        except Exception as e:
+            self.model_loaded_signal.emit(model_path, False, str(e))
+
+    @Slot(int)
+    def update_model_progress(self, percent):
+        if percent >= 100:
+            self.model_status_label.setText("Initializing...")
+        else:
+            self.model_status_label.setText(f"Loading... {percent}%")
+
+    @Slot(str, bool, str)
+    def on_model_loaded(self, model_path, loaded, error):
+        # 已被取消或已被新导入的模型替换，丢弃这次加载的结果
+        if model_path != self.model_path or self.model_cancel_event.is_set():
+            if loaded:
+                registry.release(model_path)
+            return
+        self.cancel_load_button.hide()
+        self.model_ready = loaded
+        self.api_local_model_radio_button.setDisabled(not loaded)
+        if loaded:
+            self.model_status_label.setText(f"Ready: {os.path.basename(model_path)}")
+            if self.restore_local_model:
+                self.api_local_model_radio_button.setChecked(True)
+        else:
+            self.model_path = ""
+            self.model_status_label.setText(f"Load failed: {error}" if error != "Cancelled" else "No local model")
+
+    @Slot()
+    def cancel_model_loading(self):
+        if self.model_cancel_event is not None and not self.model_ready:
+            self.restore_local_model = False
+            self.model_cancel_event.set()
+            self.model_path = ""
+            self.cancel_load_button.hide()
+            self.model_status_label.setText("No local model")
+
+    # 释放本标签页持有的本地模型
+    def release_model(self):
+        if self.model_ready:
+            self.model_ready = False
+            registry.release(self.model_path)
+            if self.api_local_model_radio_button.isChecked():
+                self.api_gpt35_radio_button.click()
+            self.api_local_model_radio_button.setDisabled(True)
+            self.model_path = ""
+            self.model_status_label.setText("No local model")
+
+    # 退出时保存的标签页设置：模型、参数、语言和风格
+    def tab_settings(self):
+        return dict(
+            model=self.selected_api,
+            model_path=self.model_path if self.model_ready else "",
+            temperature=self.temperature_input.text(),
+            max_tokens=self.max_tokens_input.text(),
+            language=self.language_combobox.currentText(),
+            style=self.style_combobox.currentText(),
+        )
+
+    # 恢复保存的标签页：设置、对话历史和聊天记录；本地模型重新在后台加载
+    def restore_tab(self, settings, history):
+        self.temperature_input.setText(settings.get("temperature", self.temperature_input.text()))
+        self.max_tokens_input.setText(settings.get("max_tokens", self.max_tokens_input.text()))
+        self.language_combobox.setCurrentText(settings.get("language", self.language_combobox.currentText()))
+        self.style_combobox.setCurrentText(settings.get("style", self.style_combobox.currentText()))
+        if settings.get("model") == "gpt-4":
+            self.api_gpt4_radio_button.setChecked(True)
+        model_path = settings.get("model_path")
+        if model_path and os.path.exists(model_path):
+            self.load_model(model_path)
+            self.restore_local_model = settings.get("model") == "local model"
+        self.session.restore_history(history)
+        self.chat_log.refresh()
+
+    # 导出聊天记录，格式由扩展名决定(.txt/.md/.json)；从会话日志中逐条读取，在后台线程中写文件
     @Slot()
     def export_chat(self):
         now = datetime.now()
         timestamp = now.strftime("%Y-%m-%d-%H-%M-%S")
-        file_name = f"chat_{timestamp}.txt"  # 文件名为chat_时间戳.txt
+        file_name, selected_filter = QtWidgets.QFileDialog.getSaveFileName(
+            self, "Export Chat", f"chat_{timestamp}.txt", EXPORT_FILTERS)  # 默认文件名为chat_时间戳.txt
+        if not file_name:
+            return
+        if not os.path.splitext(file_name)[1]:
+            file_name += selected_filter[selected_filter.index("*") + 1:-1]
+        self.chat_buffer.flush()  # 还没显示的片段也要记入日志
+        if self.journal is None:
+            # 没有会话日志时从聊天记录导出，只有角色和文本
+            messages = [dict(role=role, text=text) for role, text in self.transcript]
+            engine.submit(self.export_chat_file(file_name, messages))
+        else:
+            engine.submit(self.export_chat_file(file_name))
 
+    async def export_chat_file(self, file_name, messages=None):
         try:
-            with open(file_name, "w") as f:
-                f.write(self.chat_log.toPlainText())
+            if messages is None:
+                await engine.run_blocking(self.journal.flush)
+                await engine.run_blocking(export_session, self.journal.paths(), file_name)
+            else:
+                await engine.run_blocking(export_messages, messages, file_name)
+            engine.dispatch(self.export_finished, file_name, None)
+        except Exception as e:
+            engine.dispatch(self.export_finished, file_name, e)
+
+    def export_finished(self, file_name, error):
+        if error is None:
             QtWidgets.QMessageBox.information(
                 self, "Export Successful", f"The chat has been exported to {file_name}."
             )
-        except Exception as e:
+        else:
             # 错误处理
             QtWidgets.QMessageBox.critical(
                 self,
                 "Export Error",
-                f"An error occurred while exporting the chat: {str(e)}",
+                f"An error occurred while exporting the chat: {str(error)}",
             )
 
     # 清空聊天记录
     @Slot()
     def clear(self):
-        self.conversation_history.clear()
-        self.chat_log.clear()
+        self.session.clear()
+        self.chat_buffer.clear()
+        self.transcript.clear()
+        self.chat_log.refresh()
 
-    # 录音
+    # 录音：PortAudio 的回调把数据放进环形缓冲，这个线程边录边去掉长的静音并写成 WAV(超过内存上限时移到临时文件)，
+    # 录完(按设置压缩后)直接上传；没有听到说话时不上传
     def record(self):
-        p = pyaudio.PyAudio()
-        frames = []
-        stream = p.open(format=pyaudio.paInt16,
-                        channels=1,
-                        rate=10000,
-                        input=True,
-                        frames_per_buffer=2048)
+        recorder = Recorder(**self.audio_settings)
         self.recording_state_signal.emit(True)
-        # 开始录音
-        while not self.recording.is_set():
-            try:
-                # 读取音频数据
-                data = stream.read(2048)
-                frames.append(data)
-                print("1")
-                if self.recording.wait(timeout=0.05):  # timeout设置为1秒检查一次
-                    print("0")
-                    break
-            except Exception as e:
-                print(e)
-                break
-
-        stream.stop_stream()
-        stream.close()
-        p.terminate()
-
-        # 保存录音
-        output_folder = "records"
-        if not os.path.exists(output_folder):
-            os.makedirs(output_folder)
-        output_path = os.path.join(output_folder, "recorded_audio.wav")
-
-        with wave.open(output_path, 'wb') as wf:
-            wf.setnchannels(1)
-            wf.setsampwidth(p.get_sample_size(pyaudio.paInt16))
-            wf.setframerate(10000)
-            wf.writeframes(b''.join(frames))
-            
-        self.upload_audio(output_path)
+        if self.live_transcription.get("enabled"):
+            self.record_live(recorder)
+            return
+        try:
+            recording = recorder.capture(self.recording)
+        except Exception as e:
+            self.update_chat_log_signal.emit(f"Error: {str(e)}", "error")
+            return
+        if recorder.dropped:
+            self.update_chat_log_signal.emit(f"{recorder.dropped:.1f}s of audio were dropped while recording.",
+                                             "notice")
+        if recorder.compress_error:
+            self.update_chat_log_signal.emit(f"Could not compress the recording ({recorder.compress_error}); "
+                                             f"sending it as WAV.", "notice")
+        if not recording.duration:
+            recording.close()
+            self.update_chat_log_signal.emit("No speech was detected; nothing was sent.", "notice")
+            return
+        self.upload_audio(recording)
+
+    # 边录边转写：录音在停顿处切段，每段一切出来就上传，转写结果按顺序追加到同一条消息中
+    # 录音线程中的提示先记在 feed 上，等转写结束后再写入聊天记录，不打断正在追加的消息
+    def record_live(self, recorder):
+        feed = SegmentFeed()
+        self.upload_live_audio(feed)
+        try:
+            recording = recorder.capture(self.recording, on_segment=feed.put)
+        except Exception as e:
+            feed.notices.append(("error", f"Error: {str(e)}"))
+            feed.close()
+            return
+        if recording.duration:
+            feed.put(recording)
+        else:
+            recording.close()
+        if recorder.dropped:
+            feed.notices.append(("notice", f"{recorder.dropped:.1f}s of audio were dropped while recording."))
+        if recorder.compress_error:
+            feed.notices.append(("notice", f"Could not compress the recording ({recorder.compress_error}); "
+                                           f"sent it as WAV."))
+        feed.close()
 
     # @Slot(bool)
     # def update_button_text(self, is_recording):
@@ -509,6 +729,8 @@ class ChatTab(QtWidgets.QWidget):
         self.recording_start_time = None
         self.recording_state_signal.emit(False)
         self.recording.clear()
+        if self.request_future is not None and not self.request_future.done():
+            self.set_button_disabled(True)  # 边录边转写：等最后几段转写完成
         if self.sender_button == 1:
             self.record_send_button.setText("Record to Transcriptions")
         elif self.sender_button == 2:
@@ -542,41 +764,173 @@ class ChatTab(QtWidgets.QWidget):
             else:
                 self.finish_recording()
 
-    def upload_audio(self, audio_file_path):
+    def upload_audio(self, recording):
             # Disable the send button to prevent multiple clicks
         self.set_button_state_signal.emit(True)
         self.set_api_button_state_signal.emit(True)
 
         self.update_chat_log_signal.emit("您发送了一条语音", "user")
 
-        message_thread = threading.Thread(target=self.process_audio, args=(audio_file_path, ))
-        message_thread.start()
+        # 请求还在排队时就被停止，录音不会再上传
+        def cancelled():
+            recording.close()
+            self.request_stopped()
+
+        self.start_request(self.process_audio(self.api_key, recording, self.sender_button), on_cancel=cancelled)
 
-    def process_audio(self, audio_file_path):
+    async def process_audio(self, api_key, recording, sender_button):
         try:
-            # openai.api_key = self.api_key  # 设置openai API密钥
-            client = OpenAI(api_key = self.api_key)
-
-            # 构建API请求
-            with open(audio_file_path, "rb") as audio_file:
-                if self.sender_button == 1:
-                    transcript = client.audio.transcriptions.create(model="whisper-1", file=audio_file)
-                else:
-                    transcript = client.audio.translations.create(model="whisper-1", file=audio_file)
-            response = transcript.text
-
-            self.update_chat_log_signal.emit("", "gpt-start-translation")
+            request_started = time.monotonic()
+            translate = sender_button != 1
+            response = await transcribe_audio(api_key, recording, translate=translate, owner=self)
+
+            self.chat_buffer.push(("gpt-start-translation", dict(model="whisper-1", translate=translate)), "")
             text_chunks = response.split("\n")
             for chunk in text_chunks:  # 遍历数据流的事件
-                self.update_chat_log_signal.emit(chunk, "gpt-translation")
-            self.update_chat_log_signal.emit("", "gpt-end-translation")
-            self.set_button_state_signal.emit(False)
-
+                await self.chat_buffer.put("gpt-translation", chunk)
+            self.chat_buffer.push(("gpt-end-translation", reply_timing(request_started, None)), "")
+            savings = describe_savings(recording, time.monotonic() - request_started)
+            if savings:
+                self.chat_buffer.push("notice", savings)
+            engine.dispatch(self.set_button_state, False)
+
+        except asyncio.CancelledError:
+            engine.dispatch(self.request_stopped)
+            raise
         except Exception as e:
             error_msg = f"Error: {str(e)}"
             # Emit the signal to update the chat log with the error message
-            self.update_chat_log_signal.emit(error_msg, "error")
-            self.set_button_state_signal.emit(False)
+            self.chat_buffer.push("error", error_msg)
+            engine.dispatch(self.set_button_state, False)
+        finally:
+            recording.close()
+
+    def upload_live_audio(self, feed):
+        engine.dispatch(self.set_live_button_state)
+        self.set_api_button_state_signal.emit(True)
+
+        self.update_chat_log_signal.emit("您发送了一条语音", "user")
+
+        # 请求还在排队时就被停止，之后切出的录音段直接关闭
+        def cancelled():
+            engine.call_soon(feed.stop)
+            self.stop_live_recording()
+            self.request_stopped()
+
+        self.start_request(self.process_live_audio(self.api_key, feed, self.sender_button), on_cancel=cancelled)
+
+    async def process_live_audio(self, api_key, feed, sender_button):
+        try:
+            request_started = time.monotonic()
+            translate = sender_button != 1
+            first_chunk = None
+            async for index, text in stream_segment_transcription(
+                    api_key, feed, translate=translate, concurrency=self.live_transcription.get("concurrency", 3),
+                    owner=self):
+                if first_chunk is None:
+                    first_chunk = time.monotonic()
+                    self.chat_buffer.push(("gpt-start-translation", dict(model="whisper-1", translate=translate,
+                                                                         live=True)), "")
+                await self.chat_buffer.put("gpt-translation", (" " if index else "") + text.strip())
+            if first_chunk is not None:
+                self.chat_buffer.push(("gpt-end-translation", reply_timing(request_started, first_chunk,
+                                                                           segments=feed.segments)), "")
+            for message_type, message in feed.notices:
+                self.chat_buffer.push(message_type, message)
+            if first_chunk is None:
+                self.chat_buffer.push("notice", "No speech was detected; nothing was sent.")
+            else:
+                self.chat_buffer.push("notice", f"Transcribed {feed.segments} segments while recording; the last one "
+                                                f"was ready {time.monotonic() - feed.closed_at:.1f}s after recording "
+                                                f"stopped.")
+            engine.dispatch(self.set_button_state, False)
+
+        except asyncio.CancelledError:
+            engine.dispatch(self.stop_live_recording)
+            engine.dispatch(self.request_stopped)
+            raise
+        except Exception as e:
+            self.chat_buffer.push("error", f"Error: {str(e)}")
+            engine.dispatch(self.stop_live_recording)
+            engine.dispatch(self.set_button_state, False)
+
+    # 边录边转写被停止或出错时录音可能还在进行：先停止录音线程、恢复录音按钮，再恢复其他按钮，
+    # 否则麦克风一直开着，另一个录音按钮还能再开一个录音线程
+    def stop_live_recording(self):
+        if self.recording_start_time is not None:
+            self.finish_recording()
+
+    # 转写(或翻译成英文)一个音频文件：在停顿处切成有重叠的段，并发转写，按顺序拼接并去掉重叠部分的重复
+    # 进度显示在录音按钮上；文件多长内存都只保存几段
+    def import_audio(self, path, translate=False):
+        settings = dict(self.audio_file_settings)
+        concurrency = settings.pop("concurrency", 3)
+        try:
+            feed = AudioFileFeed(path, **settings, limit=concurrency + 1, trim=self.audio_settings.get("trim"),
+                                 compress=self.audio_settings.get("compress"))
+        except (OSError, ValueError) as e:
+            self.update_chat_log(f"Error: {str(e)}", "error")
+            return
+        self.sender_button = 2 if translate else 1
+        self.set_button_state(True)
+        self.set_api_button_state(True)
+        minutes, seconds = divmod(int(feed.audio.duration), 60)
+        self.update_chat_log(f"Audio file: {os.path.basename(path)} ({minutes}m{seconds:02d}s)", "user")
+        self.show_audio_progress(0)
+
+        def cancelled():
+            feed.stop()
+            self.finish_audio_import()
+            self.request_stopped()
+
+        self.start_request(self.process_audio_file(self.api_key, feed, translate, concurrency), on_cancel=cancelled)
+
+    async def process_audio_file(self, api_key, feed, translate, concurrency):
+        try:
+            request_started = time.monotonic()
+            first_chunk = None
+            previous = ""
+            async for index, text in stream_segment_transcription(
+                    api_key, feed, translate=translate, concurrency=concurrency, owner=self,
+                    priority=PRIORITY_BACKGROUND):
+                if first_chunk is None:
+                    first_chunk = time.monotonic()
+                    self.chat_buffer.push(("gpt-start-translation", dict(model="whisper-1", translate=translate,
+                                                                         file=feed.audio.path)), "")
+                text = text.strip()
+                piece = remove_overlap(previous, text)
+                previous = text
+                if piece:
+                    await self.chat_buffer.put("gpt-translation", (" " if index else "") + piece)
+                engine.dispatch(self.show_audio_progress, feed.progress(index))
+            elapsed = time.monotonic() - request_started
+            if first_chunk is not None:
+                self.chat_buffer.push(("gpt-end-translation", reply_timing(request_started, first_chunk,
+                                                                           segments=feed.segments)), "")
+                uploaded = feed.uploaded / 2 ** 20
+                self.chat_buffer.push("notice", f"Transcribed {feed.audio.duration:.0f}s of audio in {elapsed:.1f}s "
+                                                f"({feed.segments} segments, {uploaded:.1f} MB uploaded).")
+            else:
+                self.chat_buffer.push("notice", "No speech was detected; nothing was sent.")
+            engine.dispatch(self.finish_audio_import)
+            engine.dispatch(self.set_button_state, False)
+
+        except asyncio.CancelledError:
+            engine.dispatch(self.finish_audio_import)
+            engine.dispatch(self.request_stopped)
+            raise
+        except Exception as e:
+            self.chat_buffer.push("error", f"Error: {str(e)}")
+            engine.dispatch(self.finish_audio_import)
+            engine.dispatch(self.set_button_state, False)
+
+    def show_audio_progress(self, fraction):
+        button = self.record_send_button if self.sender_button == 1 else self.record_translate_button
+        button.setText(f"Transcribing... {fraction:.0%}")
+
+    def finish_audio_import(self):
+        self.record_send_button.setText("Record to Transcriptions")
+        self.record_translate_button.setText("Record to Translate")
 
     def update_recording_time(self):
         if self.recording_start_time:
@@ -590,7 +944,7 @@ class ChatTab(QtWidgets.QWidget):
     # 设置按钮样式
     def demo_ui(self):
         self.chat_log.setStyleSheet("""
-                            QTextEdit {
+                            TranscriptView {
                                 border: 2px solid black;
                                 border-radius: 10px;
                                 padding: 8px;
@@ -1032,4 +1386,8 @@ class ChatTab(QtWidgets.QWidget):
                         border: 2px solid #D3D3D3;  /* Light Gray border when disabled */
                         background-color: #A9A9A9;  /* Dark Gray background when disabled */
                     }
-                """)
\ No newline at end of file
+                """)
+
+        # stop_button 与 clear_button 使用相同的样式
+        self.stop_button.setStyleSheet(self.clear_button.styleSheet())
+
@@ -1,12 +1,30 @@
 from PySide6 import QtWidgets, QtCore
 from PySide6.QtCore import Slot
-from PySide6.QtWidgets import QFileDialog, QMainWindow
+from PySide6.QtWidgets import QFileDialog, QMainWindow, QMessageBox
+from audio_import import AUDIO_FILE_TYPES
 from chat_tab import ChatTab
 from component import MinTab
+from file_formats import output_name
+from hedging import hedge_router
+from job_queue import DONE, job_queue
+from key_pool import key_pool
+from model_registry import registry
+from openai_client import client_pool
+from qt_bridge import QtBridge
+from request_engine import engine
+from scheduler import scheduler
+from search_index import search_index
+from search_panel import SearchPanel
+from session_journal import journal_writer
+from session_store import session_store
+from translation_cache import translation_cache
+
+# 还没有显示过的恢复的标签页：只占一个空控件，第一次切换到它时才创建 ChatTab
+class TabPlaceholder(QtWidgets.QWidget):
+    def __init__(self, saved):
+        super().__init__()
+        self.saved = saved
 
-import os
-os.environ['HTTP_PROXY'] = '192.168.43.224:7890'
-os.environ['HTTPS_PROXY'] = '192.168.43.224:7890'
 
 # 管理用户交互并促进应用程序内部的对话流程
 # ChatWindow 类，主窗口
@@ -15,10 +33,28 @@ class ChatWindow(QtWidgets.QWidget):
         super().__init__()
         self.tab_count = 0
         self.configuration = configuration
+        registry.set_ram_budget(configuration.get_model_ram_budget())
+        client_pool.configure(**configuration.get_network_settings())
+        # 所有后台请求的结果都经过这个桥回到GUI线程
+        self.bridge = QtBridge()
+        engine.dispatcher = self.bridge.dispatch
+        engine.max_concurrency = configuration.get_max_concurrency()
+        translation_cache.configure(**configuration.get_cache_settings())
+        hedge_router.configure(**configuration.get_hedging_settings())
+        scheduler.configure(**configuration.get_rate_limit_settings())
+        key_pool.configure(**configuration.get_key_pool_settings())
+        job_queue.configure(**configuration.get_job_settings())
+        journal_writer.configure(**configuration.get_journal_settings())
+        session_store.configure(**configuration.get_session_settings())
+        search_index.configure(**configuration.get_search_settings())
+        self.job_futures = {}  # job_id -> 正在运行的文件翻译任务
         self.setStyleSheet("background-color: white;")
         self.setWindowTitle("TransGPT")
         self.setGeometry(50, 50, 800, 600)
 
+        # 搜索全部记录的窗口，第一次打开时创建
+        self.search_panel = None
+
         # 用于独立窗口
         self.new_window = None
         self.chat_tab = None
@@ -30,6 +66,7 @@ class ChatWindow(QtWidgets.QWidget):
         self.tab_widget.tabCloseRequested.connect(self.check_tab_count)
         self.tab_widget.setUsesScrollButtons(True)
         self.tab_widget.setTabPosition(QtWidgets.QTabWidget.West)
+        self.tab_widget.currentChanged.connect(self.materialize_tab)
 
         self.import_button = QtWidgets.QPushButton("Import Local Model", self)
         self.import_button.clicked.connect(self.import_model)
@@ -41,12 +78,34 @@ class ChatWindow(QtWidgets.QWidget):
         self.min_button = QtWidgets.QPushButton("Minimize", self)
         self.min_button.clicked.connect(self.min_tab)
 
+        self.translate_file_button = QtWidgets.QPushButton("Translate File", self)
+        self.translate_file_button.clicked.connect(self.translate_file)
+
+        self.transcribe_file_button = QtWidgets.QPushButton("Transcribe Audio", self)
+        self.transcribe_file_button.clicked.connect(self.transcribe_audio_file)
+
+        self.search_button = QtWidgets.QPushButton("Search", self)
+        self.search_button.clicked.connect(self.show_search)
+        self.search_button.setEnabled(search_index.enabled)
+
         self.bottom_box = QtWidgets.QGroupBox()
         self.bottom_layout = QtWidgets.QHBoxLayout(self.bottom_box)
         self.copyright = QtWidgets.QLabel("© [2023] Oops Computing Team. All Rights Reserved.")
+        # 全局调度器中排队的请求数和平均等待时间
+        self.queue_label = QtWidgets.QLabel(self)
+        self.queue_timer = QtCore.QTimer(self)
+        self.queue_timer.timeout.connect(self.update_queue_status)
+        self.queue_timer.start(1000)
+        # 文件翻译任务的进度
+        self.job_label = QtWidgets.QLabel(self)
 
         self.bottom_layout.addWidget(self.copyright)
+        self.bottom_layout.addWidget(self.queue_label)
+        self.bottom_layout.addWidget(self.job_label)
         self.bottom_layout.addWidget(self.import_button)
+        self.bottom_layout.addWidget(self.translate_file_button)
+        self.bottom_layout.addWidget(self.transcribe_file_button)
+        self.bottom_layout.addWidget(self.search_button)
         self.bottom_layout.addWidget(self.new_tab_button)
         self.bottom_layout.addWidget(self.min_button)
 
@@ -54,23 +113,127 @@ class ChatWindow(QtWidgets.QWidget):
         self.layout.addWidget(self.tab_widget)
         self.layout.addWidget(self.bottom_box)
 
-        self.add_new_tab()
+        self.restore_tabs()
         self.deco_ui()
 
+        # 窗口显示后再在后台预热连接(同时加载 OpenAI SDK)，并询问是否继续上次没有完成的文件翻译
+        if configuration.get_warm_up():
+            QtCore.QTimer.singleShot(0, self.warm_up_connections)
+        QtCore.QTimer.singleShot(0, self.offer_resume_jobs)
 
     def add_new_tab(self):
         self.tab_count += 1
+        title = f"Chat {self.tab_count}"
+        index = self.tab_widget.addTab(self.create_tab(title), title)
+        self.tab_widget.setCurrentIndex(index)
+
+    # 创建标签页；saved 为上次退出时保存的标签页
+    def create_tab(self, title, saved=None):
         api_key = self.configuration.get_api_key()
-        chat_tab = ChatTab(api_key)
-        index = self.tab_widget.addTab(chat_tab, f"Chat {self.tab_count}")
+        archive = None
+        tab_id = None
+        if saved is not None:
+            tab_id = saved.id
+            archive = session_store.archive(tab_id, saved.count)
+        elif session_store.enabled:
+            tab_id = session_store.new_tab()
+            archive = session_store.archive(tab_id)
+        chat_tab = ChatTab(api_key, **self.configuration.get_document_settings(),
+                           **self.configuration.get_render_settings(),
+                           journal=journal_writer.open_session(saved.journal if saved is not None else None),
+                           archive=archive, search=search_index.source(title, tab_id),
+                           audio_settings=self.configuration.get_audio_settings(),
+                           live_transcription=self.configuration.get_live_transcription_settings(),
+                           audio_file_settings=self.configuration.get_audio_file_settings())
+        chat_tab.tab_id = tab_id
+        if saved is not None:
+            chat_tab.restore_tab(saved.settings, session_store.history(tab_id))
+        return chat_tab
+
+    # 恢复上次退出时打开的标签页：只创建当前的一个，其余的在第一次切换到时创建
+    def restore_tabs(self):
+        saved_tabs = session_store.tabs() if session_store.enabled else []
+        if not saved_tabs:
+            self.add_new_tab()
+            return
+        current = 0
+        self.tab_widget.blockSignals(True)
+        self.tab_widget.setTabsClosable(False)  # 关闭按钮在全部加入后一次创建，否则每加一个都要重新排列已有的按钮
+        for index, saved in enumerate(saved_tabs):
+            self.tab_widget.addTab(TabPlaceholder(saved), saved.title)
+            number = saved.title.rpartition(" ")[2]
+            if number.isdigit():
+                self.tab_count = max(self.tab_count, int(number))
+            if saved.current:
+                current = index
+        self.tab_count = max(self.tab_count, len(saved_tabs))
+        self.tab_widget.setTabsClosable(True)
+        self.tab_widget.setCurrentIndex(current)
+        self.tab_widget.blockSignals(False)
+        self.materialize_tab(current)
+
+    # 切换到还没有创建的标签页时用 ChatTab 替换占位控件
+    @Slot(int)
+    def materialize_tab(self, index):
+        placeholder = self.tab_widget.widget(index)
+        if not isinstance(placeholder, TabPlaceholder):
+            return
+        chat_tab = self.create_tab(placeholder.saved.title, placeholder.saved)
+        self.tab_widget.blockSignals(True)
+        self.tab_widget.removeTab(index)
+        self.tab_widget.insertTab(index, chat_tab, placeholder.saved.title)
         self.tab_widget.setCurrentIndex(index)
+        self.tab_widget.blockSignals(False)
+        placeholder.deleteLater()
+
+    # 保存打开着的标签页，下次启动时恢复
+    def save_tabs(self):
+        tabs = []
+        for index in range(self.tab_widget.count()):
+            widget = self.tab_widget.widget(index)
+            title = self.tab_widget.tabText(index)
+            if isinstance(widget, TabPlaceholder):
+                tabs.append(dict(id=widget.saved.id, title=title))
+                continue
+            widget.chat_buffer.flush()
+            widget.transcript.persist()
+            tabs.append(dict(id=widget.tab_id, title=title, settings=widget.tab_settings(),
+                             journal=widget.journal.path if widget.journal is not None else None,
+                             history=widget.session.saved_history(), count=len(widget.transcript)))
+        session_store.save(tabs, self.tab_widget.currentIndex())
+
+    @Slot()
+    def show_search(self):
+        if self.search_panel is None:
+            self.search_panel = SearchPanel(search_index, parent=self)
+            self.search_panel.message_selected.connect(self.show_message)
+        self.search_panel.show_panel()
+
+    # 切换到标签页并滚动到这条消息
+    @Slot(object, int)
+    def show_message(self, tab_id, index):
+        for tab_index in range(self.tab_widget.count()):
+            widget = self.tab_widget.widget(tab_index)
+            widget_id = widget.saved.id if isinstance(widget, TabPlaceholder) else widget.tab_id
+            if widget_id == tab_id:
+                self.tab_widget.setCurrentIndex(tab_index)
+                chat_tab = self.tab_widget.widget(tab_index)
+                if index < len(chat_tab.transcript):
+                    chat_tab.chat_log.scroll_to_message(index)
+                self.show_normal()
+                self.activateWindow()
+                return
+        self.search_panel.status_label.setText("This tab has been closed.")
 
     def min_tab(self):
         self.new_window = QMainWindow()
         self.new_window.setWindowTitle(f"Widget")
 
         api_key = self.configuration.get_api_key()
-        self.chat_tab = MinTab(api_key)
+        current_tab = self.tab_widget.currentWidget()
+        self.chat_tab = MinTab(api_key, current_tab.model_path if current_tab and current_tab.model_ready else "",
+                               **self.configuration.get_clipboard_settings(),
+                               **self.configuration.get_render_settings(), search=search_index.source("Widget"))
         self.new_window.setCentralWidget(self.chat_tab)
         self.new_window.setFixedHeight(300)
         self.new_window.setFixedWidth(400)
@@ -88,14 +251,135 @@ class ChatWindow(QtWidgets.QWidget):
         # 最小化原始页
         self.showMinimized()
 
+    @Slot()
+    def update_queue_status(self):
+        usable, quarantined = key_pool.status()
+        text = f"Queue: {scheduler.queue_depth()} | Wait: {scheduler.average_wait():.1f}s | Keys: {usable}"
+        if quarantined:
+            text += f" ({quarantined} quarantined)"
+        self.queue_label.setText(text)
+        self.queue_label.setToolTip("\n".join(f"{name}: quarantined for {int(seconds)}s more ({reason})"
+                                              for name, seconds, reason in key_pool.quarantined()))
+
+    # 翻译一个文件：使用当前标签页的模型、目标语言和风格，进度保存在任务队列中，退出后可以继续
+    @Slot()
+    def translate_file(self):
+        source, _ = QFileDialog.getOpenFileName(self, "Translate File", "",
+                                                "Text Files (*.txt *.md *.jsonl *.srt)")
+        if not source:
+            return
+        current_tab = self.tab_widget.currentWidget()
+        language = current_tab.language_combobox.currentText()
+        target, _ = QFileDialog.getSaveFileName(self, "Save Translation", output_name(source, language))
+        if not target:
+            return
+        try:
+            params = current_tab.snapshot_params()
+            job_id = job_queue.add_file(source, target, language, current_tab.style_combobox.currentText(), params)
+        except (OSError, ValueError) as e:
+            QMessageBox.warning(self, "Translate File", f"Error: {str(e)}")
+            return
+        self.start_job(job_id)
+
+    # 在当前标签页中转写一个音频文件，或者直接翻译成英文
+    @Slot()
+    def transcribe_audio_file(self):
+        current_tab = self.tab_widget.currentWidget()
+        if current_tab is None or not current_tab.send_button.isEnabled():
+            QMessageBox.information(self, "Transcribe Audio", "Wait for the current request in this tab to finish.")
+            return
+        source, _ = QFileDialog.getOpenFileName(self, "Transcribe Audio", "",
+                                                f"Audio Files ({AUDIO_FILE_TYPES});;All Files (*)")
+        if not source:
+            return
+        dialog = QMessageBox(QMessageBox.Question, "Transcribe Audio", "Transcribe the audio, or translate it into "
+                             "English?", parent=self)
+        transcribe_button = dialog.addButton("Transcribe", QMessageBox.AcceptRole)
+        translate_button = dialog.addButton("Translate to English", QMessageBox.AcceptRole)
+        dialog.addButton(QMessageBox.Cancel)
+        dialog.exec()
+        if dialog.clickedButton() in (transcribe_button, translate_button):
+            current_tab.import_audio(source, translate=dialog.clickedButton() is translate_button)
+
+    def start_job(self, job_id):
+        if job_id in self.job_futures:
+            return
+        api_key = self.configuration.get_api_key()
+        future = engine.submit(job_queue.run(
+            job_id, api_key, on_progress=lambda progress: engine.dispatch(self.show_job_progress, job_id, progress)))
+        self.job_futures[job_id] = future
+        future.add_done_callback(lambda f: engine.dispatch(self.job_finished, job_id, f))
+        self.show_job_progress(job_id, job_queue.progress(job_id))
+
+    @Slot()
+    def warm_up_connections(self):
+        for key in key_pool.keys:
+            client_pool.warm_up_in_background(
+                key.key, key.base_url,
+                on_error=lambda e, name=key.name: engine.dispatch(self.show_warm_up_error, name, e))
+
+    # 预热失败只在当前标签页中提示一下，第一次请求时会重新连接
+    def show_warm_up_error(self, name, error):
+        current_tab = self.tab_widget.currentWidget()
+        if isinstance(current_tab, ChatTab):
+            current_tab.update_chat_log(f"Connection warm-up failed for API key {name}: {str(error)}", "notice")
+
+    @Slot()
+    def offer_resume_jobs(self):
+        jobs = job_queue.jobs(unfinished_only=True)
+        if not jobs:
+            return
+        names = "\n".join(f"{job.source} -> {job.target}" for job in jobs)
+        answer = QMessageBox.question(self, "Resume Translation",
+                                      f"{len(jobs)} file translation(s) did not finish:\n{names}\n\nResume them?")
+        if answer == QMessageBox.Yes:
+            for job in jobs:
+                self.start_job(job.id)
+
+    def show_job_progress(self, job_id, progress):
+        text = f"Job {job_id}: {progress.done}/{progress.total}"
+        if progress.failed:
+            text += f" ({progress.failed} failed)"
+        if progress.rate is not None:
+            minutes, seconds = divmod(int(progress.eta), 60)
+            text += f" | {progress.rate:.0f} tok/s | ETA {minutes}m{seconds:02d}s"
+        self.job_label.setText(text)
+
+    def job_finished(self, job_id, future):
+        self.job_futures.pop(job_id, None)
+        if future.cancelled():
+            return
+        job = job_queue.job(job_id)
+        if future.exception() is not None:
+            self.job_label.setText(f"Job {job_id}: Error: {str(future.exception())}")
+        elif job.status == DONE:
+            self.job_label.setText(f"Job {job_id}: saved to {job.target}")
+        else:
+            self.job_label.setText(f"Job {job_id}: {job.error}")
+
     # 在主窗口关闭时关闭所有已打开的窗口
     def closeEvent(self, event):
         if self.opened_windows:
             for window in self.opened_windows:
                 window.close()
             event.accept()
+        # 正在运行的文件翻译任务把进行中的单元记回 pending，下次启动时继续
+        for future in list(self.job_futures.values()):
+            future.cancel()
+        engine.stop()
+        self.bridge.flush()  # 被取消的回复在 finish_reply 中把已生成的部分记入历史，之后再保存
+        if session_store.enabled:
+            self.save_tabs()
+            session_store.close()
+        search_index.close()  # 写完还在队列中的索引
+        client_pool.close()
+        translation_cache.close()
+        job_queue.close()
+        journal_writer.close()  # 写完并 fsync 所有会话日志
 
     def eventFilter(self, obj, event):
+        if obj in self.opened_windows and event.type() == QtCore.QEvent.Close:
+            obj.centralWidget().cancel_requests()
         if obj == self.new_window and event.type() == QtCore.QEvent.Close:
             self.show_normal()
         return super().eventFilter(obj, event)
@@ -107,6 +391,23 @@ class ChatWindow(QtWidgets.QWidget):
 
     def close_tab(self, index):
         if self.tab_widget.count() > 1:
+            chat_tab = self.tab_widget.widget(index)
+            if isinstance(chat_tab, TabPlaceholder):
+                session_store.discard(chat_tab.saved.id)
+                if search_index.enabled:
+                    search_index.detach(chat_tab.saved.id)
+                self.tab_widget.removeTab(index)
+                return
+            chat_tab.cancel_requests()
+            chat_tab.cancel_model_loading()
+            chat_tab.release_model()
+            chat_tab.transcript.close()
+            if chat_tab.journal is not None:
+                chat_tab.journal.close()
+            if chat_tab.tab_id is not None:
+                session_store.discard(chat_tab.tab_id)
+            if chat_tab.transcript.search is not None:
+                chat_tab.transcript.search.detach()
             self.tab_widget.removeTab(index)
 
     def check_tab_count(self):
@@ -116,14 +417,17 @@ class ChatWindow(QtWidgets.QWidget):
     @Slot()
     def import_model(self):
         file_name, _ = QFileDialog.getOpenFileName(self, "Open .bin File", "", "BIN Files (*.bin)")
+        if not file_name:
+            return
         from typing import cast
         current_tab = cast(ChatTab, self.tab_widget.currentWidget())
-        current_tab.model_path=file_name
+        current_tab.load_model(file_name)
 
     
     def deco_ui(self):
         self.setStyleSheet("background-color: white;")
         self.copyright.setStyleSheet("background-color: white;")
+        self.queue_label.setStyleSheet("color: grey;")
         self.tab_widget.setStyleSheet("""
             QTabBar::tab {
                 background: #e1f4ff;
@@ -182,6 +486,10 @@ class ChatWindow(QtWidgets.QWidget):
             }
         """)
 
+        self.translate_file_button.setStyleSheet(self.import_button.styleSheet())
+        self.transcribe_file_button.setStyleSheet(self.import_button.styleSheet())
+        self.search_button.setStyleSheet(self.import_button.styleSheet())
+
         self.new_tab_button.setStyleSheet("""
             QPushButton {
                 background-color: qlineargradient(x1: 0, y1: 0, x2: 0, y2: 1,
@@ -1,20 +1,46 @@
 from PySide6.QtCore import QCoreApplication
 from PySide6.QtGui import QIcon
-import threading
 
-import chatglm_cpp
 from PySide6 import QtWidgets
 from PySide6.QtCore import Signal
 from PySide6.QtCore import Slot, QTimer
-from PySide6.QtGui import QClipboard
-from openai import OpenAI
+
+from hedging import hedge_router
+from prompts import build_translation_prompt
+from qt_bridge import render_scheduler
+from render_buffer import RenderBuffer
+from request_engine import RequestParams, engine
+from scheduler import PRIORITY_BACKGROUND
+from transcript import Transcript
+from transcript_view import CHAT_STYLES, TranscriptView
+from translation_cache import cache_model_name, translation_cache
+
+# 悬浮窗中的译文不加前缀
+MIN_TAB_STYLES = dict(CHAT_STYLES, translation=("", "blue", False))
+
+# 过滤不适合翻译的剪贴板内容：过长的文本和看起来像二进制数据的内容
+def is_translatable_text(text, max_chars):
+    if not text.strip() or len(text) > max_chars:
+        return False
+    if "\x00" in text:
+        return False
+    control = sum(1 for ch in text if (ord(ch) < 32 and ch not in "\t\r\n") or ch == "\ufffd")
+    return control <= len(text) * 0.05
+
 
 class MinTab(QtWidgets.QWidget):
     update_chat_log_signal = Signal(str, str)  # 传递聊天信息更新的信号，包括内容和发送者
-    def __init__(self,api_key):
+    def __init__(self, api_key, model_path="", debounce_ms=400, max_chars=5000, render_fps=30, render_backlog=65536,
+                 transcript_messages=500, search=None):
         super().__init__()
+        # 流式译文先进入缓冲，按帧率合并后一次写入；片段的类型带上 request_id，过期的片段渲染时丢弃
+        self.chat_buffer = RenderBuffer(self.render_translation, render_fps, render_backlog)
+        self.chat_buffer.scheduler = render_scheduler(self)
+        self.model_path = model_path
+        self.max_chars = max_chars
         self.language = None
-        self.message_thread=None
+        self.request_future = None  # 正在请求引擎中运行的翻译任务
+        self.request_id = 0         # 每次翻译加一，用来丢弃已被取消的翻译迟到的结果
         self.setObjectName("MinTab")
         self.setGeometry(10, 10, 400, 300)
         self.setMinimumSize(400, 300)
@@ -22,19 +48,22 @@ class MinTab(QtWidgets.QWidget):
         self.setStyleSheet("background-color: white;")
         self.api_key = api_key
 
-        self.chat_log = QtWidgets.QPlainTextEdit(self)
+        self.transcript = Transcript(transcript_messages, search=search)  # 译文也进入全文索引
+        self.chat_log = TranscriptView(self.transcript, MIN_TAB_STYLES, self)
         self.chat_log.setObjectName("plainTextEdit")
-        self.chat_log.setReadOnly(True)
 
         # 获取剪贴板实例
-        self.clipboard = QClipboard()
+        self.clipboard = QtWidgets.QApplication.clipboard()
         # 上一次剪贴板内容
         self.last_clipboard_text = ""
 
-        # 使用定时器实时监测剪贴板内容
-        self.timer = QTimer(self)
-        self.timer.timeout.connect(self.check_clipboard)
-        self.timer.start(100)  # 设置定时器间隔（毫秒）
+        # 剪贴板内容变化时触发，连续复制只在停止变化 debounce_ms 毫秒后翻译一次
+        self.debounce_timer = QTimer(self)
+        self.debounce_timer.setSingleShot(True)
+        self.debounce_timer.setInterval(debounce_ms)
+        self.debounce_timer.timeout.connect(self.check_clipboard)
+        self.clipboard.dataChanged.connect(self.debounce_timer.start)
+        self.debounce_timer.start()  # 打开窗口时翻译当前剪贴板中的内容
 
 
         self.comboBox = QtWidgets.QComboBox(self)
@@ -50,6 +79,9 @@ class MinTab(QtWidgets.QWidget):
         self.restart_button = QtWidgets.QPushButton(self)
         self.restart_button.setObjectName("pushButton_2")
 
+        self.stop_button = QtWidgets.QPushButton(self)
+        self.stop_button.setObjectName("pushButton_3")
+
         self.label_2 = QtWidgets.QLabel(self)
         self.label_2.setObjectName("label_2")
 
@@ -66,27 +98,39 @@ class MinTab(QtWidgets.QWidget):
         self.gridLayout.addWidget(self.chat_log, 0, 0, 1, 2)
         self.gridLayout.addWidget(self.comboBox, 2, 0, 1, 1)
         self.gridLayout.addWidget(self.label, 1, 0, 1, 1)
-        self.gridLayout.addWidget(self.restart_button, 3, 0, 1, 2)
+        self.gridLayout.addWidget(self.restart_button, 3, 0, 1, 1)
+        self.gridLayout.addWidget(self.stop_button, 3, 1, 1, 1)
         self.gridLayout.addWidget(self.label_2, 1, 1, 1, 1)
         self.gridLayout.addWidget(self.comboBox_1, 2, 1, 1, 1)
 
         self.label.setText(QCoreApplication.translate("Form", u"Target Language：", None))
         self.restart_button.setText(QCoreApplication.translate("Form", u"Restart", None))
+        self.stop_button.setText(QCoreApplication.translate("Form", u"Stop", None))
         self.label_2.setText(QCoreApplication.translate("Form", u"Selected Model:", None))
 
         self.demo_ui()
 
         self.update_chat_log_signal.connect(self.update_chat_log)
         self.restart_button.clicked.connect(self.clear)
+        self.stop_button.clicked.connect(self.stop)
 
     @Slot()
     def check_clipboard(self):
-        clipboard_text = self.clipboard.text()
-        if clipboard_text != self.last_clipboard_text:
-            # 如果剪贴板中的文本与上一次不同，执行翻译
-            self.chat_log.clear()
-            self.translate(clipboard_text)
-            self.last_clipboard_text = clipboard_text
+        mime_data = self.clipboard.mimeData()
+        if mime_data is None or not mime_data.hasText():
+            return  # 图片、文件等非文本内容
+        clipboard_text = mime_data.text()
+        if clipboard_text.strip() == self.last_clipboard_text.strip():
+            return
+        self.last_clipboard_text = clipboard_text
+        if not is_translatable_text(clipboard_text, self.max_chars):
+            return
+        # 如果剪贴板中的文本与上一次不同，取消上一次还没完成的翻译，再执行翻译
+        self.cancel_requests()
+        self.chat_buffer.clear()
+        self.transcript.clear()
+        self.chat_log.refresh()
+        self.translate(clipboard_text)
 
     # 翻译功能
     @Slot()
@@ -96,99 +140,78 @@ class MinTab(QtWidgets.QWidget):
         if not message:
             return  # 如果没有输入，返回
         selected_language = self.language
-        request = f"Please translate the following sentence to {selected_language},give me translation outcome without anything else: {message}"
+        request = build_translation_prompt(message, selected_language)
         #self.update_chat_log_signal.emit(message, "user")
 
-        try:
-            if self.selected_api == "local model":
-                self.message_thread = threading.Thread(target=self.local_translate_message, args=(request,))
-            else:
-                self.message_thread = threading.Thread(target=self.translate_message, args=(request,))
-            self.message_thread.start()
-        except Exception as e:
-            print(f"Exception in translate: {str(e)}")
-
-    # 调用api让gpt翻译
-    def translate_message(self, message):
-        try:
-            user_message = {"role": "user", "content": message}
-
-            client = OpenAI(api_key=self.api_key)
-            response = client.chat.completions.create(
-                model=self.selected_api,
-                messages=[user_message],  # Use the conversation history
-                stream=True
-            )
-
-            self.update_chat_log_signal.emit("", "gpt-start-translation")
-            for chunk in response:  # 遍历数据流的事件
-                chunk_message = chunk.choices[0].delta.content  # 提取消息
-                if chunk_message is not None:
-                    self.update_chat_log_signal.emit(chunk_message, "gpt-translation")
-            self.update_chat_log_signal.emit("", "gpt-end-translation")
+        self.request_id += 1
+        params = RequestParams(model=self.selected_api, api_key=self.api_key, model_path=self.model_path)
+        cache_key = (message, selected_language, "Normal", cache_model_name(params))
+        self.request_future = engine.submit(self.translate_message(params, request, cache_key, self.request_id))
 
+    # 取消正在进行的翻译(窗口关闭时)
+    def cancel_requests(self):
+        if self.request_future is not None:
+            self.request_future.cancel()
+            self.request_future = None
 
-        except Exception as e:
-            error_msg = f"Error: {str(e)}"
-            # Emit the signal to update the chat log with the error message
-            self.update_chat_log_signal.emit(error_msg, "error")
-
-    # 让部署在本地的ChatGLM-3 模型翻译
-    def local_translate_message(self, message, max_length=2048, max_context_length=512, top_k=0, top_p=0.7, temp=0.95,
-                                repeat_penalty=1.0):
+    # 停止正在生成的翻译，已经显示的部分保留
+    @Slot()
+    def stop(self):
+        if self.request_future is not None and not self.request_future.done():
+            self.cancel_requests()
+            self.request_id += 1  # 丢弃停止前已经发出、还没显示的片段
+            self.update_chat_log("", "gpt-end-translation")
+
+    # 让gpt或部署在本地的ChatGLM-3 模型翻译；开启对冲时由路由器在多个后端之间选择先返回的一个
+    # 每次剪贴板变化都会查缓存，查询在线程池中进行，不占用GUI线程；命中时直接显示，不再请求模型
+    async def translate_message(self, params, message, cache_key, request_id):
         try:
-            pipeline = chatglm_cpp.Pipeline(self.model_path)
-            # 2. 定义生成参数
-            generation_kwargs = dict(
-                max_length=max_length,
-                max_context_length=max_context_length,
-                do_sample=temp > 0,
-                top_k=top_k,
-                top_p=top_p,
-                temperature=temp,
-                repetition_penalty=repeat_penalty,
-                stream=True,
-            )
-
-            self.update_chat_log_signal.emit("", "gpt-start-translation")
-            for response_text in pipeline.chat([message], **generation_kwargs):
-                self.update_chat_log_signal.emit(response_text, "gpt")
-            self.update_chat_log_signal.emit("", "gpt-end-translation")
+            cached = await engine.run_blocking(translation_cache.get, *cache_key)
+            if cached is not None:
+                self.chat_buffer.push((request_id, "gpt-end-translation"), cached)
+                return
+
+            translation = ""
+            backend = params
+            self.chat_buffer.push((request_id, "gpt-start-translation"), "")
+            # 剪贴板翻译是后台请求，排在标签页中用户主动发送的请求之后
+            async for backend, chunk_message in hedge_router.stream(params, message, priority=PRIORITY_BACKGROUND,
+                                                                    owner=self):
+                translation += chunk_message
+                await self.chat_buffer.put((request_id, "gpt-translation"), chunk_message)
+            self.chat_buffer.push((request_id, "gpt-end-translation"), "")
+            # 缓存记在实际回答的模型名下
+            await engine.run_blocking(translation_cache.put, *cache_key[:3], cache_model_name(backend), translation)
 
         except Exception as e:
             error_msg = f"Error: {str(e)}"
             # Emit the signal to update the chat log with the error message
-            self.update_chat_log_signal.emit(error_msg, "error")
+            self.chat_buffer.push((request_id, "error"), error_msg)
 
+    # 只显示最新一次翻译的结果
+    def render_translation(self, items):
+        for (request_id, message_type), message in items:
+            if request_id == self.request_id:
+                self.transcript.write(message_type, message)
+        self.chat_log.refresh()
 
     # 清空聊天记录
     @Slot()
     def clear(self):
-        self.chat_log.clear()
+        self.chat_buffer.clear()
+        self.transcript.clear()
+        self.chat_log.refresh()
 
     # 更新聊天记录并设置外观颜色
     @Slot(str, str)
     def update_chat_log(self, message, message_type):
-        response_cursor = self.chat_log.textCursor()
-        if message_type == "user":
-            response_cursor.insertHtml("<span style='color: black; font-style: italic;'>You: </span>")
-            response_cursor.insertText(f"{message}\n\n")
-        elif message_type == "gpt-start-translation":
-            response_cursor.insertHtml("<span style='color: blue;'> </span>")
-            response_cursor.insertText(f"{message}")
-        elif message_type == "gpt-translation":
-            response_cursor.insertHtml("<span style='color: blue;'> </span>")
-            response_cursor.insertText(f"{message}")
-        elif message_type == "gpt-end-translation":
-            response_cursor.insertHtml("<span style='color: blue;'> </span>")
-            response_cursor.insertText(f"{message}\n\n")
-        elif message_type == "error":
-            response_cursor.insertHtml("<span style='color: red;'>ERROR: </span>")
-            response_cursor.insertText(f"{message}\n\n")
+        self.chat_buffer.flush()
+        self.transcript.write(message_type, message)
+        self.chat_log.refresh()
 
     def demo_ui(self):
         self.chat_log.setStyleSheet("""
-                    QPlainTextEdit {
+                    TranscriptView {
                         padding: 8px 15px;
                         background-color: #ffffff;
                         border: 1px solid #1f618d;
@@ -254,6 +277,7 @@ class MinTab(QtWidgets.QWidget):
                         border-style: inset;
                     }
                 """)
+        self.stop_button.setStyleSheet(self.restart_button.styleSheet())
 
         self.comboBox_1.setStyleSheet("""
                     QComboBox {
@@ -1,5 +1,4 @@
 import configparser
-from PySide6 import QtWidgets
 import sys
 
 
@@ -17,6 +16,8 @@ class Configuration:
         return api_key
 
     def prompt_for_api_key(self):
+        from PySide6 import QtWidgets  # 只有需要输入密钥时才用到界面，脚本导入配置时不加载Qt
+
         api_key, ok = QtWidgets.QInputDialog.getText(
             None,
             "OpenAI API Key",
@@ -31,3 +32,183 @@ class Configuration:
         self.config["API"] = {"key": api_key}
         with open("config.ini", "w") as configfile:
             self.config.write(configfile)
+
+    # 本地模型可占用的内存预算(MB)，0表示不限制
+    def get_model_ram_budget(self):
+        return self.config.getint("LocalModel", "ram_budget_mb", fallback=0) * 1024 * 1024
+
+    # 网络设置：代理、超时和连接池大小
+    def get_network_settings(self):
+        proxy = self.config.get("Network", "proxy", fallback="").strip()
+        if proxy and "://" not in proxy:
+            proxy = f"http://{proxy}"
+        return dict(
+            proxy=proxy,
+            timeout=self.config.getfloat("Network", "timeout", fallback=60.0),
+            connect_timeout=self.config.getfloat("Network", "connect_timeout", fallback=10.0),
+            max_connections=self.config.getint("Network", "max_connections", fallback=20),
+            max_keepalive_connections=self.config.getint("Network", "max_keepalive_connections", fallback=10),
+            keepalive_expiry=self.config.getfloat("Network", "keepalive_expiry", fallback=120.0),
+        )
+
+    def get_warm_up(self):
+        return self.config.getboolean("Network", "warm_up", fallback=True)
+
+    # 同时进行的模型请求数上限
+    def get_max_concurrency(self):
+        return self.config.getint("Engine", "max_concurrency", fallback=4)
+
+    # 翻译缓存的位置、容量和过期时间
+    def get_cache_settings(self):
+        return dict(
+            path=self.config.get("Cache", "path", fallback="cache/translations.db"),
+            memory_entries=self.config.getint("Cache", "memory_entries", fallback=512),
+            max_bytes=self.config.getint("Cache", "max_size_mb", fallback=64) * 1024 * 1024,
+            max_age_days=self.config.getfloat("Cache", "max_age_days", fallback=30),
+            enabled=self.config.getboolean("Cache", "enabled", fallback=True),
+        )
+
+    # 小窗口监听剪贴板的防抖间隔和可翻译文本的最大长度
+    def get_clipboard_settings(self):
+        return dict(
+            debounce_ms=self.config.getint("Clipboard", "debounce_ms", fallback=400),
+            max_chars=self.config.getint("Clipboard", "max_chars", fallback=5000),
+        )
+
+    # 翻译请求的对冲和熔断设置
+    def get_hedging_settings(self):
+        backends = self.config.get("Hedging", "backends", fallback="gpt-3.5-turbo, gpt-4, local model")
+        return dict(
+            enabled=self.config.getboolean("Hedging", "enabled", fallback=False),
+            percentile=self.config.getfloat("Hedging", "percentile", fallback=95),
+            default_delay=self.config.getint("Hedging", "default_delay_ms", fallback=2000) / 1000,
+            min_delay=self.config.getint("Hedging", "min_delay_ms", fallback=300) / 1000,
+            max_delay=self.config.getint("Hedging", "max_delay_ms", fallback=8000) / 1000,
+            backends=[backend.strip() for backend in backends.split(",") if backend.strip()],
+            failure_threshold=self.config.getint("Hedging", "failure_threshold", fallback=3),
+            reset_timeout=self.config.getfloat("Hedging", "reset_timeout", fallback=30),
+        )
+
+    # 各模型每分钟的请求数和token数上限(0表示不限制)，以及遇到429时的重试次数和退避时间
+    def get_rate_limit_settings(self):
+        limits = {}
+        if self.config.has_section("RateLimits"):
+            for model, value in self.config.items("RateLimits"):
+                rpm, _, tpm = value.partition(",")
+                limits[model] = (int(rpm.strip() or 0), int(tpm.strip() or 0))
+        return dict(
+            limits=limits,
+            max_retries=self.config.getint("Engine", "rate_limit_retries", fallback=4),
+            backoff_base=self.config.getfloat("Engine", "backoff_base", fallback=1.0),
+            backoff_max=self.config.getfloat("Engine", "backoff_max", fallback=30.0),
+        )
+
+    # 密钥池：[API] 中的密钥和所有名字以 "API " 开头的节，每个密钥可以有自己的接口地址和每分钟限额
+    # api_key 不为空时代替 [API] 中的密钥(命令行中不弹出输入框)
+    def get_key_pool_settings(self, api_key=None):
+        keys = []
+        for section in ["API"] + [name for name in self.config.sections() if name.startswith("API ")]:
+            if section == "API":
+                key = api_key or self.get_api_key()
+            else:
+                key = self.config.get(section, "key", fallback="")
+            keys.append(dict(
+                name=section[4:] or "default",
+                key=key.strip(),
+                base_url=self.config.get(section, "base_url", fallback="").strip(),
+                rpm=self.config.getint(section, "rpm", fallback=0),
+                tpm=self.config.getint(section, "tpm", fallback=0),
+            ))
+        return dict(
+            keys=keys,
+            quarantine_seconds=self.config.getfloat("Engine", "key_quarantine_seconds", fallback=600),
+        )
+
+    # 长文本分段翻译：每段的token数上限和同时翻译的段数
+    def get_document_settings(self):
+        return dict(
+            document_concurrency=self.config.getint("Translation", "document_concurrency", fallback=4),
+            segment_tokens=self.config.getint("Translation", "segment_tokens", fallback=800),
+        )
+
+    # 流式回复的渲染帧率、最多积压的字符数(超过后放慢生成端)和聊天记录在内存中保留的消息数
+    def get_render_settings(self):
+        return dict(
+            render_fps=self.config.getint("Display", "fps", fallback=30),
+            render_backlog=self.config.getint("Display", "max_backlog_chars", fallback=65536),
+            transcript_messages=self.config.getint("Display", "messages_in_memory", fallback=500),
+        )
+
+    # 会话日志：存放的目录、单个文件的大小上限(超过后换新文件)、换下来的文件是否压缩和 fsync 的间隔
+    def get_journal_settings(self):
+        return dict(
+            folder=self.config.get("Journal", "folder", fallback="cache/sessions"),
+            enabled=self.config.getboolean("Journal", "enabled", fallback=True),
+            max_bytes=self.config.getint("Journal", "max_file_mb", fallback=16) * 1024 * 1024,
+            compress=self.config.getboolean("Journal", "compress", fallback=False),
+            fsync_interval=self.config.getfloat("Journal", "fsync_interval", fallback=1.0),
+        )
+
+    # 退出时保存打开的标签页(设置、对话历史和聊天记录)，下次启动时恢复
+    def get_session_settings(self):
+        return dict(
+            path=self.config.get("Session", "path", fallback="cache/tabs.db"),
+            enabled=self.config.getboolean("Session", "restore", fallback=True),
+        )
+
+    # 录音：采样率、环形缓冲的秒数、录音留在内存中的上限、是否另存每次的录音，以及上传前去掉静音和压缩的设置
+    def get_audio_settings(self):
+        keep = self.config.getboolean("Audio", "keep_recordings", fallback=False)
+        trim = self.config.getboolean("Audio", "trim_silence", fallback=True)
+        compress = self.config.get("Audio", "compress", fallback="none").strip().lower()
+        return dict(
+            rate=self.config.getint("Audio", "sample_rate", fallback=10000),
+            ring_seconds=self.config.getint("Audio", "ring_seconds", fallback=10),
+            max_memory=self.config.getint("Audio", "memory_mb", fallback=8) * 1024 * 1024,
+            keep_folder=self.config.get("Audio", "folder", fallback="records") if keep else None,
+            trim=self.get_voice_activity_settings() if trim else None,
+            compress=compress if compress != "none" else None,
+            min_segment=self.config.getfloat("Audio", "min_segment", fallback=3.0),
+            max_segment=self.config.getfloat("Audio", "max_segment", fallback=30.0),
+        )
+
+    # 导入音频文件：每段的长度、相邻两段重叠的秒数，以及最多同时转写的段数
+    def get_audio_file_settings(self):
+        overlap = self.config.getfloat("Audio", "file_overlap", fallback=2.0)
+        return dict(
+            chunk_seconds=max(overlap + 20, self.config.getfloat("Audio", "file_chunk_seconds", fallback=120.0)),
+            overlap=overlap,
+            concurrency=max(1, self.config.getint("Audio", "file_concurrency", fallback=3)),
+        )
+
+    # 边录边转写：是否开启，以及最多同时转写的段数
+    def get_live_transcription_settings(self):
+        return dict(
+            enabled=self.config.getboolean("Audio", "live", fallback=False),
+            concurrency=max(1, self.config.getint("Audio", "live_concurrency", fallback=3)),
+        )
+
+    # 判断有没有说话的阈值，见 voice_activity.VoiceActivityDetector
+    def get_voice_activity_settings(self):
+        return dict(
+            max_silence=self.config.getfloat("Audio", "max_silence", fallback=0.6),
+            frame_ms=self.config.getint("Audio", "frame_ms", fallback=30),
+            energy_db=self.config.getfloat("Audio", "energy_db", fallback=-45.0),
+            margin_db=self.config.getfloat("Audio", "margin_db", fallback=12.0),
+            zcr_threshold=self.config.getfloat("Audio", "zcr_threshold", fallback=0.3),
+        )
+
+    # 全部聊天和翻译记录的全文索引
+    def get_search_settings(self):
+        return dict(
+            path=self.config.get("Search", "path", fallback="cache/search.db"),
+            enabled=self.config.getboolean("Search", "enabled", fallback=True),
+            candidates=self.config.getint("Search", "rank_candidates", fallback=1000),
+        )
+
+    # 持久化翻译任务队列的数据库和每个任务同时翻译的单元数
+    def get_job_settings(self):
+        return dict(
+            path=self.config.get("Jobs", "path", fallback="cache/jobs.db"),
+            concurrency=self.config.getint("Jobs", "concurrency", fallback=4),
+        )
@@ -0,0 +1,87 @@
+# 各模型的上下文长度(token)，请求的提示词预算 = 上下文长度 - 回复的最大token数
+CONTEXT_LIMITS = {
+    "gpt-3.5-turbo": 16385,
+    "gpt-4": 8192,
+}
+DEFAULT_CONTEXT_LIMIT = 4096
+MESSAGE_OVERHEAD = 4  # 每条消息的角色、分隔符等格式开销
+
+
+# 粗略估算文本的token数：中日韩字符约1个token一个字，其它文字约4个字符一个token
+def estimate_tokens(text):
+    wide = sum(1 for ch in text if ord(ch) >= 0x2E80)
+    return wide + (len(text) - wide + 3) // 4
+
+
+def estimate_message_tokens(message):
+    if isinstance(message, dict):
+        message = message.get("content") or ""
+    return estimate_tokens(message) + MESSAGE_OVERHEAD
+
+
+def prompt_budget(model, max_tokens):
+    return max(CONTEXT_LIMITS.get(model, DEFAULT_CONTEXT_LIMIT) - max_tokens, 0)
+
+
+# 有token预算的对话历史
+# 每条消息在加入时估算一次token数，并维护窗口内的累计值，发送前不需要重新扫描全部历史
+# 超出预算时从最早的消息开始丢弃，一次降到预算的 low_water 比例以下，
+# 这样窗口起点在之后几轮内保持不变，本地模型的前缀缓存也能继续复用
+class ContextWindow:
+    def __init__(self, low_water=0.75):
+        self.low_water = low_water
+        self.messages = []
+        self.token_counts = []
+        self.pinned = []
+        self.start = 0               # 窗口内第一条消息的下标
+        self.window_tokens = 0       # 窗口内所有消息的token数
+        self.pinned_tokens = 0       # 窗口之前被固定保留的消息的token数
+        self.dropped_messages = 0    # 已被移出窗口的消息数
+        self.dropped_tokens = 0
+
+    def __len__(self):
+        return len(self.messages)
+
+    def __iter__(self):
+        return iter(self.messages)
+
+    def __getitem__(self, index):
+        return self.messages[index]
+
+    # 加入一条消息，pinned=True 的消息不会因预算被丢弃(例如系统提示词)
+    # tokens 为已知的token数(恢复保存的历史时)，不再重新估算
+    def append(self, message, pinned=False, tokens=None):
+        if tokens is None:
+            tokens = estimate_message_tokens(message)
+        self.messages.append(message)
+        self.token_counts.append(tokens)
+        self.pinned.append(pinned)
+        self.window_tokens += tokens
+
+    def clear(self):
+        self.__init__(self.low_water)
+
+    @property
+    def total_tokens(self):
+        return self.pinned_tokens + self.window_tokens
+
+    # 选出要发送的消息：固定的消息加上预算内最新的消息，最新一条总是保留
+    # align=2 时窗口起点总是落在偶数下标上，保证本地模型的历史以用户消息开头
+    def select(self, budget, align=1):
+        if self.total_tokens > budget:
+            target = budget * self.low_water
+            last = len(self.messages) - 1
+            while self.start < last and (self.total_tokens > target or self.start % align):
+                self._advance()
+        kept_pinned = [m for m, p in zip(self.messages[:self.start], self.pinned) if p]
+        return kept_pinned + self.messages[self.start:]
+
+    def _advance(self):
+        tokens = self.token_counts[self.start]
+        self.window_tokens -= tokens
+        if self.pinned[self.start]:
+            self.pinned_tokens += tokens
+        else:
+            self.dropped_messages += 1
+            self.dropped_tokens += tokens
+        self.start += 1
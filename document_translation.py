@@ -0,0 +1,65 @@
+import asyncio
+
+from hedging import hedge_router
+from prompts import build_translation_prompt
+from request_engine import engine
+from scheduler import PRIORITY_INTERACTIVE
+from segmenter import split_segments
+from translation_cache import cache_model_name, translation_cache
+
+_END = object()
+
+
+# 分段并行翻译长文本，按原文顺序逐段产出 (段号, 译文片段)
+# 最多 concurrency 段同时翻译；排在最前面、还没完成的一段边生成边产出，后面已经在翻译的段先缓冲，
+# 轮到它们时再一次性产出。每段的译文单独写入翻译缓存。某一段出错时抛出异常，其余的段被取消
+async def stream_document_translation(params, text, language, style="Normal", concurrency=4, segment_tokens=800,
+                                      bypass_cache=False, priority=PRIORITY_INTERACTIVE, owner=None):
+    segments = split_segments(text, segment_tokens)
+    queues = [asyncio.Queue() for _ in segments]
+    semaphore = asyncio.Semaphore(concurrency)
+    tasks = [asyncio.ensure_future(_translate_segment(params, segment.text, language, style, queue, semaphore,
+                                                      bypass_cache, priority, owner))
+             for segment, queue in zip(segments, queues)]
+    try:
+        for index, (segment, queue) in enumerate(zip(segments, queues)):
+            while True:
+                chunk = await queue.get()
+                if chunk is _END:
+                    break
+                yield index, chunk
+            await tasks[index]  # 这一段出错时在这里抛出
+            yield index, segment.separator
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def _translate_segment(params, text, language, style, queue, semaphore, bypass_cache, priority, owner):
+    try:
+        cache_key = (text, language, style, cache_model_name(params))
+        cached = None if bypass_cache else await engine.run_blocking(translation_cache.get, *cache_key)
+        if cached is not None:
+            queue.put_nowait(cached)
+            return
+        async with semaphore:
+            translation = ""
+            backend = params
+            prompt = build_translation_prompt(text, language, style)
+            async for backend, chunk in hedge_router.stream(params, prompt, priority=priority, owner=owner):
+                translation += chunk
+                queue.put_nowait(chunk)
+            await engine.run_blocking(translation_cache.put, *cache_key[:3], cache_model_name(backend), translation)
+    finally:
+        queue.put_nowait(_END)
+
+
+# 翻译一段文本，返回完整的译文；长文本同样分段翻译
+async def translate_text(params, text, language, style="Normal", concurrency=1, segment_tokens=800,
+                         bypass_cache=False, priority=PRIORITY_INTERACTIVE, owner=None):
+    chunks = []
+    async for _, chunk in stream_document_translation(params, text, language, style, concurrency, segment_tokens,
+                                                      bypass_cache, priority, owner):
+        chunks.append(chunk)
+    return "".join(chunks).rstrip()
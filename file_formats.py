@@ -0,0 +1,137 @@
+import json
+import os
+import tempfile
+from collections import namedtuple
+from contextlib import contextmanager
+
+from segmenter import split_segments
+
+SUPPORTED_EXTENSIONS = (".txt", ".md", ".jsonl", ".srt")
+
+# 翻译单元：text 为要翻译的文本(None 表示原样输出)，kind 和 data 决定译文怎样写回输出文件
+# 单元只包含普通数据，可以存进任务队列的数据库，重启后照样能渲染
+Unit = namedtuple("Unit", ["text", "kind", "data"])
+
+
+# 逐个读出文件中的翻译单元，不把整个文件读进内存
+def read_units(path, field="text", output_field="translation"):
+    ext = os.path.splitext(path)[1].lower()
+    with open(path, encoding="utf-8") as file:
+        if ext == ".jsonl":
+            yield from _jsonl_units(file, field, output_field)
+        elif ext == ".srt":
+            yield from _srt_units(file)
+        else:
+            yield from _paragraph_units(file, markdown=ext == ".md")
+
+
+# 把一段文本按段落和句子切成翻译单元(GUI中输入的长文本)
+def text_units(text, segment_tokens=800):
+    for segment in split_segments(text, segment_tokens):
+        yield Unit(segment.text, "text", segment.separator)
+
+
+# 默认的输出文件名：notes.md -> notes.Chinese.md
+def output_name(path, language):
+    root, ext = os.path.splitext(path)
+    return f"{root}.{language}{ext}"
+
+
+# 把译文按单元的类型写成输出内容
+def render_unit(unit, translation):
+    kind, data = unit.kind, unit.data
+    if kind == "raw":
+        return data
+    if kind == "text":
+        return translation + data
+    if kind == "json-string":
+        return json.dumps(translation, ensure_ascii=False) + "\n"
+    if kind == "json-record":
+        return json.dumps(dict(data["record"], **{data["field"]: translation}), ensure_ascii=False) + "\n"
+    if kind == "srt":
+        return data + translation.strip() + "\n\n"
+    raise ValueError(f"Unknown unit kind: {kind}")
+
+
+# 原子地写出文件：先写入同一目录下的临时文件，正常退出时再替换目标文件；出错时目标文件保持原样
+@contextmanager
+def atomic_writer(target):
+    folder = os.path.dirname(os.path.abspath(target))
+    os.makedirs(folder, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=folder, prefix=".translating-", suffix=os.path.splitext(target)[1])
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as out:
+            yield out
+        os.replace(temp_path, target)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+# 按空行分段；Markdown 中的代码块原样保留
+def _paragraph_units(lines, markdown=False):
+    paragraph = []
+    in_code = False
+    for line in lines:
+        if markdown and line.lstrip().startswith(("```", "~~~")):
+            if paragraph and not in_code:
+                yield _paragraph_unit(paragraph)
+                paragraph = []
+            in_code = not in_code
+            yield Unit(None, "raw", line)
+        elif in_code:
+            yield Unit(None, "raw", line)
+        elif not line.strip():
+            if paragraph:
+                yield _paragraph_unit(paragraph)
+                paragraph = []
+            yield Unit(None, "raw", line)
+        else:
+            paragraph.append(line)
+    if paragraph:
+        yield _paragraph_unit(paragraph)
+
+
+def _paragraph_unit(paragraph):
+    text = "".join(paragraph)
+    body = text.rstrip("\n")
+    return Unit(body, "text", text[len(body):])
+
+
+def _jsonl_units(lines, field, output_field):
+    for line in lines:
+        if not line.strip():
+            yield Unit(None, "raw", line)
+            continue
+        record = json.loads(line)
+        if isinstance(record, str):
+            yield Unit(record, "json-string", None)
+        elif isinstance(record, dict) and isinstance(record.get(field), str) and record[field].strip():
+            yield Unit(record[field], "json-record", {"record": record, "field": output_field})
+        else:
+            yield Unit(None, "raw", json.dumps(record, ensure_ascii=False) + "\n")
+
+
+# 字幕：序号和时间轴原样保留，只翻译字幕文本
+def _srt_units(lines):
+    cue = []
+    for line in lines:
+        if line.strip():
+            cue.append(line.rstrip("\r\n"))
+            continue
+        if cue:
+            yield _srt_unit(cue)
+            cue = []
+    if cue:
+        yield _srt_unit(cue)
+
+
+def _srt_unit(cue):
+    timing = next((i for i, line in enumerate(cue) if "-->" in line), None)
+    if timing is None:
+        return Unit(None, "raw", "\n".join(cue) + "\n\n")
+    header = "\n".join(cue[:timing + 1]) + "\n"
+    text = "\n".join(cue[timing + 1:])
+    if not text.strip():
+        return Unit(None, "raw", header + "\n")
+    return Unit(text, "srt", header)
@@ -0,0 +1,300 @@
+import asyncio
+import threading
+import time
+from collections import deque
+
+from local_session import LOCAL_CONTEXT_LENGTH, stream_local_reply
+from model_registry import registry
+from openai_client import create_chat_completion, stream_text
+from request_engine import engine
+from scheduler import PRIORITY_INTERACTIVE, request_tokens, scheduler
+
+# 本地模型翻译时使用的生成参数；temperature 和回复长度在 local_generation_kwargs 中按请求参数设置
+LOCAL_TRANSLATION_KWARGS = dict(
+    max_length=2048,
+    max_context_length=LOCAL_CONTEXT_LENGTH,
+    top_k=0,
+    top_p=0.7,
+    repetition_penalty=1.0,
+)
+
+_EMPTY = object()
+
+
+# 每个后端一个熔断器：连续失败 failure_threshold 次后断开，reset_timeout 秒后放行一次试探请求，
+# 试探成功则恢复，失败则重新断开
+class CircuitBreaker:
+    def __init__(self, failure_threshold=3, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state(time.monotonic())
+
+    # 是否可以向这个后端发请求；半开状态下只放行一个试探请求
+    def allow(self):
+        with self._lock:
+            state = self._state(time.monotonic())
+            if state == "closed":
+                return True
+            if state == "half-open" and not self.trial_running:
+                self.trial_running = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self.trial_running = False
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+    # 请求被取消(例如对冲中落败)时不计入成败，只归还试探的名额
+    def record_cancel(self):
+        with self._lock:
+            self.trial_running = False
+
+    def _state(self, now):
+        if self.opened_at is None:
+            return "closed"
+        if now - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+
+# 后端的健康状况：熔断器和最近若干次请求的首个token延迟
+# 在首个token之前被取消的请求(对冲中落败)只知道延迟至少是多少，作为删失样本记录；
+# 只用完成的请求会漏掉慢的那些，百分位数越来越低，对冲也就越来越频繁
+class BackendHealth:
+    def __init__(self, window=50, failure_threshold=3, reset_timeout=30.0):
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.latencies = deque(maxlen=window)   # (秒数, 是否删失)
+        self._lock = threading.Lock()
+
+    def record_latency(self, seconds, censored=False):
+        with self._lock:
+            self.latencies.append((seconds, censored))
+
+    # 最近延迟的百分位数(Kaplan-Meier 估计)，样本不足 min_samples 个时返回 None
+    # 删失样本太多、估计不到这个百分位时，返回最大的样本(真正的值只会更大)
+    def percentile(self, percent, min_samples=5):
+        with self._lock:
+            samples = sorted(self.latencies)    # 同样的秒数时完成的样本排在删失样本前面
+        if len(samples) < min_samples:
+            return None
+        survival = 1.0
+        at_risk = len(samples)
+        for seconds, censored in samples:
+            if not censored:
+                survival *= 1 - 1 / at_risk
+                if 1 - survival >= percent / 100:
+                    return seconds
+            at_risk -= 1
+        return samples[-1][0]
+
+
+# 在多个后端之间路由翻译请求
+# 开启对冲时，主后端在最近首token延迟的 percentile 百分位内还没有返回token，就向下一个后端再发一个请求，
+# 先产出token的流胜出，其余的被取消；主后端熔断或在产出token前出错时直接改用下一个后端
+class HedgeRouter:
+    def __init__(self):
+        self.enabled = False
+        self.percentile = 95
+        self.default_delay = 2.0
+        self.min_delay = 0.3
+        self.max_delay = 8.0
+        self.backends = ["gpt-3.5-turbo", "gpt-4", "local model"]
+        self.failure_threshold = 3
+        self.reset_timeout = 30.0
+        self._health = {}
+        self._lock = threading.Lock()
+
+    def configure(self, enabled=None, percentile=None, default_delay=None, min_delay=None, max_delay=None,
+                  backends=None, failure_threshold=None, reset_timeout=None):
+        if enabled is not None:
+            self.enabled = enabled
+        if percentile is not None:
+            self.percentile = percentile
+        if default_delay is not None:
+            self.default_delay = default_delay
+        if min_delay is not None:
+            self.min_delay = min_delay
+        if max_delay is not None:
+            self.max_delay = max_delay
+        if backends:
+            self.backends = [backend.lower() for backend in backends]
+        if failure_threshold is not None:
+            self.failure_threshold = failure_threshold
+        if reset_timeout is not None:
+            self.reset_timeout = reset_timeout
+        with self._lock:
+            self._health.clear()
+
+    def health(self, backend):
+        backend = backend.lower()
+        with self._lock:
+            health = self._health.get(backend)
+            if health is None:
+                health = BackendHealth(failure_threshold=self.failure_threshold, reset_timeout=self.reset_timeout)
+                self._health[backend] = health
+            return health
+
+    # 等待主后端首个token的时间，超过后发出对冲请求
+    def hedge_delay(self, backend):
+        latency = self.health(backend).percentile(self.percentile)
+        if latency is None:
+            return self.default_delay
+        return min(self.max_delay, max(self.min_delay, latency))
+
+    # 主后端在前，后面是可以改用的其他后端；本地模型只有在已经加载时才参与
+    def candidates(self, params):
+        primary = params.model.lower()
+        if not self.enabled:
+            return [params]
+        result = [params]
+        for backend in self.backends:
+            if backend == primary:
+                continue
+            if backend == "local model":
+                if params.model_path and registry.is_loaded(params.model_path):
+                    result.append(params._replace(model=backend))
+            elif params.api_key:
+                result.append(params._replace(model=backend))
+        return result
+
+    # 流式翻译，逐段产出 (实际回答的后端参数, 文本)
+    # priority 和 owner 交给调度器，用来排定不同来源请求的先后
+    async def stream(self, params, prompt, priority=PRIORITY_INTERACTIVE, owner=None, **generation_kwargs):
+        candidates = self.candidates(params)
+        allowed = [p for p in candidates if self.health(p.model).breaker.allow()]
+        queue = deque(allowed or candidates[:1])
+        running = {}  # task -> (params, stream, 开始时间)
+        request_options = dict(generation_kwargs, priority=priority, owner=owner)
+        winner = None
+        last_error = None
+        try:
+            while winner is None:
+                if not running:
+                    if not queue:
+                        raise last_error
+                    self._start(queue.popleft(), prompt, request_options, running)
+                timeout = None
+                if queue:
+                    # 对冲的时机以最早发出、还在等待的请求为准
+                    first = min(running.values(), key=lambda item: item[2])
+                    timeout = max(0.0, self.hedge_delay(first[0].model) - (time.monotonic() - first[2]))
+                done, _ = await asyncio.wait(running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    self._start(queue.popleft(), prompt, request_options, running)
+                    continue
+                for task in done:
+                    backend, stream, started = running.pop(task)
+                    health = self.health(backend.model)
+                    if task.exception() is not None:
+                        health.breaker.record_failure()
+                        last_error = task.exception()
+                        if queue and running:
+                            self._start(queue.popleft(), prompt, request_options, running)  # 出错时立即改用下一个
+                    elif winner is None:
+                        health.record_latency(time.monotonic() - started)
+                        winner = backend, stream, task.result()
+                    else:
+                        health.record_latency(time.monotonic() - started)
+                        health.breaker.record_cancel()
+                        await stream.aclose()
+            await self._cancel(running)
+
+            backend, stream, first = winner
+            health = self.health(backend.model)
+            try:
+                if first is not _EMPTY:
+                    yield backend, first
+                    async for chunk in stream:
+                        yield backend, chunk
+            except asyncio.CancelledError:
+                health.breaker.record_cancel()
+                raise
+            except Exception:
+                health.breaker.record_failure()
+                raise
+            health.breaker.record_success()
+        finally:
+            await self._cancel(running)
+            for backend in queue:
+                self.health(backend.model).breaker.record_cancel()  # 没有用到的后端归还试探名额
+            if winner is not None:
+                await winner[1].aclose()
+
+    def _start(self, backend, prompt, request_options, running):
+        stream = backend_stream(backend, prompt, **request_options)
+        running[asyncio.ensure_future(_first_chunk(stream))] = (backend, stream, time.monotonic())
+
+    # 取消还没有产出token的请求，等待的时间记作删失样本
+    async def _cancel(self, running):
+        now = time.monotonic()
+        for task, (backend, stream, started) in list(running.items()):
+            task.cancel()
+            health = self.health(backend.model)
+            health.record_latency(now - started, censored=True)
+            health.breaker.record_cancel()
+        if running:
+            await asyncio.gather(*running, return_exceptions=True)
+        running.clear()
+
+
+async def _first_chunk(stream):
+    try:
+        return await stream.__anext__()
+    except StopAsyncIteration:
+        return _EMPTY
+
+
+# 本地模型的生成参数：和 OpenAI 请求一样使用请求参数中的 temperature 和 max_tokens，
+# 对冲或改用本地模型时，回复的生成设置和主后端相同
+def local_generation_kwargs(params):
+    kwargs = dict(LOCAL_TRANSLATION_KWARGS, temperature=params.temperature, do_sample=params.temperature > 0)
+    if params.max_tokens:
+        kwargs["max_length"] = min(kwargs["max_length"], LOCAL_CONTEXT_LENGTH + params.max_tokens)
+    return kwargs
+
+
+# 向单个后端发出翻译请求，逐段产出文本
+async def backend_stream(params, prompt, priority=PRIORITY_INTERACTIVE, owner=None, **generation_kwargs):
+    if params.model.lower() == "local model":
+        kwargs = dict(local_generation_kwargs(params), **generation_kwargs)
+        async for text in stream_local_reply(params.model_path, [prompt], **kwargs):
+            yield text
+        return
+    messages = [{"role": "user", "content": prompt}]
+    options = {"max_tokens": params.max_tokens} if params.max_tokens else {}
+    response = await scheduler.call(
+        params.model,
+        create_chat_completion,
+        api_key=params.api_key,
+        model=params.model.lower(),
+        messages=messages,
+        temperature=params.temperature,
+        stream=True,
+        tokens=request_tokens(messages, params.max_tokens),
+        priority=priority,
+        owner=owner,
+        **options
+    )
+    async for text in engine.iterate(stream_text, response, abort=response.close):
+        yield text
+
+
+# 全局共享的路由器，各个后端的健康状况在所有标签页和小窗口之间共享
+hedge_router = HedgeRouter()
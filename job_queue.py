@@ -0,0 +1,334 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+from context_window import estimate_tokens
+from document_translation import translate_text
+from file_formats import Unit, atomic_writer, read_units, render_unit, text_units
+from request_engine import RequestParams, engine
+from scheduler import PRIORITY_BACKGROUND
+
+# 单元的状态
+PENDING = "pending"
+IN_FLIGHT = "in-flight"
+DONE = "done"
+FAILED = "failed"
+RUNNING = "running"  # 任务的状态另外还有 running
+
+Job = namedtuple("Job", ["id", "source", "target", "language", "style", "model", "model_path", "status", "error"])
+# rate 是本次运行中每秒完成的原文token数，eta 是按这个速度完成剩余单元还需要的秒数(还没有速度时为 None)
+JobProgress = namedtuple("JobProgress", ["total", "done", "failed", "pending", "rate", "eta"])
+
+# 运行中的任务每 LEASE_SECONDS / 3 秒续一次租约；租约过期或持有的进程已经退出时，别的进程才能接手
+LEASE_SECONDS = 60
+
+
+# 持久化的翻译任务队列(SQLite)
+# 每个任务的翻译单元和状态(pending / in-flight / done / failed)都记在数据库里，每完成一个单元就提交一次；
+# 运行中的任务和领取的单元记下进程号(owner)和租约(lease)。GUI 和命令行共用一个数据库，
+# 只有开始运行时才把持有者已经退出或租约过期的 in-flight 单元放回 pending，再次运行只翻译没有完成的单元
+class JobQueue:
+    def __init__(self, path="cache/jobs.db", concurrency=4):
+        self.path = path
+        self.concurrency = concurrency
+        self._conn = None
+        self._runs = {}  # job_id -> 正在运行的任务的 _RunStats
+        self._lock = threading.Lock()
+
+    def configure(self, path=None, concurrency=None):
+        if path is not None and path != self.path:
+            self.close()
+            self.path = path
+        if concurrency is not None:
+            self.concurrency = max(1, concurrency)
+
+    # 从文件创建任务，target 为输出文件
+    def add_file(self, source, target, language, style, params, field="text", output_field="translation"):
+        return self._add(source, target, language, style, params, read_units(source, field, output_field))
+
+    # 从一段文本创建任务(GUI中输入的长文本)
+    def add_text(self, text, target, language, style, params, segment_tokens=800):
+        return self._add("", target, language, style, params, text_units(text, segment_tokens))
+
+    def jobs(self, unfinished_only=False):
+        query = "SELECT id, source, target, language, style, model, model_path, status, error FROM jobs"
+        if unfinished_only:
+            query += f" WHERE status != '{DONE}'"
+        with self._lock:
+            return [Job(*row) for row in self._connect().execute(query + " ORDER BY id")]
+
+    def job(self, job_id):
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT id, source, target, language, style, model, model_path, status, error FROM jobs WHERE id = ?",
+                (job_id,)).fetchone()
+        return Job(*row) if row else None
+
+    # 正在运行的任务直接用内存中的计数，每完成一个单元调用一次也不用扫描数据库
+    def progress(self, job_id):
+        with self._lock:
+            run = self._runs.get(job_id)
+            if run is None:
+                run = self._load_stats(job_id)
+            return run.progress()
+
+    def delete(self, job_id):
+        with self._lock:
+            self._connect().execute("DELETE FROM units WHERE job_id = ?", (job_id,))
+            self._conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+            self._conn.commit()
+
+    # 运行任务直到所有单元完成，完成后原子地写出结果文件
+    # 失败的单元会在这次运行中重新翻译；已完成的单元不再请求。on_progress 在每个单元结束后以 JobProgress 调用
+    async def run(self, job_id, api_key, concurrency=None, on_progress=None, priority=PRIORITY_BACKGROUND):
+        job = self.job(job_id)
+        if job is None:
+            raise ValueError(f"No translation job {job_id}")
+        params = RequestParams(model=job.model, api_key=api_key, model_path=job.model_path)
+        run = await engine.run_blocking(self._start_run, job_id)
+        heartbeat = asyncio.ensure_future(self._heartbeat(job_id))
+        semaphore = asyncio.Semaphore(concurrency or self.concurrency)
+        tasks = set()
+        after = -1
+        try:
+            # 分批读出待翻译的单元，内存中最多只有一批
+            while True:
+                batch = await engine.run_blocking(self._pending_units, job_id, after)
+                if not batch:
+                    break
+                for idx, text, tokens in batch:
+                    await semaphore.acquire()
+                    task = asyncio.ensure_future(self._translate_unit(job, params, idx, text, tokens, priority))
+                    task.add_done_callback(lambda _: semaphore.release())
+                    task.add_done_callback(tasks.discard)
+                    if on_progress is not None:
+                        task.add_done_callback(lambda t: t.cancelled() or on_progress(self.progress(job_id)))
+                    tasks.add(task)
+                after = batch[-1][0]
+            await asyncio.gather(*tasks)
+            failed = run.failed
+            if failed:
+                await engine.run_blocking(self._set_status, job_id, FAILED, f"{failed} units failed")
+                return False
+            await engine.run_blocking(self._write_result, job)
+            await engine.run_blocking(self._set_status, job_id, DONE, None)
+            return True
+        except BaseException as e:
+            tasks = list(tasks)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            status = PENDING if isinstance(e, asyncio.CancelledError) else FAILED
+            await asyncio.shield(engine.run_blocking(self._set_status, job_id, status, str(e) or None))
+            raise
+        finally:
+            heartbeat.cancel()
+            with self._lock:
+                self._runs.pop(job_id, None)
+
+    # 按顺序读出已完成任务的全部译文
+    def result_chunks(self, job_id, batch_size=256):
+        after = -1
+        while True:
+            with self._lock:
+                rows = self._connect().execute(
+                    "SELECT idx, text, kind, data, translation FROM units WHERE job_id = ? AND idx > ? "
+                    "ORDER BY idx LIMIT ?", (job_id, after, batch_size)).fetchall()
+            if not rows:
+                return
+            for _, text, kind, data, translation in rows:
+                yield render_unit(Unit(text, kind, json.loads(data)), translation)
+            after = rows[-1][0]
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    async def _translate_unit(self, job, params, idx, text, tokens, priority):
+        await engine.run_blocking(self._set_unit, job.id, idx, IN_FLIGHT)
+        try:
+            translation = await translate_text(params, text, job.language, job.style, priority=priority)
+        except asyncio.CancelledError:
+            await asyncio.shield(engine.run_blocking(self._set_unit, job.id, idx, PENDING))
+            raise
+        except Exception as e:
+            await engine.run_blocking(self._set_unit, job.id, idx, FAILED, error=str(e))
+            with self._lock:
+                self._runs[job.id].failed += 1
+            return
+        await engine.run_blocking(self._set_unit, job.id, idx, DONE, translation=translation)
+        with self._lock:
+            self._runs[job.id].finish(tokens)
+
+    def _add(self, source, target, language, style, params, units):
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            job_id = conn.execute(
+                "INSERT INTO jobs (source, target, language, style, model, model_path, status, created, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (source, target, language, style, params.model, params.model_path, PENDING, now, now)).lastrowid
+            conn.executemany(
+                "INSERT INTO units (job_id, idx, text, kind, data, status, tokens) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                ((job_id, idx, unit.text, unit.kind, json.dumps(unit.data, ensure_ascii=False),
+                  PENDING if unit.text is not None else DONE, estimate_tokens(unit.text or ""))
+                 for idx, unit in enumerate(units)))
+            conn.commit()
+        return job_id
+
+    # 领取任务：任务正在别的进程(或本进程)中运行时拒绝；否则上一个持有者已经退出，
+    # 它领取的 in-flight 单元和失败的单元回到 pending。检查和领取在同一个写事务中，两个进程不会同时领到
+    def _start_run(self, job_id):
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                status, owner, lease = conn.execute("SELECT status, owner, lease FROM jobs WHERE id = ?",
+                                                    (job_id,)).fetchone()
+                if status == RUNNING and self._owner_alive(job_id, owner, lease):
+                    raise RuntimeError(f"Job {job_id} is already running in process {owner}")
+                now = time.time()
+                conn.execute("UPDATE units SET status = ?, owner = NULL, lease = NULL, error = NULL "
+                             "WHERE job_id = ? AND status IN (?, ?)", (PENDING, job_id, FAILED, IN_FLIGHT))
+                conn.execute("UPDATE jobs SET status = ?, owner = ?, lease = ?, error = NULL, updated = ? WHERE id = ?",
+                             (RUNNING, os.getpid(), now + LEASE_SECONDS, now, job_id))
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+            run = self._runs[job_id] = self._load_stats(job_id)
+            return run
+
+    # 本进程的任务看是否还在 _runs 中；别的进程看租约和进程是否还在
+    def _owner_alive(self, job_id, owner, lease):
+        if owner == os.getpid():
+            return job_id in self._runs
+        return lease is not None and lease > time.time() and _process_alive(owner)
+
+    async def _heartbeat(self, job_id):
+        while True:
+            await asyncio.sleep(LEASE_SECONDS / 3)
+            try:
+                await engine.run_blocking(self._renew_lease, job_id)
+            except sqlite3.Error:
+                pass  # 数据库暂时被锁住，下一次再续
+
+    def _renew_lease(self, job_id):
+        lease = time.time() + LEASE_SECONDS
+        with self._lock:
+            self._connect().execute("UPDATE jobs SET lease = ? WHERE id = ? AND owner = ?",
+                                    (lease, job_id, os.getpid()))
+            self._conn.execute("UPDATE units SET lease = ? WHERE job_id = ? AND status = ? AND owner = ?",
+                               (lease, job_id, IN_FLIGHT, os.getpid()))
+            self._conn.commit()
+
+    def _load_stats(self, job_id):
+        total, done, failed, remaining = self._connect().execute(
+            "SELECT COUNT(*), COALESCE(SUM(status = ?), 0), COALESCE(SUM(status = ?), 0), "
+            "COALESCE(SUM(CASE WHEN status != ? THEN tokens ELSE 0 END), 0) FROM units WHERE job_id = ?",
+            (DONE, FAILED, DONE, job_id)).fetchone()
+        return _RunStats(total, done, failed, remaining)
+
+    def _pending_units(self, job_id, after, limit=256):
+        with self._lock:
+            return self._connect().execute(
+                "SELECT idx, text, tokens FROM units WHERE job_id = ? AND status = ? AND idx > ? ORDER BY idx LIMIT ?",
+                (job_id, PENDING, after, limit)).fetchall()
+
+    # 领取(in-flight)时记下本进程和租约，结束时清除
+    def _set_unit(self, job_id, idx, status, translation=None, error=None):
+        owner = lease = None
+        if status == IN_FLIGHT:
+            owner, lease = os.getpid(), time.time() + LEASE_SECONDS
+        with self._lock:
+            self._connect().execute(
+                "UPDATE units SET status = ?, translation = COALESCE(?, translation), error = ?, owner = ?, lease = ? "
+                "WHERE job_id = ? AND idx = ?", (status, translation, error, owner, lease, job_id, idx))
+            self._conn.commit()
+
+    def _set_status(self, job_id, status, error):
+        with self._lock:
+            self._connect().execute(
+                "UPDATE jobs SET status = ?, error = ?, owner = NULL, lease = NULL, updated = ? WHERE id = ?",
+                (status, error, time.time(), job_id))
+            self._conn.commit()
+
+    def _write_result(self, job):
+        if job.target:
+            with atomic_writer(job.target) as out:
+                for chunk in self.result_chunks(job.id):
+                    out.write(chunk)
+
+    def _connect(self):
+        if self._conn is None:
+            folder = os.path.dirname(self.path)
+            if folder and not os.path.exists(folder):
+                os.makedirs(folder)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, source TEXT, target TEXT, language TEXT NOT NULL, "
+                "style TEXT NOT NULL, model TEXT NOT NULL, model_path TEXT, status TEXT NOT NULL, error TEXT, "
+                "created REAL NOT NULL, updated REAL NOT NULL, owner INTEGER, lease REAL)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS units ("
+                "job_id INTEGER NOT NULL, idx INTEGER NOT NULL, text TEXT, kind TEXT NOT NULL, data TEXT, "
+                "status TEXT NOT NULL, translation TEXT, error TEXT, tokens INTEGER NOT NULL, owner INTEGER, "
+                "lease REAL, PRIMARY KEY (job_id, idx))")
+            # 旧版本创建的数据库没有 owner 和 lease 两列
+            for table in ("jobs", "units"):
+                columns = {row[1] for row in self._conn.execute(f"PRAGMA table_info({table})")}
+                for column, kind in (("owner", "INTEGER"), ("lease", "REAL")):
+                    if column not in columns:
+                        self._conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {kind}")
+        return self._conn
+
+
+# 进程是否还在。Windows 上 os.kill 会结束进程，不能用来检查，只看租约
+def _process_alive(pid):
+    if pid is None:
+        return False
+    if os.name == "nt":
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+# 任务的单元计数；rate 只按本次运行完成的token数计算
+class _RunStats:
+    def __init__(self, total, done, failed, remaining_tokens):
+        self.total = total
+        self.done = done
+        self.failed = failed
+        self.remaining_tokens = remaining_tokens
+        self.finished_tokens = 0
+        self.started = time.monotonic()
+
+    def finish(self, tokens):
+        self.done += 1
+        self.finished_tokens += tokens
+        self.remaining_tokens -= tokens
+
+    def progress(self):
+        rate = eta = None
+        if self.finished_tokens > 0:
+            rate = self.finished_tokens / max(time.monotonic() - self.started, 1e-6)
+            eta = self.remaining_tokens / rate
+        pending = self.total - self.done - self.failed
+        return JobProgress(self.total, self.done, self.failed, pending, rate, eta)
+
+
+# 全局共享的任务队列
+job_queue = JobQueue()
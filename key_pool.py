@@ -0,0 +1,156 @@
+import threading
+import time
+
+
+# 令牌桶：容量为每分钟的限额，按限额/60的速度持续补充；limit 为0表示不限制
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.tokens = float(per_minute)
+        self.updated = time.monotonic()
+
+    # 还要等多少秒才能取出 amount 个令牌
+    def wait_time(self, amount, now):
+        if not self.capacity:
+            return 0.0
+        self._refill(now)
+        amount = min(amount, self.capacity)  # 超过容量的请求等桶满后放行
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) * 60.0 / self.capacity
+
+    def consume(self, amount, now):
+        if self.capacity:
+            self._refill(now)
+            self.tokens -= min(amount, self.capacity)
+
+    # 剩余令牌占容量的比例，不限制时为1
+    def headroom(self, now):
+        if not self.capacity:
+            return 1.0
+        self._refill(now)
+        return max(self.tokens, 0.0) / self.capacity
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.capacity / 60.0)
+        self.updated = now
+
+
+# 一个API密钥：自身的每分钟请求数/token数限额，以及按模型的限额(各个密钥分别计算)
+class ApiKey:
+    def __init__(self, name, key, base_url=None, rpm=0, tpm=0):
+        self.name = name
+        self.key = key
+        self.base_url = base_url or None
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.model_buckets = {}
+        self.paused_until = 0.0       # 收到429后暂停到这个时间
+        self.quarantined_until = 0.0  # 认证失败或额度用完后隔离到这个时间
+        self.quarantine_reason = None
+        self.last_used = 0.0
+
+    def buckets(self, model, limits):
+        buckets = self.model_buckets.get(model)
+        if buckets is None:
+            rpm, tpm = limits.get(model, (0, 0))
+            buckets = TokenBucket(rpm), TokenBucket(tpm)
+            self.model_buckets[model] = buckets
+        return buckets
+
+    # 还要等多少秒才能用这个密钥向 model 发送一个约 tokens 个token的请求
+    def wait_time(self, model, tokens, limits, now):
+        model_requests, model_tokens = self.buckets(model, limits)
+        return max(self.paused_until - now, self.requests.wait_time(1, now), self.tokens.wait_time(tokens, now),
+                   model_requests.wait_time(1, now), model_tokens.wait_time(tokens, now))
+
+    def headroom(self, model, limits, now):
+        model_requests, model_tokens = self.buckets(model, limits)
+        return min(self.requests.headroom(now), self.tokens.headroom(now),
+                   model_requests.headroom(now), model_tokens.headroom(now))
+
+    def consume(self, model, tokens, limits, now):
+        model_requests, model_tokens = self.buckets(model, limits)
+        for bucket, amount in ((self.requests, 1), (self.tokens, tokens), (model_requests, 1), (model_tokens, tokens)):
+            bucket.consume(amount, now)
+        self.last_used = now
+
+
+# 认证失败、没有权限或额度用完：这个密钥暂时不能再用
+def is_key_error(error):
+    import openai  # 出错时 SDK 必然已经加载
+
+    if isinstance(error, (openai.AuthenticationError, openai.PermissionDeniedError)):
+        return True
+    return isinstance(error, openai.RateLimitError) and getattr(error, "code", None) == "insufficient_quota"
+
+
+# 所有可用的API密钥，请求按剩余额度分配到各个密钥上
+class KeyPool:
+    def __init__(self):
+        self.keys = []
+        self.quarantine_seconds = 600.0
+        self._lock = threading.Lock()
+
+    # keys 是 dict 的列表：name、key、base_url、rpm、tpm
+    def configure(self, keys=None, quarantine_seconds=None):
+        with self._lock:
+            if keys is not None:
+                self.keys = [ApiKey(**key) for key in keys if key.get("key")]
+            if quarantine_seconds is not None:
+                self.quarantine_seconds = quarantine_seconds
+
+    # 没有配置密钥池时(例如脚本中直接传入密钥)，把传入的密钥作为唯一的密钥
+    def ensure(self, api_key):
+        with self._lock:
+            if not self.keys and api_key:
+                self.keys.append(ApiKey("default", api_key))
+
+    # 选出现在就能使用、剩余额度最多的密钥；都不能用时返回 (None, 最短等待秒数)，
+    # 所有密钥都被隔离时等待秒数为 None
+    def choose(self, model, tokens, limits, now):
+        with self._lock:
+            best = None
+            wait = None
+            for key in self.keys:
+                if key.quarantined_until > now:
+                    continue
+                key_wait = key.wait_time(model, tokens, limits, now)
+                if key_wait > 0:
+                    wait = key_wait if wait is None else min(wait, key_wait)
+                    continue
+                rank = (key.headroom(model, limits, now), -key.last_used)
+                if best is None or rank > best[0]:
+                    best = rank, key
+            if best is None:
+                return None, wait
+            best[1].consume(model, tokens, limits, now)
+            return best[1], 0.0
+
+    def pause(self, key, seconds):
+        with self._lock:
+            key.paused_until = max(key.paused_until, time.monotonic() + seconds)
+
+    # 隔离一个密钥；主窗口的状态栏显示被隔离的密钥数，提示中有每个密钥的原因(见 quarantined)
+    def quarantine(self, key, reason=None):
+        with self._lock:
+            key.quarantined_until = time.monotonic() + self.quarantine_seconds
+            key.quarantine_reason = reason
+
+    # 可用的密钥数和被隔离的密钥数
+    def status(self):
+        now = time.monotonic()
+        with self._lock:
+            quarantined = sum(1 for key in self.keys if key.quarantined_until > now)
+            return len(self.keys) - quarantined, quarantined
+
+    # 被隔离的密钥：(名称, 剩余秒数, 原因)
+    def quarantined(self):
+        now = time.monotonic()
+        with self._lock:
+            return [(key.name, key.quarantined_until - now, key.quarantine_reason)
+                    for key in self.keys if key.quarantined_until > now]
+
+
+# 全局共享的密钥池
+key_pool = KeyPool()
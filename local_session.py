@@ -0,0 +1,121 @@
+import threading
+
+from model_registry import registry
+from request_engine import engine
+
+LOCAL_CONTEXT_LENGTH = 512  # 本地模型每次请求的历史token上限
+
+
+# 本地多轮对话的会话状态
+# 记住模型KV缓存中已经计算过的token，下一轮只预填充与缓存不同的部分(通常只有新的用户输入)
+# 历史被修改或清空时，公共前缀变短，自动退化为从分歧处(或从头)重新计算
+class LocalChatSession:
+    def __init__(self):
+        self.cached_ids = []          # 当前KV缓存中对应的token序列
+        self.last_prefill_tokens = 0  # 最近一轮实际预填充的token数
+
+    # 丢弃缓存，下一轮完整重新计算
+    def invalidate(self):
+        self.cached_ids = []
+
+    # 模型是否提供了逐token生成的接口，否则只能整段调用 pipeline.chat
+    @staticmethod
+    def supports(pipeline):
+        model = getattr(pipeline, "model", None)
+        tokenizer = getattr(pipeline, "tokenizer", None)
+        return hasattr(model, "generate_next_token") and hasattr(tokenizer, "encode_history")
+
+    # 流式生成回复，产出新增的文本片段
+    # 调用方需要独占 pipeline(见 ModelRegistry.lease)，否则其它生成任务会覆盖KV缓存
+    # stop_event 被设置后在当前token之后结束
+    def chat(self, pipeline, history, max_length=2048, max_context_length=512, do_sample=True, top_k=0, top_p=0.7,
+             temperature=0.95, repetition_penalty=1.0, stop_event=None):
+        if not self.supports(pipeline):
+            self.invalidate()
+            yield from _until_stopped(
+                pipeline.chat(history, max_length=max_length, max_context_length=max_context_length,
+                              do_sample=do_sample, top_k=top_k, top_p=top_p, temperature=temperature,
+                              repetition_penalty=repetition_penalty, stream=True), stop_event)
+            return
+
+        input_ids = list(pipeline.tokenizer.encode_history(history, max_context_length))
+        n_past = common_prefix_length(self.cached_ids, input_ids)
+        if n_past == len(input_ids):
+            n_past -= 1  # 至少重新计算最后一个token，才能得到下一个token的分布
+        self.last_prefill_tokens = len(input_ids) - n_past
+        self.cached_ids = []  # 生成过程中缓存处于中间状态，完成后再记录
+
+        import chatglm_cpp
+
+        gen_config = chatglm_cpp._C.GenerationConfig(
+            max_length=max_length,
+            max_context_length=max_context_length,
+            do_sample=do_sample,
+            top_k=top_k,
+            top_p=top_p,
+            temperature=temperature,
+            repetition_penalty=repetition_penalty,
+        )
+        eos_ids = eos_token_ids(pipeline)
+        n_ctx = len(input_ids)
+        ids = input_ids
+        computed = n_past
+        token_cache = []
+        printed_len = 0
+        try:
+            while len(ids) < max_length and not (stop_event is not None and stop_event.is_set()):
+                next_id = pipeline.model.generate_next_token(ids, gen_config, computed, n_ctx)
+                computed = len(ids)
+                if next_id in eos_ids:
+                    break
+                ids.append(next_id)
+                token_cache.append(next_id)
+                text = pipeline.tokenizer.decode(token_cache)
+                if text.endswith("\ufffd"):
+                    continue  # 多字节字符还没解码完整
+                yield text[printed_len:]
+                printed_len = len(text)
+        finally:
+            self.cached_ids = ids[:computed]
+
+
+# 在注册表中租用模型并流式生成回复；带 session 时复用该会话的KV缓存
+def stream_local_chat(model_path, history, session=None, stop_event=None, **generation_kwargs):
+    with registry.lease(model_path, session=session) as pipeline:
+        if session is not None:
+            yield from session.chat(pipeline, history, stop_event=stop_event, **generation_kwargs)
+        else:
+            yield from _until_stopped(pipeline.chat(history, stream=True, **generation_kwargs), stop_event)
+
+
+# 在事件循环中流式生成本地模型的回复
+# 先在事件循环中排队拿到这个模型的生成锁再进入线程，排队的请求不占线程，也就不会占满线程池让持有锁的生成卡住；
+# 被取消时 stop_event 让生成在当前token之后结束，线程随即空出来
+async def stream_local_reply(model_path, history, session=None, **generation_kwargs):
+    stop_event = threading.Event()
+    async with registry.generation_lock(model_path):
+        async for chunk in engine.iterate(stream_local_chat, model_path, history, session=session,
+                                          stop_event=stop_event, abort=stop_event.set, **generation_kwargs):
+            yield chunk
+
+
+def _until_stopped(stream, stop_event):
+    for chunk in stream:
+        yield chunk
+        if stop_event is not None and stop_event.is_set():
+            return
+
+
+def common_prefix_length(a, b):
+    n = min(len(a), len(b))
+    for i in range(n):
+        if a[i] != b[i]:
+            return i
+    return n
+
+
+def eos_token_ids(pipeline):
+    config = pipeline.model.config
+    ids = {config.eos_token_id}
+    ids.update(getattr(config, "extra_eos_token_ids", None) or [])
+    return ids
@@ -1,5 +1,9 @@
-from chat_window import *
-from config import *
+import sys
+
+from PySide6 import QtWidgets
+
+from chat_window import ChatWindow
+from config import Configuration
 
 # 应用程序的入口点，GUI的初始化
 app = QtWidgets.QApplication(sys.argv)
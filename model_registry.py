@@ -0,0 +1,196 @@
+import asyncio
+import mmap
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+# 单个已加载(或正在加载)的本地模型
+class ModelEntry:
+    def __init__(self, key, size):
+        self.key = key
+        self.size = size                  # 估算的常驻内存(字节)
+        self.pipeline = None
+        self.ref_count = 0
+        self.error = None
+        self.ready = threading.Event()    # 加载完成(成功或失败)后置位
+        self.generate_lock = threading.Lock()  # 同一个模型同一时间只允许一个生成任务
+        self.kv_owner = None              # 最近一次使用模型KV缓存的会话
+
+
+# 进程内共享的 chatglm_cpp.Pipeline 注册表，按模型路径和加载参数区分
+# 所有标签页和小窗口共用同一份已加载的模型，引用计数为0的模型按LRU在超出内存预算时被卸载
+class ModelRegistry:
+    def __init__(self, ram_budget=0, loader=None):
+        self.ram_budget = ram_budget      # 内存预算(字节)，0表示不限制
+        self.loader = loader or load_pipeline
+        self._entries = OrderedDict()
+        self._generation_locks = {}       # 模型路径 -> 事件循环中排队生成用的 asyncio.Lock
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(model_path, **options):
+        return os.path.abspath(model_path), tuple(sorted(options.items()))
+
+    # 获取模型，必要时加载；同一个模型的并发请求只会触发一次加载
+    def acquire(self, model_path, **options):
+        return self._acquire_entry(model_path, options).pipeline
+
+    # 释放 acquire 得到的引用，模型仍保留在缓存中直到被卸载或淘汰
+    def release(self, model_path, **options):
+        key = self.make_key(model_path, **options)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.ref_count > 0:
+                entry.ref_count -= 1
+            self._evict()
+
+    # 在一次生成期间持有模型：加引用并独占生成锁
+    # session 为 LocalChatSession 时，若KV缓存期间被其它任务用过，则让该会话的缓存失效
+    @contextmanager
+    def lease(self, model_path, session=None, **options):
+        entry = self._acquire_entry(model_path, options)
+        try:
+            with entry.generate_lock:
+                if session is not None and entry.kv_owner is not session:
+                    session.invalidate()
+                entry.kv_owner = session
+                yield entry.pipeline
+        finally:
+            with self._lock:
+                if entry.ref_count > 0:
+                    entry.ref_count -= 1
+                self._evict()
+
+    # 同一个模型的生成请求在事件循环中排队：等待的请求不占用线程，被取消时直接离开队列
+    # lease 中的 generate_lock 仍然保证同一时间只有一个线程在用 pipeline
+    def generation_lock(self, model_path):
+        key = self.make_key(model_path)
+        with self._lock:
+            lock = self._generation_locks.get(key)
+            if lock is None:
+                lock = self._generation_locks[key] = asyncio.Lock()
+            return lock
+
+    # 显式卸载模型；仍在使用中的模型只有在 force=True 时才会被移除
+    def unload(self, model_path, force=False, **options):
+        key = self.make_key(model_path, **options)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or (entry.ref_count > 0 and not force):
+                return False
+            del self._entries[key]
+            return True
+
+    # 后台预加载：先把权重文件预读进页缓存(可取消并汇报进度)，再构建 Pipeline
+    # 返回 True 时调用方持有一个引用，用完需要 release；被取消时返回 False 且不持有引用
+    def preload(self, model_path, progress=None, cancel_event=None, **options):
+        if not self.is_loaded(model_path, **options):
+            if not prefetch_file(model_path, progress, cancel_event):
+                return False
+        self.acquire(model_path, **options)
+        if cancel_event is not None and cancel_event.is_set():
+            self.release(model_path, **options)
+            self.unload(model_path, **options)
+            return False
+        return True
+
+    def is_loaded(self, model_path, **options):
+        key = self.make_key(model_path, **options)
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and entry.pipeline is not None
+
+    def set_ram_budget(self, ram_budget):
+        with self._lock:
+            self.ram_budget = ram_budget
+            self._evict()
+
+    # 当前已加载模型的信息：(路径, 加载参数, 估算大小, 引用数)
+    def loaded_models(self):
+        with self._lock:
+            return [(entry.key[0], dict(entry.key[1]), entry.size, entry.ref_count)
+                    for entry in self._entries.values() if entry.pipeline is not None]
+
+    def _acquire_entry(self, model_path, options):
+        key = self.make_key(model_path, **options)
+        with self._lock:
+            entry = self._entries.get(key)
+            owner = entry is None
+            if owner:
+                entry = ModelEntry(key, self._estimate_size(key[0]))
+                self._entries[key] = entry
+            entry.ref_count += 1
+            self._entries.move_to_end(key)
+
+        if owner:
+            try:
+                entry.pipeline = self.loader(key[0], **options)
+            except Exception as e:
+                entry.error = e
+                with self._lock:
+                    if self._entries.get(key) is entry:
+                        del self._entries[key]
+                entry.ready.set()
+                raise
+            entry.ready.set()
+            with self._lock:
+                self._evict()
+        else:
+            entry.ready.wait()
+            if entry.error is not None:
+                raise entry.error
+        return entry
+
+    # ggml 格式的权重文件大小基本等于加载后的常驻内存
+    @staticmethod
+    def _estimate_size(model_path):
+        try:
+            return os.path.getsize(model_path)
+        except OSError:
+            return 0
+
+    # 超出预算时，按最久未使用的顺序卸载没有引用的模型(调用方需持有 self._lock)
+    def _evict(self):
+        if not self.ram_budget:
+            return
+        total = sum(entry.size for entry in self._entries.values())
+        for key in list(self._entries):
+            if total <= self.ram_budget:
+                break
+            entry = self._entries[key]
+            if entry.ref_count == 0 and entry.ready.is_set():
+                del self._entries[key]
+                total -= entry.size
+
+
+# 以只读方式映射权重文件，逐块访问每一页，使其进入操作系统页缓存，之后的加载只需从内存拷贝
+# 这只是预读：chatglm_cpp.Pipeline 仍把权重拷贝进自己的私有内存，并不直接使用映射。
+# 不让常驻内存翻倍靠的是注册表在进程内共享同一个 Pipeline；另一个进程加载同一个模型仍要再占一份内存
+def prefetch_file(model_path, progress=None, cancel_event=None, chunk_size=64 * 1024 * 1024):
+    size = os.path.getsize(model_path)
+    if size == 0:
+        return True
+    with open(model_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        offset = 0
+        while offset < size:
+            if cancel_event is not None and cancel_event.is_set():
+                return False
+            end = min(offset + chunk_size, size)
+            mapped[offset:end:mmap.PAGESIZE]  # 每页读一个字节即可触发缺页读入
+            offset = end
+            if progress is not None:
+                progress(offset / size)
+    return True
+
+
+# 默认的加载函数：chatglm_cpp 在第一次加载本地模型时才导入
+def load_pipeline(model_path, **options):
+    import chatglm_cpp
+
+    return chatglm_cpp.Pipeline(model_path, **options)
+
+
+# 全局共享的模型注册表
+registry = ModelRegistry()
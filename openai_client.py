@@ -0,0 +1,130 @@
+import threading
+
+
+# 全局共享的 OpenAI 客户端，每个 API key/接口地址一个
+# 所有标签页和小窗口复用同一个带连接池的 HTTP 客户端，避免每次请求重新建立 TCP/TLS 连接和代理握手
+class ClientPool:
+    def __init__(self):
+        self.proxy = None
+        self.timeout = 60.0
+        self.connect_timeout = 10.0
+        self.max_connections = 20
+        self.max_keepalive_connections = 10
+        self.keepalive_expiry = 120.0
+        self._clients = {}
+        self._http_clients = {}
+        self._lock = threading.Lock()
+
+    # 修改网络设置，已创建的客户端会被关闭，之后按新设置重新创建
+    def configure(self, proxy=None, timeout=None, connect_timeout=None, max_connections=None,
+                  max_keepalive_connections=None, keepalive_expiry=None):
+        if proxy is not None:
+            self.proxy = proxy or None
+        if timeout is not None:
+            self.timeout = timeout
+        if connect_timeout is not None:
+            self.connect_timeout = connect_timeout
+        if max_connections is not None:
+            self.max_connections = max_connections
+        if max_keepalive_connections is not None:
+            self.max_keepalive_connections = max_keepalive_connections
+        if keepalive_expiry is not None:
+            self.keepalive_expiry = keepalive_expiry
+        self.close()
+
+    def get(self, api_key, base_url=None):
+        key = (api_key, base_url)
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                from openai import OpenAI  # SDK 在创建第一个客户端时才加载
+
+                http_client = self._make_http_client()
+                client = OpenAI(api_key=api_key, base_url=base_url, http_client=http_client)
+                self._clients[key] = client
+                self._http_clients[key] = http_client
+            return client
+
+    # 预先建立到接口地址的连接(TCP、TLS和代理握手)，连接放回连接池供第一次请求使用
+    # 失败时返回异常：预热失败不影响之后的请求，它们会自己重新连接
+    def warm_up(self, api_key, base_url=None):
+        client = self.get(api_key, base_url)
+        with self._lock:
+            http_client = self._http_clients.get((api_key, base_url))
+        if http_client is None:
+            return None
+        import httpx
+
+        try:
+            http_client.head(str(client.base_url))
+        except httpx.HTTPError as e:
+            return e
+        return None
+
+    # 在后台线程中预热；失败时在该线程中调用 on_error(异常)
+    def warm_up_in_background(self, api_key, base_url=None, on_error=None):
+        def run():
+            error = self.warm_up(api_key, base_url)
+            if error is not None and on_error is not None:
+                on_error(error)
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def close(self):
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients.clear()
+            self._http_clients.clear()
+        for client in clients:
+            client.close()
+
+    def _make_http_client(self):
+        import httpx
+        from openai import DefaultHttpxClient
+
+        return DefaultHttpxClient(
+            proxy=self.proxy,
+            timeout=httpx.Timeout(self.timeout, connect=self.connect_timeout),
+            limits=httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_keepalive_connections,
+                keepalive_expiry=self.keepalive_expiry,
+            ),
+        )
+
+
+client_pool = ClientPool()
+
+
+def get_client(api_key, base_url=None):
+    return client_pool.get(api_key, base_url)
+
+
+# 用给定的客户端发出对话请求(供调度器在选定密钥后调用)
+def create_chat_completion(client, **kwargs):
+    return client.chat.completions.create(**kwargs)
+
+
+# 逐段产出流式回复中的文本
+def stream_text(response):
+    for chunk in response:  # 遍历数据流的事件
+        if not chunk.choices:
+            continue
+        chunk_message = chunk.choices[0].delta.content  # 提取消息
+        if chunk_message is not None:
+            yield chunk_message
+
+
+# 语音转文字，translate=True 时直接翻译成英文
+# audio 是文件路径，或者有 upload() 方法的录音(audio_capture.WavSpool)，后者直接从内存或临时文件上传
+def transcribe_file(client, audio, translate=False, model="whisper-1"):
+    if isinstance(audio, str):
+        with open(audio, "rb") as audio_file:
+            return _transcribe(client, audio_file, translate, model)
+    return _transcribe(client, audio.upload(), translate, model)
+
+
+def _transcribe(client, audio_file, translate, model):
+    if translate:
+        return client.audio.translations.create(model=model, file=audio_file).text
+    return client.audio.transcriptions.create(model=model, file=audio_file).text
@@ -0,0 +1,17 @@
+# 提示词的版本号，修改下面的提示词时需要加一，旧的翻译缓存随之失效
+PROMPT_VERSION = 2
+
+STYLE_TEXTS = {
+    "interesting": "Use a relaxed, playful and cute translation style that needs to be distinguished from normal translation",
+    "academic": "Use a rigorous and academic translation style that needs to be distinguished from normal translation",
+    "simple": "Use a simple and concise translation style, only translate the general meaning, and need to be different from normal translation.",
+}
+
+
+def style_text(style):
+    return STYLE_TEXTS.get((style or "").lower(), " ")
+
+
+# 构造翻译请求的提示词
+def build_translation_prompt(message, language, style="Normal"):
+    return f"Please translate the following sentence to {language}，{style_text(style)}, and give me translation outcome without anything else: {message}"
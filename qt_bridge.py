@@ -0,0 +1,26 @@
+from PySide6.QtCore import QCoreApplication, QEvent, QObject, QTimer, Signal, Slot
+
+
+# 线程安全的桥：在任意线程发出回调，在创建它的GUI线程中执行
+class QtBridge(QObject):
+    call_signal = Signal(object, object)
+
+    def __init__(self):
+        super().__init__()
+        self.call_signal.connect(self.call)
+
+    def dispatch(self, callback, args):
+        self.call_signal.emit(callback, args)
+
+    @Slot(object, object)
+    def call(self, callback, args):
+        callback(*args)
+
+    # 在GUI线程中立即执行已经发出、还在排队的回调(例如关闭窗口前让被取消的回复记入历史)
+    def flush(self):
+        QCoreApplication.sendPostedEvents(self, QEvent.MetaCall)
+
+
+# RenderBuffer 的 scheduler：在GUI线程中延迟调用；context 控件被销毁后不再调用
+def render_scheduler(context):
+    return lambda delay, callback: QTimer.singleShot(max(1, round(delay * 1000)), context, callback)
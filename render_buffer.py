@@ -0,0 +1,90 @@
+import asyncio
+import threading
+import time
+
+from request_engine import engine
+
+
+# 流式输出的渲染缓冲：工作线程放入片段，GUI线程按限定的帧率一次取出、一次渲染
+# 相邻的同类片段合并成一段，每一帧最多向GUI线程发一个事件、只更新一次显示；
+# 积压的字符数超过 max_backlog 时 put() 等到下一次渲染后才返回，生成端随之放慢
+class RenderBuffer:
+    def __init__(self, render, fps=30, max_backlog=65536):
+        self.render = render            # 在GUI线程中以 [(kind, text), ...] 调用
+        self.interval = 1.0 / fps
+        self.max_backlog = max_backlog
+        # scheduler(delay, callback)：在GUI线程中 delay 秒后调用 callback；为 None 时立即渲染(无界面的脚本)
+        self.scheduler = None
+        self.chunks = 0                 # 放入的片段数和实际渲染的次数，用于统计
+        self.flushes = 0
+        self._items = []                # [kind, [text, ...]]
+        self._backlog = 0
+        self._flush_pending = False
+        self._last_flush = 0.0
+        self._waiters = []              # 等待积压降下来的生产者 (loop, future)
+        self._lock = threading.Lock()
+
+    # 放入一个片段，可在任意线程调用；不等待
+    def push(self, kind, text):
+        with self._lock:
+            if self._items and self._items[-1][0] == kind:
+                self._items[-1][1].append(text)
+            else:
+                self._items.append([kind, [text]])
+            self._backlog += len(text)
+            self.chunks += 1
+            if self._flush_pending:
+                return
+            self._flush_pending = True
+        engine.dispatch(self._schedule)
+
+    # 在请求引擎的协程中放入片段；积压过多时等到下一次渲染
+    async def put(self, kind, text):
+        self.push(kind, text)
+        with self._lock:
+            if self._backlog <= self.max_backlog:
+                return
+            future = asyncio.get_running_loop().create_future()
+            self._waiters.append((future.get_loop(), future))
+        await future
+
+    # 立即渲染积压的片段(GUI线程)；直接写入显示内容之前先调用，保证先后顺序
+    def flush(self):
+        items, waiters = self._take()
+        self._last_flush = time.monotonic()
+        if items:
+            self.flushes += 1
+            self.render([(kind, "".join(parts)) for kind, parts in items])
+        _wake(waiters)
+
+    # 丢弃还没渲染的片段(显示内容被清空时)
+    def clear(self):
+        _wake(self._take()[1])
+
+    def _take(self):
+        with self._lock:
+            items, self._items = self._items, []
+            waiters, self._waiters = self._waiters, []
+            self._backlog = 0
+            self._flush_pending = False
+        return items, waiters
+
+    def _schedule(self):
+        delay = self._last_flush + self.interval - time.monotonic()
+        if self.scheduler is None or delay <= 0:
+            self.flush()
+        else:
+            self.scheduler(delay, self.flush)
+
+
+def _wake(waiters):
+    for loop, future in waiters:
+        try:
+            loop.call_soon_threadsafe(_set_done, future)
+        except RuntimeError:
+            pass  # 请求引擎已经停止
+
+
+def _set_done(future):
+    if not future.done():
+        future.set_result(None)
@@ -0,0 +1,185 @@
+import asyncio
+import contextlib
+import contextvars
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+# 在GUI线程中读取的请求参数快照，工作线程只使用这份不可变的数据，不再访问控件
+RequestParams = namedtuple(
+    "RequestParams",
+    ["model", "api_key", "model_path", "temperature", "max_tokens"],
+    defaults=("", None, 1.0, None),
+)
+
+_DONE = object()
+
+# 占着并发名额的任务(submit 提交的协程所在的任务)；子任务会继承这个值，所以要和当前任务比较
+_slot_owner = contextvars.ContextVar("slot_owner", default=None)
+
+
+# 所有模型请求共用的后台 asyncio 事件循环
+# 请求以可取消的任务运行，受全局并发上限约束；短的阻塞调用(SDK请求、缓存、编码)在线程池中执行，
+# 线程池的大小和并发上限无关(max_workers 为 None 时用 ThreadPoolExecutor 的默认值)；
+# 逐项读取的流各自占一个线程，长时间的生成不会占满线程池。结果通过 dispatcher(例如 QtBridge)统一转回GUI线程
+class RequestEngine:
+    def __init__(self, max_concurrency=4, max_workers=None):
+        self.max_concurrency = max_concurrency
+        self.max_workers = max_workers
+        self.dispatcher = None
+        self._loop = None
+        self._thread = None
+        self._semaphore = None
+        self._executor = None
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        with self._start_lock:
+            if self._loop is not None:
+                return
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="request")
+            self._loop = asyncio.new_event_loop()
+            ready = threading.Event()
+            self._thread = threading.Thread(target=self._run, args=(ready,), name="request-engine", daemon=True)
+            self._thread.start()
+            ready.wait()
+
+    def stop(self):
+        with self._start_lock:
+            if self._loop is None:
+                return
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop.close()
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._loop = None
+
+    # 提交一个协程，返回 concurrent.futures.Future，可在任意线程调用 cancel()
+    # 协程开始运行后被取消时由它自己处理 CancelledError；还在排队时就被取消则协程不会运行，改为分发 on_cancel
+    def submit(self, coro, on_cancel=None):
+        self.start()
+        claim = _StartClaim()
+        future = asyncio.run_coroutine_threadsafe(self._run_limited(coro, claim), self._loop)
+        if on_cancel is not None:
+            future.add_done_callback(
+                lambda f: f.cancelled() and claim.take("cancelled") and self.dispatch(on_cancel))
+        return future
+
+    # 在事件循环中调用 fn，可在任意线程中调用；用来把其他线程产生的数据交给正在运行的协程
+    def call_soon(self, fn, *args):
+        self.start()
+        self._loop.call_soon_threadsafe(fn, *args)
+
+    # 把回调交给GUI线程执行；没有设置 dispatcher 时直接调用(无界面的脚本)
+    def dispatch(self, callback, *args):
+        if self.dispatcher is None:
+            callback(*args)
+        else:
+            self.dispatcher(callback, args)
+
+    # 在线程池中执行阻塞调用
+    # 任务在调用返回前被取消时，调用的结果(例如已打开的HTTP流)会在返回后被关闭
+    async def run_blocking(self, fn, *args, **kwargs):
+        future = self._executor.submit(fn, *args, **kwargs)
+        try:
+            return await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            future.add_done_callback(_close_result)
+            raise
+
+    # 在这个流自己的线程中逐项迭代一个阻塞的迭代器(生成器、SDK的流)
+    # 任务被取消时，等正在进行的 next() 返回后再在同一个线程中关闭迭代器，生成器中的 finally 会被执行；
+    # abort 会在取消时立即在单独的线程中调用，用来打断正在阻塞的读取(例如关闭HTTP响应、让本地生成停下)；
+    # 取消时下一个 next() 可能还在排队、没有开始，这时也要调用 abort，否则HTTP响应要等到被回收时才关闭
+    async def iterate(self, make_iterator, *args, abort=None, **kwargs):
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="stream")
+        pending = executor.submit(lambda: iter(make_iterator(*args, **kwargs)))
+        iterator = None
+        try:
+            iterator = await asyncio.wrap_future(pending)
+            while True:
+                pending = executor.submit(next, iterator, _DONE)
+                item = await asyncio.wrap_future(pending)
+                if item is _DONE:
+                    return
+                yield item
+        except asyncio.CancelledError:
+            if abort is not None:
+                threading.Thread(target=abort, daemon=True).start()
+            raise
+        finally:
+            # 单个线程按提交的顺序执行，close 一定在正在进行的 next() 之后
+            if iterator is None:
+                pending.add_done_callback(_close_result)
+            elif getattr(iterator, "close", None) is not None:
+                executor.submit(iterator.close)
+            executor.shutdown(wait=False)
+
+    # 在长时间的等待(例如排队等待限流)期间让出并发名额，等待结束后重新占用
+    # 只有占着名额的任务才会让出；请求内部并发的子任务(对冲、分段、边录边转写)共用父任务的名额，在子任务中什么都不做
+    @contextlib.asynccontextmanager
+    async def idle(self):
+        if _slot_owner.get() is not asyncio.current_task():
+            yield
+            return
+        self._semaphore.release()
+        token = _slot_owner.set(None)   # 让出期间嵌套的 idle() 不再释放
+        try:
+            yield
+        finally:
+            _slot_owner.reset(token)
+            reacquire = asyncio.ensure_future(self._semaphore.acquire())
+            cancelled = False
+            while True:
+                try:
+                    await asyncio.shield(reacquire)
+                    break
+                except asyncio.CancelledError:
+                    cancelled = True  # 先重新占用名额，退出时 _run_limited 释放的才是自己的名额
+            if cancelled:
+                raise asyncio.CancelledError()
+
+    def _run(self, ready):
+        asyncio.set_event_loop(self._loop)
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._loop.call_soon(ready.set)
+        self._loop.run_forever()
+        # 停止时取消还没结束的任务，给它们最多 5 秒收尾(例如把进行中的任务状态写回数据库)
+        tasks = asyncio.all_tasks(self._loop)
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            self._loop.run_until_complete(asyncio.wait(tasks, timeout=5))
+
+    async def _run_limited(self, coro, claim):
+        try:
+            async with self._semaphore:
+                if claim.take("started"):
+                    _slot_owner.set(asyncio.current_task())
+                    return await coro
+        finally:
+            coro.close()  # 排队时就被取消的协程从未运行过
+
+
+# 记录任务是先开始运行还是先被取消，两者只有一个会成立
+class _StartClaim:
+    def __init__(self):
+        self.state = None
+        self._lock = threading.Lock()
+
+    def take(self, state):
+        with self._lock:
+            if self.state is None:
+                self.state = state
+            return self.state == state
+
+
+def _close_result(future):
+    if not future.cancelled() and future.exception() is None:
+        close = getattr(future.result(), "close", None)
+        if close is not None:
+            close()
+
+
+# 全局共享的请求引擎
+engine = RequestEngine()
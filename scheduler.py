@@ -0,0 +1,186 @@
+import asyncio
+import random
+import threading
+import time
+from collections import OrderedDict, deque
+
+from context_window import estimate_message_tokens
+from key_pool import is_key_error, key_pool
+from openai_client import get_client
+from request_engine import engine
+
+# 优先级：数字越小越先调度
+PRIORITY_INTERACTIVE = 0  # 用户在标签页中主动发送的请求
+PRIORITY_BACKGROUND = 1   # 剪贴板翻译等后台请求
+DEFAULT_REPLY_TOKENS = 512  # 没有设置 max_tokens 时按这个回复长度预估
+
+
+# 预估一次对话请求消耗的token数(提示词 + 回复)，用于token限流
+def request_tokens(messages, max_tokens=None):
+    return sum(estimate_message_tokens(message) for message in messages) + (max_tokens or DEFAULT_REPLY_TOKENS)
+
+
+# 每个模型的等待队列
+# 队列按优先级分组，同一优先级内在各个来源(标签页、小窗口)之间轮流调度，同一来源内先到先得
+class _ModelQueue:
+    def __init__(self, model):
+        self.model = model
+        self.classes = {}  # priority -> OrderedDict(owner -> deque of (future, tokens, enqueued))
+        self.timer = None
+
+    def head(self):
+        for priority in sorted(self.classes):
+            owners = self.classes[priority]
+            for owner, waiters in list(owners.items()):
+                while waiters and waiters[0][0].done():
+                    waiters.popleft()  # 已取消的等待者
+                if waiters:
+                    return priority, owner
+                del owners[owner]
+            del self.classes[priority]
+        return None
+
+    def pop(self, priority, owner):
+        owners = self.classes[priority]
+        waiter = owners[owner].popleft()
+        if owners[owner]:
+            owners.move_to_end(owner)  # 轮到下一个来源
+        else:
+            del owners[owner]
+        if not owners:
+            del self.classes[priority]
+        return waiter
+
+
+# 全进程共享的请求调度器：所有标签页和小窗口的模型请求按优先级和来源公平排队，
+# 放行时分配给密钥池中剩余额度最多的密钥(每个密钥分别按模型限流)；
+# 遇到429时暂停该密钥一段带抖动的退避时间后重试，认证失败或额度用完的密钥被隔离，请求换一个密钥重试
+# 调度在请求引擎的事件循环中进行，等待期间不占用引擎的并发名额
+class RequestScheduler:
+    def __init__(self):
+        self.limits = {}  # model -> 每个密钥的 (rpm, tpm)
+        self.max_retries = 4
+        self.backoff_base = 1.0
+        self.backoff_max = 30.0
+        self._queues = {}
+        self._depth = 0
+        self._waits = deque(maxlen=100)
+        self._lock = threading.Lock()
+
+    def configure(self, limits=None, max_retries=None, backoff_base=None, backoff_max=None):
+        if limits is not None:
+            with self._lock:
+                self.limits = {model.lower(): limit for model, limit in limits.items()}
+                self._queues.clear()
+        if max_retries is not None:
+            self.max_retries = max_retries
+        if backoff_base is not None:
+            self.backoff_base = backoff_base
+        if backoff_max is not None:
+            self.backoff_max = backoff_max
+
+    # 排队等待向 model 发送一个约 tokens 个token的请求，返回分配到的密钥
+    async def acquire(self, model, tokens=0, priority=PRIORITY_INTERACTIVE, owner=None):
+        queue = self._queue(model)
+        future = asyncio.get_running_loop().create_future()
+        enqueued = time.monotonic()
+        queue.classes.setdefault(priority, OrderedDict()).setdefault(owner, deque()).append(
+            (future, tokens, enqueued))
+        self._set_depth(1)
+        try:
+            self._dispatch(queue)
+            if not future.done():
+                async with engine.idle():
+                    await future
+            with self._lock:
+                self._waits.append(time.monotonic() - enqueued)
+            return future.result()
+        finally:
+            self._set_depth(-1)
+            if not future.done():
+                future.cancel()
+                self._dispatch(queue)  # 被取消的等待者可能挡在队首
+
+    # 排队后用分配到的密钥对应的客户端在线程池中执行 fn(client, *args, **kwargs)
+    # 遇到429时退避并重新排队；密钥失效时隔离它并换一个密钥重试
+    # api_key 只在没有配置密钥池时使用
+    async def call(self, model, fn, /, *args, api_key=None, tokens=0, priority=PRIORITY_INTERACTIVE, owner=None,
+                   **kwargs):
+        import openai  # 第一次请求时才加载 SDK
+
+        key_pool.ensure(api_key)
+        attempt = 0
+        while True:
+            key = await self.acquire(model, tokens, priority, owner)
+            try:
+                return await engine.run_blocking(fn, get_client(key.key, key.base_url), *args, **kwargs)
+            except openai.APIStatusError as e:
+                if is_key_error(e):
+                    key_pool.quarantine(key, str(e))
+                    if key_pool.status()[0] == 0:
+                        raise
+                elif isinstance(e, openai.RateLimitError) and attempt < self.max_retries:
+                    key_pool.pause(key, self._backoff(attempt, e))
+                    attempt += 1
+                else:
+                    raise
+
+    def queue_depth(self):
+        with self._lock:
+            return self._depth
+
+    # 最近若干个请求的平均排队时间(秒)
+    def average_wait(self):
+        with self._lock:
+            return sum(self._waits) / len(self._waits) if self._waits else 0.0
+
+    def _queue(self, model):
+        model = model.lower()
+        with self._lock:
+            queue = self._queues.get(model)
+            if queue is None:
+                queue = _ModelQueue(model)
+                self._queues[model] = queue
+            return queue
+
+    # 按顺序放行队首的等待者，直到没有密钥还有额度；没有额度时定时器到点后再继续
+    def _dispatch(self, queue):
+        if queue.timer is not None:
+            queue.timer.cancel()
+            queue.timer = None
+        while True:
+            head = queue.head()
+            if head is None:
+                return
+            future, tokens, _ = queue.classes[head[0]][head[1]][0]
+            key, wait = key_pool.choose(queue.model, tokens, self.limits, time.monotonic())
+            if key is None and wait is None:
+                queue.pop(*head)
+                future.set_exception(RuntimeError("No usable API key: all keys are quarantined or none is configured"))
+                continue
+            if key is None:
+                queue.timer = asyncio.get_running_loop().call_later(wait, self._dispatch, queue)
+                return
+            queue.pop(*head)
+            future.set_result(key)
+
+    def _set_depth(self, delta):
+        with self._lock:
+            self._depth += delta
+
+    # 优先使用服务器给出的 Retry-After，否则按指数退避并加上随机抖动
+    def _backoff(self, attempt, error):
+        retry_after = None
+        response = getattr(error, "response", None)
+        if response is not None:
+            try:
+                retry_after = float(response.headers.get("retry-after", ""))
+            except ValueError:
+                retry_after = None
+        if retry_after is not None and 0 < retry_after <= self.backoff_max:
+            return retry_after + random.uniform(0, self.backoff_base)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+
+# 全局共享的请求调度器
+scheduler = RequestScheduler()
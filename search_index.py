@@ -0,0 +1,214 @@
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+# 建索引的角色；提示和错误信息不建索引
+INDEXED_ROLES = ("user", "gpt", "translation")
+
+# 中日韩文字没有空格分词，连续的一段按两个字一组(bigram)建索引
+CJK_RUN = re.compile("[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af\uff66-\uff9f]+")
+
+# source 为来源(标签页标题或 "Widget")，tab 和 index 为消息所在的标签页编号(session_store)和下标，不能跳转时 tab 为 None
+SearchHit = namedtuple("SearchHit", ["id", "source", "tab", "index", "role", "text", "time", "snippet"])
+
+
+# 建索引用的文字：中日韩文字的每一段换成相邻两字的组，再加上最后一个字，
+# 这样每个字都是某个词的开头，单字查询可以用前缀匹配
+def index_text(text):
+    return CJK_RUN.sub(lambda match: " " + " ".join(_bigrams(match.group()) + [match.group()[-1]]) + " ", text)
+
+
+# 查询用的词：中日韩文字的一段换成相邻两字的组；单字保留，查询时按前缀匹配
+def query_tokens(term):
+    return CJK_RUN.sub(lambda match: " " + " ".join(_bigrams(match.group()) or [match.group()]) + " ", term).split()
+
+
+def _bigrams(run):
+    return [run[i:i + 2] for i in range(len(run) - 1)]
+
+
+# 把用户输入转成 FTS5 查询：每个空格分开的词作为一个短语，全部词都要出现；
+# 最后一个词按前缀匹配(边输入边搜索)，以单个中日韩字结尾的词也按前缀匹配
+def fts_query(query):
+    terms = query.split()
+    phrases = []
+    for i, term in enumerate(terms):
+        tokens = query_tokens(term)
+        if not tokens:
+            continue
+        phrase = '"' + " ".join(tokens).replace('"', '""') + '"'
+        if i == len(terms) - 1 or CJK_RUN.fullmatch(tokens[-1]) and len(tokens[-1]) == 1:
+            phrase += " *"
+        phrases.append(phrase)
+    return " ".join(phrases)
+
+
+# 消息中第一个匹配的词附近的一段文字
+def make_snippet(text, query, width=80):
+    text = " ".join(text.split())
+    lowered = text.lower()
+    positions = [lowered.find(term.lower()) for term in query.split()]
+    positions = [position for position in positions if position >= 0]
+    start = max(0, min(positions) - width // 4) if positions else 0
+    snippet = text[start:start + width]
+    return ("…" if start else "") + snippet + ("…" if start + width < len(text) else "")
+
+
+# 全部聊天和翻译记录的全文索引(SQLite FTS5)
+# 原文存在 messages 表中，FTS 表只存分好词的索引(contentless)；中日韩文字按 bigram 分词，另有单字前缀索引
+# add() 在GUI线程中调用，只把消息放进队列；后台线程成批写入，一批一个事务。search() 可以在任意线程调用
+# 相关度排序只在最新的 candidates 条匹配中进行：常见的词能匹配几十万条消息，对全部匹配计算 bm25 要上百毫秒
+class SearchIndex:
+    def __init__(self, path="cache/search.db", enabled=True, candidates=1000):
+        self.path = path
+        self.enabled = enabled
+        self.candidates = candidates
+        self.error = None       # 最近一次写入失败的异常
+        self._pending = []      # ("add", row) 或 ("detach", tab)
+        self._submitted = 0
+        self._written = 0
+        self._stopping = False
+        self._thread = None
+        self._cond = threading.Condition()
+        self._conn = None       # 查询用的连接，写入在后台线程中另开连接
+        self._lock = threading.Lock()
+
+    def configure(self, path=None, enabled=None, candidates=None):
+        if path is not None and path != self.path:
+            self.close()
+            self.path = path
+        if enabled is not None:
+            self.enabled = enabled
+        if candidates is not None:
+            self.candidates = max(1, candidates)
+
+    # 一个标签页或小窗口的消息来源；关闭了搜索时返回 None
+    def source(self, name, tab=None):
+        return SearchSource(self, name, tab) if self.enabled else None
+
+    def add(self, source, tab, index, role, text):
+        self._submit(("add", (source, tab, index, role, text, time.time())))
+
+    # 标签页被清空或关闭后，它以前的消息仍然可以搜索到，但不能再跳转
+    def detach(self, tab):
+        self._submit(("detach", tab))
+
+    # 等待已经放入队列的消息写入
+    def flush(self, timeout=10):
+        with self._cond:
+            target = self._submitted
+            return self._cond.wait_for(lambda: self._written >= target or self._thread is None, timeout)
+
+    # 按相关度(bm25)排序返回最多 limit 条结果
+    def search(self, query, limit=50):
+        expression = fts_query(query)
+        if not expression:
+            return []
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT m.id, m.source, m.tab, m.idx, m.role, m.text, m.time FROM "
+                "(SELECT rowid, rank FROM messages_fts WHERE messages_fts MATCH ? ORDER BY rowid DESC LIMIT ?) hits "
+                "JOIN messages m ON m.id = hits.rowid ORDER BY hits.rank LIMIT ?",
+                (expression, self.candidates, limit)).fetchall()
+        return [SearchHit(*row, make_snippet(row[5], query)) for row in rows]
+
+    def count(self):
+        with self._lock:
+            return self._connect().execute("SELECT count(*) FROM messages").fetchone()[0]
+
+    # 写完队列中的消息后停止后台线程
+    def close(self):
+        with self._cond:
+            thread = self._thread
+            self._stopping = True
+            self._cond.notify()
+        if thread is not None:
+            thread.join()
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def _submit(self, item):
+        with self._cond:
+            self._pending.append(item)
+            self._submitted += 1
+            if self._thread is None:
+                self._stopping = False
+                self._thread = threading.Thread(target=self._run, name="search-index", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def _run(self):
+        conn = self._open()
+        try:
+            while True:
+                with self._cond:
+                    while not (self._pending or self._stopping):
+                        self._cond.wait()
+                    batch, self._pending = self._pending, []
+                    target = self._submitted
+                    stopping = self._stopping
+                try:
+                    with conn:
+                        for kind, value in batch:
+                            if kind == "add":
+                                cursor = conn.execute(
+                                    "INSERT INTO messages (source, tab, idx, role, text, time) VALUES (?, ?, ?, ?, ?, ?)",
+                                    value)
+                                conn.execute("INSERT INTO messages_fts (rowid, body) VALUES (?, ?)",
+                                             (cursor.lastrowid, index_text(value[4])))
+                            else:
+                                conn.execute("UPDATE messages SET tab = NULL WHERE tab = ?", (value,))
+                except sqlite3.Error as e:
+                    self.error = e  # 写不进去的消息丢弃，不影响界面
+                with self._cond:
+                    self._written = target
+                    self._cond.notify_all()
+                    if stopping and not self._pending:
+                        self._thread = None
+                        return
+        finally:
+            conn.close()
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn = self._open()
+        return self._conn
+
+    def _open(self):
+        folder = os.path.dirname(self.path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder, exist_ok=True)
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY, source TEXT NOT NULL, tab INTEGER, "
+                     "idx INTEGER NOT NULL, role TEXT NOT NULL, text TEXT NOT NULL, time REAL NOT NULL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS messages_tab ON messages (tab) WHERE tab IS NOT NULL")
+        conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(body, content='', prefix='1', "
+                     "tokenize='unicode61 remove_diacritics 2')")
+        conn.commit()
+        return conn
+
+
+# 一个标签页(或小窗口)写入索引的入口，由 Transcript 在每条消息完整之后调用
+class SearchSource:
+    def __init__(self, index, name, tab=None):
+        self.index = index
+        self.name = name
+        self.tab = tab
+
+    def add(self, index, role, text):
+        if role in INDEXED_ROLES and text:
+            self.index.add(self.name, self.tab, index, role, text)
+
+    def detach(self):
+        if self.tab is not None:
+            self.index.detach(self.tab)
+
+
+search_index = SearchIndex()
@@ -0,0 +1,98 @@
+import time
+
+from PySide6 import QtCore, QtWidgets
+from PySide6.QtCore import Signal, Slot
+
+from request_engine import engine
+from transcript import PREFIXES
+
+SEARCH_DELAY_MS = 150   # 停止输入这么久之后才搜索
+
+
+# 搜索全部聊天和翻译记录的窗口：边输入边搜索，查询在后台线程中执行
+# 双击结果发出 message_selected(标签页编号, 消息下标)；已关闭或清空的标签页中的消息只显示，不能跳转
+class SearchPanel(QtWidgets.QWidget):
+    message_selected = Signal(object, int)
+
+    def __init__(self, index, limit=100, parent=None):
+        super().__init__(parent, QtCore.Qt.Window)
+        self.index = index
+        self.limit = limit
+        self.generation = 0     # 每次搜索加一，丢弃过期的结果
+        self.setWindowTitle("Search History")
+        self.resize(600, 400)
+        self.setStyleSheet("background-color: white;")
+
+        self.query_input = QtWidgets.QLineEdit(self)
+        self.query_input.setPlaceholderText("Search all chats and translations")
+        self.results = QtWidgets.QListWidget(self)
+        self.results.setWordWrap(True)
+        self.status_label = QtWidgets.QLabel(self)
+        self.status_label.setStyleSheet("color: grey;")
+
+        self.layout = QtWidgets.QVBoxLayout(self)
+        self.layout.addWidget(self.query_input)
+        self.layout.addWidget(self.results)
+        self.layout.addWidget(self.status_label)
+
+        self.search_timer = QtCore.QTimer(self)
+        self.search_timer.setSingleShot(True)
+        self.search_timer.setInterval(SEARCH_DELAY_MS)
+        self.search_timer.timeout.connect(self.search)
+        self.query_input.textChanged.connect(self.search_timer.start)
+        self.query_input.returnPressed.connect(self.search)
+        self.results.itemActivated.connect(self.open_result)
+
+    def show_panel(self):
+        self.show()
+        self.raise_()
+        self.activateWindow()
+        self.query_input.setFocus()
+        self.query_input.selectAll()
+
+    @Slot()
+    def search(self):
+        self.search_timer.stop()
+        self.generation += 1
+        query = self.query_input.text().strip()
+        if not query:
+            self.results.clear()
+            self.status_label.clear()
+            return
+        engine.submit(self.run_search(query, self.generation))
+
+    async def run_search(self, query, generation):
+        started = time.monotonic()
+        try:
+            hits = await engine.run_blocking(self.index.search, query, self.limit)
+        except Exception as e:
+            engine.dispatch(self.show_error, generation, e)
+            return
+        engine.dispatch(self.show_results, generation, hits, time.monotonic() - started)
+
+    def show_results(self, generation, hits, elapsed):
+        if generation != self.generation:
+            return
+        self.results.clear()
+        for hit in hits:
+            when = time.strftime("%Y-%m-%d %H:%M", time.localtime(hit.time))
+            item = QtWidgets.QListWidgetItem(f"{hit.source} · {when}\n{PREFIXES[hit.role]}{hit.snippet}")
+            item.setData(QtCore.Qt.UserRole, (hit.tab, hit.index))
+            if hit.tab is None:
+                item.setForeground(QtCore.Qt.gray)
+            self.results.addItem(item)
+        more = "+" if len(hits) >= self.limit else ""
+        self.status_label.setText(f"{len(hits)}{more} results in {elapsed * 1000:.0f} ms")
+
+    def show_error(self, generation, error):
+        if generation == self.generation:
+            self.results.clear()
+            self.status_label.setText(f"Error: {str(error)}")
+
+    @Slot(QtWidgets.QListWidgetItem)
+    def open_result(self, item):
+        tab, index = item.data(QtCore.Qt.UserRole)
+        if tab is None:
+            self.status_label.setText("This message is no longer shown in an open tab.")
+            return
+        self.message_selected.emit(tab, index)
@@ -0,0 +1,85 @@
+import re
+from collections import namedtuple
+
+from context_window import estimate_tokens
+
+# 一段待翻译的文本；separator 是原文中这段之后的空白(段落之间的空行、句子之间的空格)，拼接译文时原样保留
+Segment = namedtuple("Segment", ["text", "separator"])
+
+PARAGRAPH_BREAK = re.compile(r"(\n[ \t]*\n\s*)")
+# 句子结尾：西文的 .!?; 之后要有空白，中日韩的句末标点之后不需要空白；句末的引号和括号算在句子里
+SENTENCE_END = re.compile(r"""((?:[.!?;]+["'”’)\]]*\s+)|(?:[。！？；…]+[”’」』）)\]]*\s*)|(?:\n\s*))""")
+
+
+# 把长文本切成每段不超过 max_tokens 的片段
+# 先按段落切，过长的段落再按句子切，过长的句子按字数硬切；相邻的小段落合并成一段，减少请求次数
+def split_segments(text, max_tokens=800):
+    units = []
+    for paragraph, separator in _split_keep(PARAGRAPH_BREAK, text):
+        if estimate_tokens(paragraph) <= max_tokens:
+            units.append((paragraph, separator))
+            continue
+        sentences = _split_keep(SENTENCE_END, paragraph)
+        sentences[-1] = (sentences[-1][0], sentences[-1][1] + separator)
+        for sentence, sentence_separator in sentences:
+            pieces = _hard_split(sentence, max_tokens)
+            units.extend((piece, "") for piece in pieces[:-1])
+            units.append((pieces[-1], sentence_separator))
+
+    segments = []
+    text_parts = []
+    tokens = 0
+    for unit, separator in units:
+        unit_tokens = estimate_tokens(unit + separator)
+        if text_parts and tokens + unit_tokens > max_tokens:
+            segments.append(_make_segment(text_parts))
+            text_parts = []
+            tokens = 0
+        text_parts.append(unit + separator)
+        tokens += unit_tokens
+    if text_parts:
+        segments.append(_make_segment(text_parts))
+    return segments
+
+
+# 把 Segment 列表和对应的译文按原文的分隔重新拼成全文
+def join_segments(segments, translations):
+    return "".join(translation + segment.separator for segment, translation in zip(segments, translations)).rstrip()
+
+
+# 按正则切分，返回 (文本, 之后的分隔符) 的列表，丢弃只有空白的文本
+def _split_keep(pattern, text):
+    parts = pattern.split(text)
+    result = []
+    for i in range(0, len(parts), 2):
+        piece = parts[i]
+        separator = parts[i + 1] if i + 1 < len(parts) else ""
+        if piece.strip():
+            result.append((piece, separator))
+        elif result:
+            result[-1] = (result[-1][0], result[-1][1] + piece + separator)
+    return result or [(text, "")]
+
+
+# 按 estimate_tokens 的规则逐字累计token数，超过上限就切开
+def _hard_split(text, max_tokens):
+    pieces = []
+    start = 0
+    wide = narrow = 0
+    for i, ch in enumerate(text):
+        if ord(ch) >= 0x2E80:
+            wide += 1
+        else:
+            narrow += 1
+        if i > start and wide + (narrow + 3) // 4 > max_tokens:
+            pieces.append(text[start:i])
+            start = i
+            wide, narrow = (1, 0) if ord(ch) >= 0x2E80 else (0, 1)
+    pieces.append(text[start:])
+    return pieces
+
+
+def _make_segment(text_parts):
+    joined = "".join(text_parts)
+    stripped = joined.rstrip()
+    return Segment(stripped, joined[len(stripped):])
@@ -0,0 +1,330 @@
+import glob
+import gzip
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+
+from transcript import PREFIXES
+
+# 导出为 Markdown 时各角色的标题，None 表示不加标题(提示信息用斜体)
+MARKDOWN_TITLES = {"user": "You", "gpt": "GPT", "translation": "Translation", "error": "Error", "notice": None}
+
+
+# 一个会话(标签页)的日志：每条消息和流式回复的每一帧追加为一行JSON，另有时间、模型、参数和耗时
+# record() 可在任意线程调用，只把记录交给写线程；文件超过 max_bytes 后换新文件，旧文件按需压缩
+class SessionJournal:
+    def __init__(self, writer, path, max_bytes=16 * 1024 * 1024, compress=False):
+        self.writer = writer
+        self.path = path
+        self.max_bytes = max_bytes
+        self.compress = compress
+        self.error = None       # 最近一次写入失败的异常
+        # 换下来的旧文件，从早到晚；继续写恢复的标签页的日志时沿用已有的
+        self._parts = sorted(glob.glob(glob.escape(os.path.splitext(path)[0]) + ".[0-9][0-9][0-9].jsonl*"))
+        self._file = None
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def record(self, event, **fields):
+        line = json.dumps(dict(event=event, time=round(time.time(), 3), **fields), ensure_ascii=False)
+        self.writer.submit(self, line)
+
+    # 日志的全部文件，从早到晚
+    def paths(self):
+        with self._lock:
+            return self._parts + [self.path]
+
+    # 等待已经记录的内容写入磁盘
+    def flush(self, timeout=10):
+        return self.writer.flush(timeout)
+
+    # 写完已经记录的内容后关闭文件
+    def close(self):
+        self.writer.submit(self, None)
+
+    # 以下在写线程中调用
+    def _write(self, lines):
+        if self._file is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._file = open(self.path, "ab")
+            self._size = self._file.tell()
+        data = "".join(line + "\n" for line in lines).encode("utf-8")
+        self._file.write(data)
+        self._size += len(data)
+        if self.max_bytes and self._size >= self.max_bytes:
+            self._rotate()
+
+    def _rotate(self):
+        self._close()
+        with self._lock:
+            part = f"{os.path.splitext(self.path)[0]}.{len(self._parts) + 1:03d}.jsonl"
+            os.replace(self.path, part)
+            self._parts.append(part)
+        if self.compress:
+            with open(part, "rb") as source, gzip.open(part + ".gz", "wb") as target:
+                shutil.copyfileobj(source, target)
+            with self._lock:
+                self._parts[-1] = part + ".gz"
+            os.remove(part)
+
+    def _sync(self):
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def _close(self):
+        if self._file is not None:
+            self._sync()
+            self._file.close()
+            self._file = None
+
+
+# 所有会话日志共用的后台写线程：GUI线程只把记录放进队列，写线程成批写入，最多每 fsync_interval 秒 fsync 一次
+class JournalWriter:
+    def __init__(self, folder="cache/sessions", enabled=True, max_bytes=16 * 1024 * 1024, compress=False,
+                 fsync_interval=1.0):
+        self.folder = folder
+        self.enabled = enabled
+        self.max_bytes = max_bytes
+        self.compress = compress
+        self.fsync_interval = fsync_interval
+        self._pending = []          # (journal, line)，line 为 None 表示关闭这个日志
+        self._submitted = 0         # 放入队列的记录数和已经 fsync 的记录数，flush() 据此等待
+        self._synced = 0
+        self._sync_requested = False
+        self._stopping = False
+        self._thread = None
+        self._cond = threading.Condition()
+
+    def configure(self, folder=None, enabled=None, max_bytes=None, compress=None, fsync_interval=None):
+        if folder is not None:
+            self.folder = folder
+        if enabled is not None:
+            self.enabled = enabled
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+        if compress is not None:
+            self.compress = compress
+        if fsync_interval is not None:
+            self.fsync_interval = fsync_interval
+
+    # 为一个新会话创建日志文件，给出 path 时接着写这个日志(恢复的标签页)；关闭了会话日志时返回 None
+    def open_session(self, path=None):
+        if not self.enabled:
+            return None
+        if path is None:
+            name = f"session-{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}.jsonl"
+            path = os.path.join(self.folder, name)
+        return SessionJournal(self, path, self.max_bytes, self.compress)
+
+    def submit(self, journal, line):
+        with self._cond:
+            self._pending.append((journal, line))
+            self._submitted += 1
+            if self._thread is None:
+                self._stopping = False
+                self._thread = threading.Thread(target=self._run, name="session-journal", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    # 等待目前为止放入队列的记录写入并 fsync，超时返回 False
+    def flush(self, timeout=10):
+        with self._cond:
+            target = self._submitted
+            self._sync_requested = True
+            self._cond.notify()
+            return self._cond.wait_for(lambda: self._synced >= target or self._thread is None, timeout)
+
+    # 程序退出时：写完队列中的记录，fsync 并关闭所有文件
+    def close(self):
+        with self._cond:
+            thread = self._thread
+            self._stopping = True
+            self._cond.notify()
+        if thread is not None:
+            thread.join()
+
+    def _run(self):
+        journals = set()   # 打开着的日志和其中写入后还没有 fsync 的
+        dirty = set()
+        last_sync = time.monotonic()
+        while True:
+            with self._cond:
+                while not (self._pending or self._sync_requested or self._stopping):
+                    if not dirty:
+                        self._cond.wait()
+                        continue
+                    remaining = last_sync + self.fsync_interval - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch, self._pending = self._pending, []
+                target = self._submitted
+                sync = self._sync_requested or self._stopping
+                self._sync_requested = False
+                stopping = self._stopping
+
+            lines = {}
+            for journal, line in batch:
+                lines.setdefault(journal, []).append(line)
+            for journal, journal_lines in lines.items():
+                closing = journal_lines[-1] is None
+                journal_lines = [line for line in journal_lines if line is not None]
+                try:
+                    if journal_lines:
+                        journal._write(journal_lines)
+                    if closing:
+                        journal._close()
+                except OSError as e:
+                    journal.error = e  # 写不进去的记录丢弃，不影响界面
+                if closing:
+                    journals.discard(journal)
+                    dirty.discard(journal)
+                else:
+                    journals.add(journal)
+                    dirty.add(journal)
+
+            if sync or time.monotonic() - last_sync >= self.fsync_interval:
+                for journal in dirty:
+                    try:
+                        journal._sync()
+                    except OSError as e:
+                        journal.error = e
+                dirty.clear()
+                last_sync = time.monotonic()
+                with self._cond:
+                    self._synced = target
+                    self._cond.notify_all()
+            if stopping:
+                for journal in journals:
+                    try:
+                        journal._close()
+                    except OSError as e:
+                        journal.error = e
+                journals.clear()
+                dirty.clear()
+                with self._cond:
+                    if self._pending:
+                        continue  # 关闭期间又有新的记录
+                    self._thread = None
+                    self._cond.notify_all()
+                return
+
+
+journal_writer = JournalWriter()
+
+
+# 逐行读取日志中的记录，支持压缩过的旧文件；程序崩溃时写了一半的最后一行被跳过
+def read_events(paths):
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+
+# 把记录还原成按顺序排列的消息：{"role", "text", "time", 以及模型、参数、耗时等}
+# 交错输出的流式消息等到它前面的消息都结束后才产出；内存中只保留还没结束的消息
+def iter_messages(events):
+    pending = {}    # index -> (message, [text, ...])
+    next_index = 0
+    for event in events:
+        kind = event.get("event")
+        if kind in ("message", "start"):
+            message = {key: value for key, value in event.items() if key not in ("event", "index", "text")}
+            message["complete"] = kind == "message"
+            pending[event["index"]] = (message, [event.get("text", "")])
+        elif kind == "append" and event["index"] in pending:
+            pending[event["index"]][1].append(event["text"])
+        elif kind == "end" and event["index"] in pending:
+            message = pending[event["index"]][0]
+            message.update((key, value) for key, value in event.items() if key not in ("event", "index", "time"))
+            message["finished"] = event["time"]
+            message["complete"] = True
+        elif kind == "clear":
+            # 清空之后消息重新从 0 编号
+            yield from _drain(pending, next_index, True)
+            pending.clear()
+            next_index = 0
+            continue
+        for message in _drain(pending, next_index, False):
+            next_index += 1
+            yield message
+    yield from _drain(pending, next_index, True)
+
+
+def _drain(pending, index, everything):
+    if everything:
+        indexes = sorted(i for i in pending if i >= index)
+    else:
+        indexes = []
+        while index in pending and pending[index][0]["complete"]:
+            indexes.append(index)
+            index += 1
+    for i in indexes:
+        message, parts = pending.pop(i)
+        del message["complete"]
+        message["text"] = "".join(parts)
+        yield message
+
+
+# 导出格式由文件扩展名决定：.md 为 Markdown，.json 为JSON数组，其他为和聊天记录相同的纯文本
+def export_format(path):
+    extension = os.path.splitext(path)[1].lower()
+    return {".md": "markdown", ".markdown": "markdown", ".json": "json"}.get(extension, "txt")
+
+
+# 逐条写出消息，不在内存中拼出整个文件
+def export_messages(messages, path, fmt=None):
+    fmt = fmt or export_format(path)
+    with open(path, "w", encoding="utf-8") as f:
+        if fmt == "json":
+            f.write("[")
+            for i, message in enumerate(messages):
+                f.write(("," if i else "") + "\n" + json.dumps(message, ensure_ascii=False))
+            f.write("\n]\n")
+            return
+        for message in messages:
+            if fmt == "markdown":
+                f.write(markdown_message(message))
+            else:
+                f.write(f"{PREFIXES[message['role']]}{message['text']}\n\n")
+
+
+# 从会话日志导出标签页中现在显示的内容(最后一次清空之后的消息)，在后台线程中调用
+def export_session(paths, path, fmt=None):
+    export_messages(iter_messages(since_last_clear(paths)), path, fmt)
+
+
+# 先数出清空的次数，第二遍跳过最后一次清空之前的记录；两遍都是逐行读取
+def since_last_clear(paths):
+    clears = sum(1 for event in read_events(paths) if event.get("event") == "clear")
+    for event in read_events(paths):
+        if clears == 0:
+            yield event
+        elif event.get("event") == "clear":
+            clears -= 1
+
+
+def markdown_message(message):
+    title = MARKDOWN_TITLES[message["role"]]
+    if title is None:
+        return f"*{message['text']}*\n\n"
+    details = []
+    if "time" in message:
+        details.append(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(message["time"])))
+    if message.get("model"):
+        details.append(message["model"])
+    latency = message.get("latency_ms")
+    if latency is not None:
+        details.append(f"{latency} ms" if latency < 1000 else f"{latency / 1000:.1f} s")
+    heading = " · ".join([f"**{title}**"] + details)
+    return f"{heading}\n\n{message['text']}\n\n"
@@ -0,0 +1,101 @@
+import json
+import os
+import sqlite3
+from collections import namedtuple
+
+from transcript import MESSAGES_TABLE, MessageArchive
+
+# 保存的标签页：settings 为模型、参数、语言和风格，journal 为会话日志的路径，count 为聊天记录的消息数
+SavedTab = namedtuple("SavedTab", ["id", "title", "settings", "journal", "count", "current"])
+
+
+# 退出时打开着的标签页保存在SQLite中，下次启动时恢复
+# 每个标签页创建时就分到一个编号，聊天记录移出内存的消息直接存进这里的 messages 表，退出时只需写入内存中剩下的部分；
+# 启动时只读出标签页列表，对话历史在标签页第一次显示时才读出，聊天记录按需逐条读取。只在GUI线程中使用
+class SessionStore:
+    def __init__(self, path="cache/tabs.db", enabled=True):
+        self.path = path
+        self.enabled = enabled
+        self._conn = None
+
+    def configure(self, path=None, enabled=None):
+        if path is not None and path != self.path:
+            self.close()
+            self.path = path
+        if enabled is not None:
+            self.enabled = enabled
+
+    # 上次退出时保存的标签页，按顺序排列
+    def tabs(self):
+        rows = self._connect().execute(
+            "SELECT id, title, settings, journal, count, current FROM tabs WHERE position IS NOT NULL "
+            "ORDER BY position").fetchall()
+        return [SavedTab(tab_id, title, json.loads(settings or "{}"), journal, count, bool(current))
+                for tab_id, title, settings, journal, count, current in rows]
+
+    # 为新标签页分配编号；退出时没有保存的编号在下次启动时删除
+    def new_tab(self):
+        tab_id = self._connect().execute("INSERT INTO tabs (title) VALUES ('')").lastrowid
+        self._conn.commit()
+        return tab_id
+
+    # 标签页聊天记录的存档，Transcript 移出内存的消息写到这里
+    def archive(self, tab_id, count=0):
+        return MessageArchive(self._connect(), tab_id, count)
+
+    def history(self, tab_id):
+        row = self._connect().execute("SELECT history FROM tabs WHERE id = ?", (tab_id,)).fetchone()
+        return json.loads(row[0]) if row and row[0] else []
+
+    # 标签页被关闭
+    def discard(self, tab_id):
+        self._connect().execute("DELETE FROM messages WHERE tab = ?", (tab_id,))
+        self._conn.execute("DELETE FROM tabs WHERE id = ?", (tab_id,))
+        self._conn.commit()
+
+    # 保存现在打开的标签页，在一个事务中完成
+    # tabs 为 dict(id, title)，显示过的标签页另有 settings、journal、history 和 count；没有显示过的保持上次保存的内容
+    def save(self, tabs, current=0):
+        with self._connect():
+            self._conn.execute("UPDATE tabs SET position = NULL, current = 0")
+            for position, tab in enumerate(tabs):
+                self._conn.execute("UPDATE tabs SET position = ?, current = ?, title = ? WHERE id = ?",
+                                   (position, position == current, tab["title"], tab["id"]))
+                if "settings" in tab:
+                    self._conn.execute(
+                        "UPDATE tabs SET settings = ?, journal = ?, history = ?, count = ? WHERE id = ?",
+                        (json.dumps(tab["settings"], ensure_ascii=False), tab["journal"],
+                         json.dumps(tab["history"], ensure_ascii=False), tab["count"], tab["id"]))
+            self._purge()
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    # 删除没有保存的标签页和保存之后才写入的消息(上次没有正常退出时留下的)
+    def _purge(self):
+        self._conn.execute("DELETE FROM messages WHERE tab IN (SELECT id FROM tabs WHERE position IS NULL)")
+        self._conn.execute("DELETE FROM tabs WHERE position IS NULL")
+        for tab_id, count in self._conn.execute("SELECT id, count FROM tabs").fetchall():
+            self._conn.execute("DELETE FROM messages WHERE tab = ? AND idx >= ?", (tab_id, count))
+
+    def _connect(self):
+        if self._conn is None:
+            folder = os.path.dirname(self.path)
+            if folder and not os.path.exists(folder):
+                os.makedirs(folder)
+            self._conn = sqlite3.connect(self.path)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS tabs ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, position INTEGER, current INTEGER NOT NULL DEFAULT 0, "
+                "title TEXT NOT NULL, settings TEXT, journal TEXT, history TEXT, count INTEGER NOT NULL DEFAULT 0)")
+            self._conn.execute(MESSAGES_TABLE)
+            self._purge()
+            self._conn.commit()
+        return self._conn
+
+
+session_store = SessionStore()
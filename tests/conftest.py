@@ -0,0 +1,30 @@
+import os
+import sys
+
+import pytest
+
+# 测试直接导入仓库根目录下的模块，和 benchmarks 中的脚本一样
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_openai import FakeOpenAI  # noqa: E402
+
+
+# 本地的 OpenAI 兼容接口；清掉代理的环境变量，请求直接连到本机
+@pytest.fixture
+def fake_openai(monkeypatch):
+    for name in ("HTTP_PROXY", "HTTPS_PROXY", "ALL_PROXY", "http_proxy", "https_proxy", "all_proxy"):
+        monkeypatch.delenv(name, raising=False)
+    server = FakeOpenAI().start()
+    yield server
+    server.stop()
+
+
+# 让全局的密钥池只有一个指向 fake_openai 的密钥，结束时恢复
+@pytest.fixture
+def api_key(fake_openai, monkeypatch):
+    from key_pool import ApiKey, key_pool
+    from openai_client import client_pool
+
+    monkeypatch.setattr(key_pool, "keys", [ApiKey("test", "sk-test", fake_openai.url)])
+    yield "sk-test"
+    client_pool.close()
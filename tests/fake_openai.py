@@ -0,0 +1,152 @@
+import json
+import sys
+import threading
+import time
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# 本地的 OpenAI 兼容接口，测试用：记录接受的 TCP 连接数和收到的请求
+# 对话请求回复 reply(请求体)，默认把最后一条消息原样返回；stream=True 时分 chunks 段、每段间隔 delay 秒发出，
+# delay 也可以是 delay(请求体)，按请求决定
+# 语音请求(/audio/transcriptions 和 /audio/translations)的请求体是 {"model", "file", "filename"}，
+# 等 delay 秒后回复 transcribe(请求体)，默认回复音频的字节数
+# fail(请求体, 请求头) 返回 (状态码, 错误信息) 时按错误回复，返回 None 时正常回复
+class FakeOpenAI(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), _Handler)
+        self.connections = 0
+        self.requests = []      # (路径, 请求体)
+        self.aborted = 0        # 客户端没有读完就断开的流式回复数
+        self.reply = lambda body: body["messages"][-1]["content"]
+        self.transcribe = lambda body: f"{len(body['file'])} bytes"
+        self.fail = lambda body, headers: None
+        self.delay = 0.0
+        self.chunks = 2
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/v1"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    # 客户端中途断开(例如请求被取消)是正常的，不打印
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def count_connection(self):
+        with self._lock:
+            self.connections += 1
+
+    def record(self, path, body):
+        with self._lock:
+            self.requests.append((path, body))
+
+    def count_abort(self):
+        with self._lock:
+            self.aborted += 1
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        self.server.count_connection()
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_POST(self):
+        data = self.rfile.read(int(self.headers["Content-Length"]))
+        content_type = self.headers.get("Content-Type", "")
+        if content_type.startswith("application/json"):
+            body = json.loads(data)
+        elif content_type.startswith("multipart/form-data"):
+            body = _form_fields(content_type, data)
+        else:
+            body = data
+        self.server.record(self.path, body)
+        failure = self.server.fail(body, self.headers)
+        if failure is not None:
+            status, message = failure
+            self._send_json({"error": {"message": message, "type": "error", "code": None}}, status)
+            return
+        if self.path.startswith("/v1/audio/"):
+            time.sleep(self.server.delay(body) if callable(self.server.delay) else self.server.delay)
+            self._send_json({"text": self.server.transcribe(body)})
+            return
+        text = self.server.reply(body)
+        if body.get("stream"):
+            self._send_stream(body, text)
+        else:
+            self._send_json({"id": "chatcmpl-test", "object": "chat.completion", "created": 0, "model": body["model"],
+                             "choices": [{"index": 0, "message": {"role": "assistant", "content": text},
+                                          "finish_reason": "stop"}]})
+
+    def _send_json(self, payload, status=200):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_stream(self, body, text):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        size = -(-len(text) // self.server.chunks) or 1
+        delay = self.server.delay(body) if callable(self.server.delay) else self.server.delay
+        try:
+            for start in range(0, len(text), size):
+                time.sleep(delay)
+                self._write_chunk(text[start:start + size])
+            self._write_event("[DONE]")
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            self.server.count_abort()
+            self.close_connection = True
+
+    def _write_chunk(self, piece):
+        self._write_event(json.dumps({"id": "chatcmpl-test", "object": "chat.completion.chunk", "created": 0,
+                                      "model": "test", "choices": [{"index": 0, "delta": {"content": piece},
+                                                                    "finish_reason": None}]}))
+
+    def _write_event(self, data):
+        event = f"data: {data}\n\n".encode()
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(event), event))
+        self.wfile.flush()
+
+
+# multipart 表单的字段；文件字段的内容为 bytes，文件名放在 filename 中
+def _form_fields(content_type, data):
+    message = BytesParser(policy=HTTP).parsebytes(b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + data)
+    fields = {}
+    for part in message.iter_parts():
+        name = part.get_param("name", header="content-disposition")
+        if part.get_filename() is not None:
+            fields["filename"] = part.get_filename()
+            fields[name] = part.get_payload(decode=True)
+        else:
+            fields[name] = part.get_content().strip()
+    return fields
@@ -0,0 +1,75 @@
+import io
+import wave
+
+import pytest
+
+from audio_capture import RingBuffer, WavSpool, describe_savings, encode_flac
+
+np = pytest.importorskip("numpy")
+
+RATE = 16000
+
+
+def speech(seconds):
+    t = np.arange(int(seconds * RATE)) / RATE
+    return (6000 * np.sin(2 * np.pi * 220 * t) * np.sin(2 * np.pi * 3 * t)).astype("<i2")
+
+
+def make_spool(samples, **kwargs):
+    spool = WavSpool(RATE, **kwargs)
+    pcm = samples.tobytes()
+    for i in range(0, len(pcm), 4096):
+        spool.write(pcm[i:i + 4096])
+    spool.finish()
+    return spool
+
+
+def test_spool_is_a_valid_wav_in_memory_or_spilled_to_disk():
+    samples = speech(1.0)
+    for max_memory in (8 * 1024 * 1024, 1000):
+        spool = make_spool(samples, max_memory=max_memory)
+        assert spool.in_memory == (max_memory > 1000)
+        name, file, mime_type = spool.upload()
+        with wave.open(file, "rb") as wav:
+            assert (wav.getframerate(), wav.getnchannels(), wav.getsampwidth()) == (RATE, 1, 2)
+            assert wav.readframes(wav.getnframes()) == samples.tobytes()
+        assert spool.duration == pytest.approx(1.0) and mime_type == "audio/wav"
+        spool.close()
+
+
+def test_ring_buffer_drops_data_that_does_not_fit():
+    buffer = RingBuffer(10)
+    buffer.write(b"abcdef")
+    assert buffer.read() == b"abcdef"
+    buffer.write(b"ghijkl")           # 跨过缓冲的末尾
+    buffer.write(b"mnopq")
+    assert buffer.read() == b"ghijklmnop" and buffer.dropped == 1
+    assert buffer.read(timeout=0) == b""
+
+
+# 压缩成 FLAC 是无损的：解码出来的采样和录下的一样，而且比 WAV 小
+@pytest.mark.parametrize("max_memory", [8 * 1024 * 1024, 1000])
+def test_flac_round_trips_the_recording(max_memory):
+    soundfile = pytest.importorskip("soundfile")
+    samples = speech(2.5)
+    spool = make_spool(samples, max_memory=max_memory)
+    wav_size = spool.size
+
+    recording = encode_flac(spool, block_seconds=1)
+    name, file, mime_type = recording.upload()
+    decoded, rate = soundfile.read(file, dtype="int16")
+    assert rate == RATE and np.array_equal(decoded, samples)
+    assert name.endswith(".flac") and mime_type == "audio/flac"
+    assert recording.size < wav_size and recording.original_size == wav_size
+    assert recording.duration == pytest.approx(2.5)
+    assert isinstance(recording.file, io.BytesIO) == spool.in_memory
+    recording.close()
+
+
+def test_savings_report_removed_silence_and_bytes():
+    spool = make_spool(speech(2.0))
+    spool.original_size, spool.original_duration = spool.size * 2, 4.0
+    assert describe_savings(spool, elapsed=1.0) == (
+        "Audio: removed 2.0s of silence from 4.0s, uploaded 63 KB instead of 125 KB (50% smaller), "
+        "about 1.0s faster.")
+    assert describe_savings(make_spool(speech(1.0)), elapsed=1.0) is None
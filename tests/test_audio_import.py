@@ -0,0 +1,73 @@
+import wave
+
+import pytest
+
+from audio_import import AudioFile, plan_chunks, read_resampled, remove_overlap
+
+
+def test_overlap_repeated_at_the_start_is_removed():
+    assert remove_overlap("the cat sat on the mat.", "On the mat, it slept.") == "it slept."
+    assert remove_overlap("a b c", "b c") == ""
+    assert remove_overlap("", "first segment") == "first segment"
+
+
+# 一段开头是半个词，转写得不对：重复的部分可以从第 skip 个词之内开始，前面的词一起去掉
+def test_a_garbled_first_word_before_the_overlap_is_dropped():
+    assert remove_overlap("the cat sat on the mat.", "n the mat it slept") == "it slept"
+    assert remove_overlap("we walked to the station", "um to the station and waited") == "and waited"
+
+
+def test_a_single_matching_word_must_start_the_text():
+    assert remove_overlap("we went home", "home was quiet") == "was quiet"
+    assert remove_overlap("we went home", "a home was quiet") == "a home was quiet"
+
+
+def test_unrelated_text_is_kept():
+    assert remove_overlap("the cat sat", "dogs bark loudly") == "dogs bark loudly"
+
+
+def test_cjk_characters_count_as_words():
+    assert remove_overlap("今天天气很好我们", "我们去公园") == "去公园"
+    assert remove_overlap("今天天气很好", "明天下雨") == "明天下雨"
+
+
+def write_wav(path, samples, rate):
+    with wave.open(str(path), "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(rate)
+        f.writeframes(samples.astype("<i2").tobytes())
+    return AudioFile(str(path))
+
+
+# 每 4 秒一次 0.3 秒的停顿，其余时间是声音：切点落在停顿中，相邻两段重叠 overlap 秒
+def test_chunks_are_cut_at_the_quietest_moment_and_overlap(tmp_path):
+    np = pytest.importorskip("numpy")
+    rate = 8000
+    t = np.arange(65 * rate) / rate
+    samples = 8000 * np.sin(2 * np.pi * 300 * t)
+    for pause in np.arange(2.5, 65, 4):
+        samples[int(pause * rate):int((pause + 0.3) * rate)] = 0
+    audio = write_wav(tmp_path / "speech.wav", samples, rate)
+
+    chunks = list(plan_chunks(audio, chunk_seconds=20, overlap=1, search_seconds=5))
+    assert chunks[0][0] == 0 and chunks[-1][1] == audio.frames
+    for (start, end), (next_start, _) in zip(chunks, chunks[1:]):
+        assert end - next_start == rate                  # 重叠 1 秒
+        assert not samples[end - 100:end + 100].any()     # 切在停顿里
+        assert 15 * rate <= end - start <= 20 * rate
+    audio.close()
+
+
+def test_resampled_blocks_join_without_seams(tmp_path):
+    np = pytest.importorskip("numpy")
+    rate = 44100
+    t = np.arange(3 * rate) / rate
+    audio = write_wav(tmp_path / "tone.wav", 10000 * np.sin(2 * np.pi * 440 * t), rate)
+
+    blocks = list(read_resampled(audio, 0, audio.frames, 16000, block_seconds=0.5))
+    joined = np.concatenate(blocks).astype(np.float64)
+    expected = 10000 * np.sin(2 * np.pi * 440 * np.arange(3 * 16000) / 16000)
+    assert len(joined) == 3 * 16000
+    assert np.max(np.abs(joined[100:-100] - expected[100:-100])) < 100
+    audio.close()
@@ -0,0 +1,58 @@
+import concurrent.futures
+import threading
+import time
+
+import pytest
+
+from chat_session import ChatSession
+from request_engine import RequestParams, engine
+
+
+# Stop：取消正在流式输出的回复，任务很快结束，HTTP 流被关闭，已经收到的部分留在调用方手中
+def test_stopping_a_streamed_reply(fake_openai, api_key):
+    fake_openai.delay = 0.2
+    fake_openai.chunks = 20
+    session = ChatSession()
+    params = RequestParams("gpt-3.5-turbo", api_key, temperature=1.0, max_tokens=100)
+    messages, _ = session.prepare(params, "a fairly long message to stream back slowly")
+    received = []
+    first = threading.Event()
+
+    async def reply():
+        async for chunk in session.stream_reply(params, messages):
+            received.append(chunk)
+            first.set()
+
+    future = engine.submit(reply())
+    assert first.wait(10)
+    started = time.monotonic()
+    future.cancel()
+    with pytest.raises(concurrent.futures.CancelledError):
+        future.result(1)
+    assert time.monotonic() - started < 0.1
+
+    # 服务器在写下一段时发现连接已经断开
+    deadline = time.monotonic() + 2
+    while fake_openai.aborted == 0 and time.monotonic() < deadline:
+        time.sleep(0.02)
+    assert fake_openai.aborted == 1
+
+    partial = "".join(received)
+    session.finish(params, partial)
+    assert session.history.messages[-1] == {"role": "assistant", "content": partial}
+    assert 0 < len(partial) < len(messages[-1]["content"])
+
+
+# 回复还没有记入历史时保存：不保存没有回复的用户消息，本地模型恢复后用户、回复仍然交替
+def test_saved_history_leaves_out_an_unanswered_turn():
+    session = ChatSession()
+    params = RequestParams("local model", "", model_path="model.bin", max_tokens=100)
+    session.prepare(params, "first")
+    session.finish(params, "reply")
+    session.prepare(params, "second")
+    assert [message for message, _, _ in session.saved_history()] == ["first", "reply"]
+
+    session.finish(params, "")
+    restored = ChatSession()
+    restored.restore_history(session.saved_history())
+    assert restored.history.messages == ["first", "reply", "second", ""]
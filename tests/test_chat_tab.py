@@ -0,0 +1,147 @@
+import os
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("PySide6")
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from PySide6.QtWidgets import QApplication  # noqa: E402
+
+import chat_tab  # noqa: E402
+from audio_capture import WavSpool  # noqa: E402
+from qt_bridge import QtBridge  # noqa: E402
+from request_engine import engine  # noqa: E402
+from translation_cache import TranslationCache  # noqa: E402
+
+RATE = 16000
+
+
+def segment(seconds):
+    spool = WavSpool(RATE)
+    spool.write(bytes(int(seconds * RATE) * 2))
+    spool.finish()
+    return spool
+
+
+# 代替麦克风的录音：每 0.05 秒切出一段，直到 stop_event 被设置
+class FakeRecorder:
+    started = 0
+    running = 0
+
+    def __init__(self, **settings):
+        self.dropped = 0
+        self.compress_error = None
+
+    def capture(self, stop_event, on_segment=None):
+        FakeRecorder.started += 1
+        FakeRecorder.running += 1
+        try:
+            while not stop_event.wait(0.05):
+                on_segment(segment(0.1))
+            return segment(0)
+        finally:
+            FakeRecorder.running -= 1
+
+
+@pytest.fixture
+def tab(api_key, monkeypatch):
+    app = QApplication.instance() or QApplication([])
+    bridge = QtBridge()
+    monkeypatch.setattr(engine, "dispatcher", bridge.dispatch)
+    monkeypatch.setattr(chat_tab, "Recorder", FakeRecorder)
+    monkeypatch.setattr(FakeRecorder, "started", 0)
+    monkeypatch.setattr(FakeRecorder, "running", 0)
+    tab = chat_tab.ChatTab(api_key, live_transcription=dict(enabled=True, concurrency=2))
+    yield tab
+    if tab.recording_start_time is not None:
+        tab.finish_recording()
+    tab.cancel_requests()
+    tab.deleteLater()
+    app.processEvents()
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        QApplication.processEvents()
+        time.sleep(0.01)
+
+
+def assert_recording_stopped(tab):
+    assert FakeRecorder.running == 0 and not tab.record_thread.is_alive()
+    assert tab.record_send_button.text() == "Record to Transcriptions"
+    assert tab.record_translate_button.text() == "Record to Translate"
+    assert not tab.recording_timer.isActive() and not tab.recording.is_set()
+
+
+# 边录边转写时一段转写失败：录音停止，两个录音按钮都回到初始状态，不会同时开两个录音
+def test_live_transcription_error_stops_the_recorder(tab, fake_openai):
+    fake_openai.fail = lambda body, headers: (400, "bad audio")
+    tab.record_send_button.click()
+    wait_until(lambda: fake_openai.requests)
+    wait_until(lambda: tab.send_button.isEnabled())
+
+    assert_recording_stopped(tab)
+    assert "Error: " in "".join(tab.transcript.iter_text())
+    tab.record_translate_button.click()
+    wait_until(lambda: FakeRecorder.running == 1)
+    tab.record_translate_button.click()
+    assert FakeRecorder.started == 2 and FakeRecorder.running == 0
+
+
+def test_stop_during_live_transcription_stops_the_recorder(tab, fake_openai):
+    fake_openai.delay = 1.0
+    tab.record_translate_button.click()
+    wait_until(lambda: fake_openai.requests)
+    assert not tab.record_send_button.isEnabled()
+
+    tab.stop()
+    wait_until(lambda: tab.send_button.isEnabled())
+    assert_recording_stopped(tab)
+    assert "Generation stopped." in "".join(tab.transcript.iter_text())
+
+
+# 关闭窗口时回复还在生成：停止引擎后先执行排队的 finish_reply，保存的历史以已生成的部分回复结尾
+def test_closing_mid_reply_saves_the_partial_reply(tab, fake_openai):
+    fake_openai.delay = 0.2
+    fake_openai.chunks = 20
+    tab.chat_input.setPlainText("a fairly long message to stream back slowly")
+    tab.send_button.click()
+    wait_until(lambda: any(role == "gpt" and text for role, text in tab.transcript))
+
+    engine.stop()
+    engine.dispatcher.__self__.flush()
+    history = [message for message, _, _ in tab.session.saved_history()]
+    assert [message["role"] for message in history] == ["user", "assistant"]
+    assert history[1]["content"] and "a fairly long message".startswith(history[1]["content"])
+
+
+# 查缓存时记下所在的线程
+class RecordingCache(TranslationCache):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.threads = []
+
+    def get(self, *key):
+        self.threads.append(threading.current_thread())
+        return super().get(*key)
+
+
+# 同样的原文翻译两次：第二次命中缓存，不再请求模型；查缓存不在GUI线程中进行
+def test_cached_translation_is_looked_up_off_the_gui_thread(tab, fake_openai, tmp_path, monkeypatch):
+    cache = RecordingCache(path=str(tmp_path / "translations.db"))
+    monkeypatch.setattr(chat_tab, "translation_cache", cache)
+    for _ in range(2):
+        tab.chat_input.setPlainText("Good morning")
+        tab.translate_button.click()
+        wait_until(lambda: tab.send_button.isEnabled() and list(tab.transcript)[-1][0] == "translation")
+
+    assert len(fake_openai.requests) == 1
+    assert [role for role, _ in tab.transcript] == ["user", "translation"] * 2
+    translations = [text for role, text in tab.transcript if role == "translation"]
+    assert translations[0] == translations[1] and translations[0]
+    assert tab.cache_stats_label.text() == "Cache: 1 hits / 1 misses"
+    assert len(cache.threads) == 2 and threading.main_thread() not in cache.threads
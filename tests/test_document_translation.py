@@ -0,0 +1,104 @@
+import re
+import time
+
+import openai
+import pytest
+
+import document_translation
+from context_window import estimate_tokens
+from document_translation import stream_document_translation, translate_text
+from request_engine import RequestParams, engine
+from segmenter import join_segments, split_segments
+from translation_cache import TranslationCache
+
+TEXT = """The first paragraph has a few short sentences. It is here to be packed. It stays whole.
+
+Second paragraph.
+
+第三段是中文。它有好几句话。每一句都以句号结尾！最后一句是问句吗？
+
+The fourth paragraph is long enough that it has to be split into sentences. Each sentence stays \
+under the limit. The separators between them are kept so the text can be put back together.
+"""
+
+
+def test_segments_reassemble_into_the_original_text():
+    segments = split_segments(TEXT, max_tokens=20)
+    assert len(segments) > 4
+    assert all(estimate_tokens(segment.text) <= 20 for segment in segments)
+    assert join_segments(segments, [segment.text for segment in segments]) == TEXT.rstrip()
+
+
+def test_short_paragraphs_are_packed_into_one_segment():
+    segments = split_segments("One.\n\nTwo.\n\nThree.", max_tokens=100)
+    assert [segment.text for segment in segments] == ["One.\n\nTwo.\n\nThree."]
+
+
+def test_cjk_sentences_split_without_spaces():
+    segments = split_segments("第一句话。" * 10, max_tokens=12)
+    assert [segment.text for segment in segments] == ["第一句话。第一句话。"] * 5
+
+
+def test_a_sentence_longer_than_the_limit_is_cut_by_length():
+    text = "x" * 400
+    segments = split_segments(text, max_tokens=30)
+    assert all(estimate_tokens(segment.text) <= 30 for segment in segments)
+    assert "".join(segment.text for segment in segments) == text
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    cache = TranslationCache(path=str(tmp_path / "translations.db"))
+    monkeypatch.setattr(document_translation, "translation_cache", cache)
+    return cache
+
+
+def document(paragraphs):
+    return "\n\n".join(f"Paragraph {i} " + "word " * 30 + "end." for i in range(paragraphs))
+
+
+def paragraph_number(body):
+    return int(re.search(r"Paragraph (\d+)", body["messages"][-1]["content"]).group(1))
+
+
+# 前面的段回复得最慢：各段同时翻译，产出的顺序仍然是原文的顺序
+def test_segments_are_translated_concurrently_and_streamed_in_order(fake_openai, api_key, cache):
+    fake_openai.reply = lambda body: f"Translated {paragraph_number(body)}."
+    fake_openai.delay = lambda body: 0.05 * (6 - paragraph_number(body))
+    text = document(6)
+    params = RequestParams("gpt-3.5-turbo", api_key)
+
+    async def run():
+        return [item async for item in stream_document_translation(params, text, "Chinese", concurrency=6,
+                                                                   segment_tokens=60)]
+
+    started = time.monotonic()
+    items = engine.submit(run()).result(30)
+    elapsed = time.monotonic() - started
+
+    indexes = [index for index, _ in items]
+    assert indexes == sorted(indexes) and set(indexes) == set(range(6))
+    assert "".join(chunk for _, chunk in items) == "\n\n".join(f"Translated {i}." for i in range(6))
+    assert elapsed < sum(2 * 0.05 * (6 - i) for i in range(6))   # 一段接一段翻译要 2.1 秒
+    assert len(fake_openai.requests) == 6
+
+
+def test_cached_segments_are_not_requested_again(fake_openai, api_key, cache):
+    fake_openai.reply = lambda body: f"Translated {paragraph_number(body)}."
+    text = document(3)
+    params = RequestParams("gpt-3.5-turbo", api_key)
+
+    first = engine.submit(translate_text(params, text, "Chinese", segment_tokens=60)).result(30)
+    second = engine.submit(translate_text(params, text, "Chinese", segment_tokens=60)).result(30)
+    assert first == second == "Translated 0.\n\nTranslated 1.\n\nTranslated 2."
+    assert len(fake_openai.requests) == 3
+
+
+def test_a_failing_segment_raises_and_cancels_the_rest(fake_openai, api_key, cache):
+    fake_openai.reply = lambda body: f"Translated {paragraph_number(body)}."
+    fake_openai.fail = lambda body, headers: (400, "bad segment") if paragraph_number(body) == 1 else None
+    text = document(3)
+    params = RequestParams("gpt-3.5-turbo", api_key)
+
+    with pytest.raises(openai.BadRequestError):
+        engine.submit(translate_text(params, text, "Chinese", concurrency=3, segment_tokens=60)).result(30)
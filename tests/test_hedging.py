@@ -0,0 +1,120 @@
+import asyncio
+
+import pytest
+
+import hedging
+from hedging import BackendHealth, CircuitBreaker, HedgeRouter
+from request_engine import RequestParams
+
+
+def test_percentile_without_censored_samples():
+    health = BackendHealth()
+    for i in range(1, 21):
+        health.record_latency(i / 10)
+    assert health.percentile(50) == pytest.approx(1.0)
+    assert health.percentile(95) == pytest.approx(1.9)
+    assert BackendHealth().percentile(95) is None
+
+
+# 慢的请求都在对冲中被取消了：只看完成的请求百分位数会落在快的请求上，删失样本把它拉回来
+def test_censored_samples_keep_the_percentile_from_drifting_low():
+    health = BackendHealth()
+    for _ in range(40):
+        health.record_latency(0.05)
+    for _ in range(10):
+        health.record_latency(0.8, censored=True)
+    assert health.percentile(50) == pytest.approx(0.05)
+    assert health.percentile(95) == pytest.approx(0.8)
+
+
+def test_early_censored_samples_do_not_count_as_fast_requests():
+    health = BackendHealth()
+    for _ in range(10):
+        health.record_latency(0.01, censored=True)   # 对冲的请求刚发出就因为主请求胜出被取消
+    for i in range(1, 11):
+        health.record_latency(i / 10)
+    assert health.percentile(50) == pytest.approx(0.5)
+
+
+def test_breaker_opens_after_repeated_failures_and_allows_one_trial():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.0)
+    breaker.record_failure()
+    assert breaker.state == "closed"
+    breaker.record_failure()
+    assert breaker.state == "half-open"     # reset_timeout 为 0，立即可以试探
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record_success()
+    assert breaker.state == "closed"
+
+
+# 假的后端：delays[模型] 秒后产出第一段
+@pytest.fixture
+def fake_backends(monkeypatch):
+    delays = {}
+
+    async def backend_stream(params, prompt, priority=None, owner=None, **kwargs):
+        await asyncio.sleep(delays[params.model])
+        yield f"{params.model}: {prompt}"
+
+    monkeypatch.setattr(hedging, "backend_stream", backend_stream)
+    return delays
+
+
+def make_router():
+    router = HedgeRouter()
+    router.configure(enabled=True, backends=["fast", "slow"], default_delay=0.05, min_delay=0.05, max_delay=0.5)
+    return router
+
+
+async def translate(router, params):
+    return [(backend.model, text) async for backend, text in router.stream(params, "hi")]
+
+
+def test_hedged_loser_records_a_censored_sample(fake_backends):
+    fake_backends.update(slow=0.3, fast=0.01)
+    router = make_router()
+    params = RequestParams("slow", "sk-test")
+
+    assert asyncio.run(translate(router, params)) == [("fast", "fast: hi")]
+    [(seconds, censored)] = router.health("slow").latencies
+    assert censored and 0.05 <= seconds < 0.3
+    [(seconds, censored)] = router.health("fast").latencies
+    assert not censored and seconds < 0.1
+
+
+# 主后端有两成的请求很慢：以前慢的请求从不计入，对冲的等待时间降到最小值；现在它停在慢请求被取消时等过的时间上
+def test_hedge_delay_does_not_drift_down_when_slow_primaries_are_cancelled(fake_backends):
+    router = make_router()
+    params = RequestParams("slow", "sk-test")
+    fake_backends["fast"] = 0.15
+
+    async def run():
+        for i in range(25):
+            fake_backends["slow"] = 1.0 if i % 5 == 0 else 0.01
+            await translate(router, params)
+
+    asyncio.run(run())
+    latencies = router.health("slow").latencies
+    assert sum(censored for _, censored in latencies) == 5
+    assert router.hedge_delay("slow") >= 0.15
+
+
+# 对冲到本地模型时使用请求中的 temperature 和 max_tokens，和主后端的设置相同
+def test_local_backend_uses_the_request_generation_settings(monkeypatch):
+    calls = []
+
+    async def stream_local_reply(model_path, history, **kwargs):
+        calls.append(kwargs)
+        yield "译文"
+
+    monkeypatch.setattr(hedging, "stream_local_reply", stream_local_reply)
+
+    async def run(params):
+        return [text async for text in hedging.backend_stream(params, "hi")]
+
+    params = RequestParams("local model", "", model_path="model.bin", temperature=0.2, max_tokens=300)
+    assert asyncio.run(run(params)) == ["译文"]
+    assert asyncio.run(run(params._replace(temperature=0.0, max_tokens=None))) == ["译文"]
+    assert [(kwargs["temperature"], kwargs["do_sample"], kwargs["max_length"]) for kwargs in calls] == [
+        (0.2, True, hedging.LOCAL_CONTEXT_LENGTH + 300), (0.0, False, 2048)]
@@ -0,0 +1,131 @@
+import os
+import re
+import subprocess
+import sys
+import time
+
+import pytest
+
+import document_translation
+from job_queue import DONE, FAILED, IN_FLIGHT, PENDING, RUNNING, JobQueue
+from request_engine import RequestParams, engine
+from translation_cache import TranslationCache
+
+TEXT = "\n\n".join(f"Unit {i}." for i in range(5))
+
+
+@pytest.fixture
+def queue(tmp_path, fake_openai, api_key, monkeypatch):
+    monkeypatch.setattr(document_translation, "translation_cache", TranslationCache(path=str(tmp_path / "cache.db")))
+    fake_openai.reply = lambda body: f"译文 {unit_number(body)}。"
+    queue = JobQueue(path=str(tmp_path / "jobs.db"))
+    yield queue
+    queue.close()
+
+
+def unit_number(body):
+    return int(re.search(r"Unit (\d+)", body["messages"][-1]["content"]).group(1))
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def add_job(queue, tmp_path):
+    return queue.add_text(TEXT, str(tmp_path / "out.txt"), "Chinese", "Normal",
+                          RequestParams("gpt-3.5-turbo", "sk-test"), segment_tokens=3)
+
+
+def unit_statuses(queue, job_id):
+    return [status for status, in queue._connect().execute(
+        "SELECT status FROM units WHERE job_id = ? ORDER BY idx", (job_id,))]
+
+
+def dead_pid():
+    process = subprocess.Popen([sys.executable, "-c", "pass"])
+    process.wait()
+    return process.pid
+
+
+# 把任务改成正在 owner 进程中运行：单元 0、1 已完成，2、3 正在翻译
+def mark_running(queue, job_id, owner, lease):
+    conn = queue._connect()
+    conn.execute("UPDATE units SET status = ?, translation = ? WHERE job_id = ? AND idx < 2",
+                 (DONE, "旧译文。", job_id))
+    conn.execute("UPDATE units SET status = ?, owner = ?, lease = ? WHERE job_id = ? AND idx IN (2, 3)",
+                 (IN_FLIGHT, owner, lease, job_id))
+    conn.execute("UPDATE jobs SET status = ?, owner = ?, lease = ? WHERE id = ?", (RUNNING, owner, lease, job_id))
+    conn.commit()
+
+
+# 进程在翻译途中退出：只是打开数据库、查看状态不改变任何记录；再次运行时 in-flight 的单元回到 pending，
+# 只请求没有完成的单元
+def test_units_in_flight_when_the_process_died_are_translated_again(queue, fake_openai, tmp_path):
+    job_id = add_job(queue, tmp_path)
+    mark_running(queue, job_id, dead_pid(), time.time() + 60)
+    queue.close()
+
+    assert unit_statuses(queue, job_id) == [DONE, DONE, IN_FLIGHT, IN_FLIGHT, PENDING]
+    assert queue.job(job_id).status == RUNNING
+    assert queue.progress(job_id)[:4] == (5, 2, 0, 3)
+
+    assert engine.submit(queue.run(job_id, "sk-test")).result(30)
+    assert sorted(unit_number(body) for _, body in fake_openai.requests) == [2, 3, 4]
+    assert queue.job(job_id).status == DONE
+    assert (tmp_path / "out.txt").read_text(encoding="utf-8") == "旧译文。\n\n旧译文。\n\n译文 2。\n\n译文 3。\n\n译文 4。"
+
+
+# 另一个进程(这里用父进程代替)正在运行任务：查看状态不改变它的记录，再次运行被拒绝，不会重复请求
+def test_a_job_running_in_another_process_is_left_alone(queue, fake_openai, tmp_path):
+    job_id = add_job(queue, tmp_path)
+    mark_running(queue, job_id, os.getppid(), time.time() + 60)
+    other = JobQueue(path=queue.path)
+    assert [job.status for job in other.jobs()] == [RUNNING]
+    other.close()
+
+    with pytest.raises(RuntimeError, match="already running"):
+        engine.submit(queue.run(job_id, "sk-test")).result(30)
+    assert unit_statuses(queue, job_id) == [DONE, DONE, IN_FLIGHT, IN_FLIGHT, PENDING]
+    assert queue.job(job_id).status == RUNNING and not fake_openai.requests
+
+
+# 持有的进程还在但租约过期了(例如卡住了)：任务可以被接手
+def test_a_job_with_an_expired_lease_can_be_taken_over(queue, fake_openai, tmp_path):
+    job_id = add_job(queue, tmp_path)
+    mark_running(queue, job_id, os.getppid(), time.time() - 1)
+    assert engine.submit(queue.run(job_id, "sk-test")).result(30)
+    assert sorted(unit_number(body) for _, body in fake_openai.requests) == [2, 3, 4]
+    assert queue.job(job_id)[-2:] == (DONE, None)
+
+
+def test_failed_units_are_retried_on_the_next_run(queue, fake_openai, tmp_path):
+    fake_openai.fail = lambda body, headers: (400, "bad unit") if unit_number(body) == 1 else None
+    job_id = add_job(queue, tmp_path)
+
+    assert not engine.submit(queue.run(job_id, "sk-test")).result(30)
+    assert unit_statuses(queue, job_id) == [DONE, FAILED, DONE, DONE, DONE]
+    assert queue.job(job_id)[-2:] == (FAILED, "1 units failed")
+    assert not (tmp_path / "out.txt").exists()
+
+    fake_openai.fail = lambda body, headers: None
+    requested = len(fake_openai.requests)
+    assert engine.submit(queue.run(job_id, "sk-test")).result(30)
+    assert [unit_number(body) for _, body in fake_openai.requests[requested:]] == [1]
+    assert queue.progress(job_id)[:4] == (5, 5, 0, 0)
+
+
+# 取消正在运行的任务：进行中的单元回到 pending，任务也回到 pending
+def test_cancelled_run_puts_units_in_flight_back_to_pending(queue, fake_openai, tmp_path):
+    fake_openai.delay = lambda body: 1.0 if unit_number(body) == 2 else 0.0
+    job_id = add_job(queue, tmp_path)
+
+    future = engine.submit(queue.run(job_id, "sk-test", concurrency=1))
+    wait_until(lambda: len(fake_openai.requests) == 3)
+    future.cancel()
+    wait_until(lambda: queue.job(job_id).status != RUNNING)   # 取消后的收尾在后台写入数据库
+
+    assert unit_statuses(queue, job_id) == [DONE, DONE, PENDING, PENDING, PENDING]
+    assert queue.job(job_id).status == PENDING
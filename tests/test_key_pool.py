@@ -0,0 +1,96 @@
+import pytest
+
+from key_pool import ApiKey, KeyPool, TokenBucket, key_pool
+from openai_client import create_chat_completion
+from request_engine import engine
+from scheduler import scheduler
+
+
+def test_token_bucket_refills_at_the_per_minute_rate():
+    bucket = TokenBucket(60)
+    bucket.updated = 0.0
+    bucket.consume(60, 0.0)
+    assert bucket.wait_time(1, 0.0) == pytest.approx(1.0)
+    assert bucket.wait_time(1, 0.5) == pytest.approx(0.5)
+    assert bucket.wait_time(1, 1.0) == 0.0
+    assert bucket.headroom(30.0) == pytest.approx(0.5)
+    assert bucket.headroom(120.0) == 1.0     # 不会超过容量
+
+
+def test_token_bucket_lets_an_oversized_request_through_when_full():
+    bucket = TokenBucket(1000)
+    bucket.updated = 0.0
+    assert bucket.wait_time(5000, 0.0) == 0.0
+    bucket.consume(5000, 0.0)
+    assert bucket.wait_time(1, 0.0) > 0
+
+
+def test_unlimited_bucket_never_waits():
+    bucket = TokenBucket(0)
+    bucket.consume(10 ** 6, 0.0)
+    assert bucket.wait_time(10 ** 6, 0.0) == 0.0
+    assert bucket.headroom(0.0) == 1.0
+
+
+def make_pool(*names, rpm=60):
+    pool = KeyPool()
+    pool.configure(keys=[dict(name=name, key=f"sk-{name}", rpm=rpm) for name in names], quarantine_seconds=60)
+    for key in pool.keys:
+        key.requests.updated = 0.0
+    return pool
+
+
+def test_choose_prefers_the_key_with_the_most_headroom():
+    pool = make_pool("a", "b")
+    assert pool.choose("gpt-4", 0, {}, 0.0)[0].name == "a"
+    assert pool.choose("gpt-4", 0, {}, 0.0)[0].name == "b"  # a 已经用掉一个请求
+    assert pool.choose("gpt-4", 0, {}, 0.0)[0].name == "a"
+
+
+def test_choose_reports_the_shortest_wait_when_every_key_is_spent():
+    pool = make_pool("a", "b", rpm=1)
+    pool.choose("gpt-4", 0, {}, 0.0)
+    pool.choose("gpt-4", 0, {}, 0.0)
+    key, wait = pool.choose("gpt-4", 0, {}, 30.0)
+    assert key is None and wait == pytest.approx(30.0)
+
+
+def test_model_limits_apply_to_each_key_separately():
+    pool = make_pool("a", "b", rpm=0)
+    limits = {"gpt-4": (1, 0)}
+    for key in pool.keys:
+        key.buckets("gpt-4", limits)[0].updated = 0.0
+    assert pool.choose("gpt-4", 0, limits, 0.0)[0].name == "a"
+    assert pool.choose("gpt-4", 0, limits, 0.0)[0].name == "b"
+    assert pool.choose("gpt-4", 0, limits, 0.0)[0] is None
+    assert pool.choose("gpt-3.5-turbo", 0, limits, 0.0)[0] is not None
+
+
+def test_quarantined_key_is_skipped_and_reported():
+    pool = make_pool("a", "b")
+    pool.quarantine(pool.keys[0], "Incorrect API key")
+    assert pool.status() == (1, 1)
+    assert all(pool.choose("gpt-4", 0, {}, 0.0)[0].name == "b" for _ in range(3))
+    [(name, seconds, reason)] = pool.quarantined()
+    assert name == "a" and 0 < seconds <= 60 and reason == "Incorrect API key"
+
+    pool.quarantine(pool.keys[1])
+    assert pool.choose("gpt-4", 0, {}, 0.0) == (None, None)
+
+
+# 一个密钥认证失败：它被隔离，请求换到另一个密钥上完成，不向标准输出打印任何东西
+def test_request_moves_to_another_key_when_one_is_rejected(fake_openai, api_key, monkeypatch, capsys):
+    fake_openai.fail = lambda body, headers: (
+        (401, "Incorrect API key provided") if headers["Authorization"] == "Bearer sk-bad" else None)
+    monkeypatch.setattr(key_pool, "keys", [ApiKey("bad", "sk-bad", fake_openai.url),
+                                           ApiKey("good", "sk-good", fake_openai.url)])
+
+    response = engine.submit(scheduler.call(
+        "gpt-3.5-turbo", create_chat_completion, model="gpt-3.5-turbo",
+        messages=[{"role": "user", "content": "hello"}])).result(10)
+
+    assert response.choices[0].message.content == "hello"
+    assert key_pool.status() == (1, 1)
+    [(name, _, reason)] = key_pool.quarantined()
+    assert name == "bad" and "Incorrect API key provided" in reason
+    assert capsys.readouterr().out == ""
@@ -0,0 +1,83 @@
+import threading
+import time
+
+import openai
+import pytest
+
+from audio_capture import WavSpool
+from chat_session import SegmentFeed, stream_segment_transcription
+from request_engine import engine
+
+RATE = 16000
+
+
+# 录音段：seconds 秒的静音 WAV，上传的字节数区分不同的段
+def segment(seconds):
+    spool = WavSpool(RATE)
+    spool.write(bytes(int(seconds * RATE) * 2))
+    spool.finish()
+    return spool
+
+
+def seconds_of(body):
+    return round((len(body["file"]) - 44) / (RATE * 2), 1)
+
+
+# 录音线程：每隔 interval 秒切出一段，最后 close()
+def record(feed, durations, interval=0.02):
+    def run():
+        for seconds in durations:
+            time.sleep(interval)
+            feed.put(segment(seconds))
+        feed.close()
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread
+
+
+def transcribe(api_key, feed, **kwargs):
+    async def run():
+        return [item async for item in stream_segment_transcription(api_key, feed, **kwargs)]
+    return engine.submit(run())
+
+
+# 前面的段转写得最慢：各段同时转写，结果仍然按录音的顺序产出
+def test_segments_are_transcribed_while_recording_and_come_out_in_order(fake_openai, api_key):
+    fake_openai.transcribe = lambda body: f"segment of {seconds_of(body)}s"
+    fake_openai.delay = lambda body: 2 * (0.4 - seconds_of(body))
+    feed = SegmentFeed()
+
+    started = time.monotonic()
+    future = transcribe(api_key, feed, concurrency=3)
+    record(feed, [0.3, 0.2, 0.1]).join()
+    results = future.result(10)
+
+    assert results == [(0, "segment of 0.3s"), (1, "segment of 0.2s"), (2, "segment of 0.1s")]
+    assert time.monotonic() - started < 0.2 + 0.4 + 0.6    # 一段接一段转写要 1.2 秒
+    assert {path for path, _ in fake_openai.requests} == {"/v1/audio/transcriptions"}
+    assert feed.segments == 3
+
+
+def test_translate_uses_the_translation_endpoint(fake_openai, api_key):
+    feed = SegmentFeed()
+    future = transcribe(api_key, feed, translate=True)
+    record(feed, [0.1]).join()
+    assert future.result(10) == [(0, "3244 bytes")]
+    assert [path for path, _ in fake_openai.requests] == ["/v1/audio/translations"]
+
+
+# 一段转写失败：异常抛给调用方，之后录音线程还送来的段直接关闭，不再上传
+def test_a_failed_segment_stops_the_transcription(fake_openai, api_key):
+    fake_openai.fail = lambda body, headers: (400, "bad audio") if seconds_of(body) == 0.2 else None
+    feed = SegmentFeed()
+    future = transcribe(api_key, feed, concurrency=1)
+    thread = record(feed, [0.1, 0.2, 0.3, 0.4, 0.5], interval=0.1)
+
+    with pytest.raises(openai.BadRequestError, match="bad audio"):
+        future.result(10)
+    thread.join()
+    late = segment(0.6)
+    feed.put(late)
+    engine.submit(engine.run_blocking(lambda: None)).result(5)   # 等 put 在事件循环中处理完
+    assert late.file.closed
+    assert [seconds_of(body) for _, body in fake_openai.requests][-1] < 0.5
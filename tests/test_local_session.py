@@ -0,0 +1,271 @@
+import asyncio
+import sys
+import threading
+import time
+import types
+
+import pytest
+
+from local_session import LocalChatSession
+
+ROLES = {"user": 1, "assistant": 2}
+EOS = 0
+
+
+# 假的 chatglm_cpp：每个字符一个 token，每条消息前加一个角色 token，结尾加上助手的角色 token 等待生成
+# 和 chatglm_cpp 0.2 一样，历史是用户、助手交替的字符串列表，以用户消息结尾
+class FakeTokenizer:
+    def encode_history(self, history, max_context_length):
+        if len(history) % 2 != 1 or not all(isinstance(content, str) for content in history):
+            raise ValueError(f"invalid history: {history!r}")
+        ids = []
+        for i, content in enumerate(history):
+            ids.append(ROLES["user"] if i % 2 == 0 else ROLES["assistant"])
+            ids.extend(ord(c) for c in content)
+        ids.append(ROLES["assistant"])
+        return ids[-max_context_length:]
+
+    def decode(self, ids):
+        return "".join(chr(i) for i in ids)
+
+
+# 逐 token 生成，记下每次调用实际预填充(计算)的 token 数
+class FakeModel:
+    def __init__(self, reply):
+        self.reply = reply
+        self.config = types.SimpleNamespace(eos_token_id=EOS)
+        self.calls = []
+
+    def generate_next_token(self, ids, gen_config, n_past, n_ctx):
+        self.calls.append(len(ids) - n_past)
+        generated = len(ids) - n_ctx
+        return ord(self.reply[generated]) if generated < len(self.reply) else EOS
+
+
+class FakePipeline:
+    def __init__(self, reply="ok!"):
+        self.model = FakeModel(reply)
+        self.tokenizer = FakeTokenizer()
+
+
+@pytest.fixture(autouse=True)
+def fake_chatglm_cpp(monkeypatch):
+    module = types.ModuleType("chatglm_cpp")
+    module._C = types.SimpleNamespace(GenerationConfig=lambda **kwargs: kwargs)
+    monkeypatch.setitem(sys.modules, "chatglm_cpp", module)
+
+
+# 跑一轮对话，返回回复和这一轮第一次调用时预填充的 token 数
+def run_turn(session, pipeline, history, **kwargs):
+    pipeline.model.calls = []
+    reply = "".join(session.chat(pipeline, history, **kwargs))
+    return reply, pipeline.model.calls[0]
+
+
+def test_each_turn_only_prefills_the_new_suffix():
+    session = LocalChatSession()
+    pipeline = FakePipeline()
+    history = []
+    prefills = []
+    for turn in range(20):
+        history.append(f"question {turn:02d}")
+        reply, prefill = run_turn(session, pipeline, history)
+        assert reply == "ok!"
+        assert session.last_prefill_tokens == prefill
+        prefills.append(prefill)
+        history.append(reply)
+
+    # 第一轮要计算整段输入；之后每轮只有新的用户输入(角色 token + 内容 + 助手角色 token)
+    assert prefills[0] == len(pipeline.tokenizer.encode_history(history[:1], 512))
+    assert prefills[1:] == [1 + len("question 00") + 1] * 19
+
+
+def test_decoding_evaluates_one_token_per_step():
+    session = LocalChatSession()
+    pipeline = FakePipeline("abcdef")
+    run_turn(session, pipeline, ["hi"])
+    assert pipeline.model.calls[1:] == [1] * len("abcdef")
+
+
+def test_edited_history_falls_back_to_a_full_prefill():
+    session = LocalChatSession()
+    pipeline = FakePipeline()
+    history = ["first", "ok!", "second"]
+    run_turn(session, pipeline, history)
+
+    edited = ["FIRST", "ok!", "second", "ok!", "third"]
+    # 第一条消息被改了，只剩开头的角色 token 相同，整段重新计算
+    _, prefill = run_turn(session, pipeline, edited)
+    assert prefill == len(pipeline.tokenizer.encode_history(edited, 512)) - 1
+
+
+def test_edit_in_the_middle_recomputes_from_the_divergence():
+    session = LocalChatSession()
+    pipeline = FakePipeline()
+    history = ["first", "ok!", "second"]
+    run_turn(session, pipeline, history)
+
+    edited = ["first", "ok!", "changed"]
+    _, prefill = run_turn(session, pipeline, edited)
+    unchanged = 1 + len("first") + 1 + len("ok!") + 1
+    assert prefill == len(pipeline.tokenizer.encode_history(edited, 512)) - unchanged
+
+
+def test_trimmed_history_falls_back_to_a_full_prefill():
+    session = LocalChatSession()
+    pipeline = FakePipeline()
+    history = ["a" * 20]
+    run_turn(session, pipeline, history, max_context_length=40)
+    history += ["ok!", "b" * 20]
+
+    # 超出上下文长度，最早的 token 被截掉，缓存中的前缀不再匹配
+    _, prefill = run_turn(session, pipeline, history, max_context_length=40)
+    assert prefill == 40
+
+
+def test_cleared_session_prefills_everything_again():
+    session = LocalChatSession()
+    pipeline = FakePipeline()
+    history = ["hello"]
+    run_turn(session, pipeline, history)
+    history += ["ok!", "again"]
+
+    session.invalidate()
+    _, prefill = run_turn(session, pipeline, history)
+    assert prefill == len(pipeline.tokenizer.encode_history(history, 512))
+
+
+def test_identical_history_still_recomputes_the_last_token():
+    session = LocalChatSession()
+    pipeline = FakePipeline()
+    history = ["hello"]
+    run_turn(session, pipeline, history)
+    session.cached_ids = pipeline.tokenizer.encode_history(history, 512)
+
+    _, prefill = run_turn(session, pipeline, history)
+    assert prefill == 1
+
+
+def test_stopping_mid_reply_keeps_only_the_evaluated_tokens():
+    session = LocalChatSession()
+    pipeline = FakePipeline("abcdef")
+    history = ["hello"]
+    stream = session.chat(pipeline, history)
+    assert next(stream) + next(stream) == "ab"
+    stream.close()
+
+    # 已经计算过的是输入和生成的 "a"；"b" 还没有被送回模型
+    assert session.cached_ids == pipeline.tokenizer.encode_history(history, 512) + [ord("a")]
+
+
+# ChatTab 发送的历史来自 ChatSession.prepare：每轮只预填充新的用户输入
+def test_history_prepared_by_the_chat_session_reuses_the_prefix():
+    from chat_session import ChatSession
+    from request_engine import RequestParams
+
+    chat = ChatSession()
+    pipeline = FakePipeline()
+    params = RequestParams("local model", "", model_path="model.bin", max_tokens=100)
+    prefills = []
+    for turn in range(5):
+        messages, _ = chat.prepare(params, f"question {turn}")
+        reply, prefill = run_turn(chat.local_session, pipeline, messages)
+        chat.finish(params, reply)
+        prefills.append(prefill)
+    assert prefills[1:] == [1 + len("question 0") + 1] * 4
+
+
+# ChatTab.clear 经由 ChatSession.clear 清空缓存
+def test_clearing_the_chat_session_invalidates_the_cache():
+    from chat_session import ChatSession
+
+    chat = ChatSession()
+    pipeline = FakePipeline()
+    run_turn(chat.local_session, pipeline, ["hello"])
+    assert chat.local_session.cached_ids
+    chat.clear()
+    assert chat.local_session.cached_ids == []
+
+
+# 没有逐 token 接口的模型：pipeline.chat 每隔 delay 秒产出一个字符，记下同时在生成的请求数
+class SlowPipeline:
+    def __init__(self, delay=0.02):
+        self.delay = delay
+        self.generating = 0
+        self.peak = 0
+        self.tokens = 0
+
+    def chat(self, history, stream=False, **kwargs):
+        self.generating += 1
+        self.peak = max(self.peak, self.generating)
+        try:
+            for c in "reply to " + history[-1]:
+                time.sleep(self.delay)
+                self.tokens += 1
+                yield c
+        finally:
+            self.generating -= 1
+
+
+@pytest.fixture
+def slow_model(monkeypatch):
+    import local_session
+    from model_registry import ModelRegistry
+    from request_engine import RequestEngine
+
+    pipeline = SlowPipeline()
+    engine = RequestEngine(max_concurrency=1, max_workers=1)
+    monkeypatch.setattr(local_session, "registry", ModelRegistry(loader=lambda path: pipeline))
+    monkeypatch.setattr(local_session, "engine", engine)
+    yield pipeline, engine
+    engine.stop()
+
+
+def stream_threads():
+    return sum(thread.name.startswith("stream") for thread in threading.enumerate())
+
+
+# 同一个模型的多个请求(例如文档的各段、对冲请求)共用一个名额：排队的请求不占线程，一个接一个生成，不会卡死
+def test_queued_local_requests_do_not_hold_threads(slow_model):
+    from local_session import stream_local_reply
+
+    pipeline, engine = slow_model
+    threads = []
+
+    async def reply(prompt):
+        chunks = []
+        async for chunk in stream_local_reply("model.bin", [prompt]):
+            threads.append(stream_threads())
+            chunks.append(chunk)
+        return "".join(chunks)
+
+    async def run():
+        return await asyncio.gather(*(reply(f"segment {i}") for i in range(6)))
+
+    assert engine.submit(run()).result(10) == [f"reply to segment {i}" for i in range(6)]
+    assert pipeline.peak == 1 and max(threads) == 1
+
+
+# 停止正在生成的请求：生成在当前 token 之后结束，下一个请求马上开始
+def test_cancelled_local_request_stops_generating(slow_model):
+    from local_session import stream_local_reply
+
+    pipeline, engine = slow_model
+    pipeline.delay = 0.05
+    started = asyncio.Event()
+
+    async def first():
+        async for _ in stream_local_reply("model.bin", ["x" * 200]):
+            started.set()
+
+    async def second():
+        return "".join([chunk async for chunk in stream_local_reply("model.bin", ["y"])])
+
+    async def run():
+        task = asyncio.ensure_future(first())
+        await started.wait()
+        task.cancel()
+        return await second()
+
+    assert engine.submit(run()).result(3) == "reply to y"
+    assert pipeline.tokens < 20 and pipeline.generating == 0
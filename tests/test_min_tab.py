@@ -0,0 +1,65 @@
+import os
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("PySide6")
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from PySide6.QtWidgets import QApplication  # noqa: E402
+
+import component  # noqa: E402
+from qt_bridge import QtBridge  # noqa: E402
+from request_engine import engine  # noqa: E402
+from translation_cache import TranslationCache  # noqa: E402
+
+
+# 查缓存时记下所在的线程
+class RecordingCache(TranslationCache):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.threads = []
+
+    def get(self, *key):
+        self.threads.append(threading.current_thread())
+        return super().get(*key)
+
+
+@pytest.fixture
+def tab(api_key, tmp_path, monkeypatch):
+    app = QApplication.instance() or QApplication([])
+    bridge = QtBridge()
+    monkeypatch.setattr(engine, "dispatcher", bridge.dispatch)
+    monkeypatch.setattr(component, "translation_cache", RecordingCache(path=str(tmp_path / "translations.db")))
+    app.clipboard().setText("")
+    tab = component.MinTab(api_key, debounce_ms=10)
+    yield tab
+    tab.cancel_requests()
+    tab.deleteLater()
+    app.processEvents()
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        QApplication.processEvents()
+        time.sleep(0.01)
+
+
+def shown(tab):
+    return "".join(text for _, text in tab.transcript)
+
+
+# 复制回已经翻译过的文本：命中缓存，不再请求模型；每次剪贴板变化的查缓存都不在GUI线程中进行
+def test_copied_text_is_looked_up_in_the_cache_off_the_gui_thread(tab, fake_openai):
+    fake_openai.reply = lambda body: "译文：" + body["messages"][-1]["content"][-12:]
+    for text in ("Good morning", "Good evening", "Good morning"):
+        QApplication.clipboard().setText(text)
+        wait_until(lambda: shown(tab).endswith(text))
+
+    assert len(fake_openai.requests) == 2
+    cache = component.translation_cache
+    assert len(cache.threads) == 3 and threading.main_thread() not in cache.threads
+    assert cache.stats() == (1, 2)
@@ -0,0 +1,65 @@
+import socket
+import threading
+
+from openai_client import ClientPool, create_chat_completion, stream_text
+
+
+def chat(client, text, stream=False):
+    response = create_chat_completion(client, model="gpt-3.5-turbo", messages=[{"role": "user", "content": text}],
+                                      stream=stream)
+    if stream:
+        return "".join(stream_text(response))
+    return response.choices[0].message.content
+
+
+def test_sequential_requests_reuse_one_connection(fake_openai):
+    pool = ClientPool()
+    client = pool.get("sk-test", fake_openai.url)
+    for i in range(10):
+        assert chat(client, f"hello {i}", stream=i % 2 == 0) == f"hello {i}"
+    pool.close()
+
+    assert len(fake_openai.requests) == 10
+    assert fake_openai.connections == 1
+
+
+def test_pool_hands_out_one_client_per_key_and_base_url(fake_openai):
+    pool = ClientPool()
+    assert pool.get("sk-a", fake_openai.url) is pool.get("sk-a", fake_openai.url)
+    assert pool.get("sk-a", fake_openai.url) is not pool.get("sk-b", fake_openai.url)
+    pool.close()
+
+
+def test_warm_up_opens_the_connection_the_first_request_uses(fake_openai):
+    pool = ClientPool()
+    assert pool.warm_up("sk-test", fake_openai.url) is None
+    assert fake_openai.connections == 1
+
+    client = pool.get("sk-test", fake_openai.url)
+    for i in range(3):
+        chat(client, f"hello {i}")
+    pool.close()
+    assert fake_openai.connections == 1
+
+
+def test_failed_warm_up_reports_the_error_without_printing(capsys):
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]   # 关闭后这个端口上没有服务
+    pool = ClientPool()
+    pool.configure(connect_timeout=2.0)
+    errors = []
+    done = threading.Event()
+
+    def on_error(error):
+        errors.append(error)
+        done.set()
+
+    pool.warm_up_in_background("sk-test", f"http://127.0.0.1:{port}/v1", on_error=on_error)
+    assert done.wait(10)
+    pool.close()
+
+    import httpx
+
+    assert isinstance(errors[0], httpx.ConnectError)
+    assert capsys.readouterr().out == ""
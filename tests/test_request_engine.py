@@ -0,0 +1,179 @@
+import asyncio
+import concurrent.futures
+import threading
+import time
+
+import pytest
+
+from request_engine import RequestEngine
+
+
+@pytest.fixture
+def engine():
+    engine = RequestEngine(max_concurrency=1)
+    yield engine
+    engine.stop()
+
+
+# 记录同时在运行(占着名额)的请求数
+class Tracker:
+    def __init__(self):
+        self.running = 0
+        self.peak = 0
+
+    def enter(self):
+        self.running += 1
+        self.peak = max(self.peak, self.running)
+
+    def leave(self):
+        self.running -= 1
+
+
+def test_idle_lets_another_request_run_while_waiting(engine):
+    other_started = asyncio.Event()
+
+    async def waiting():
+        async with engine.idle():
+            await other_started.wait()   # 不让出名额的话 other 永远不会开始
+        return "done"
+
+    async def other():
+        other_started.set()
+
+    first = engine.submit(waiting())
+    second = engine.submit(other())
+    assert first.result(5) == "done"
+    second.result(5)
+
+
+def test_idle_in_subtasks_does_not_release_the_parent_slot(engine):
+    tracker = Tracker()
+
+    async def fan_out():
+        tracker.enter()
+
+        async def subtask():
+            async with engine.idle():
+                await asyncio.sleep(0.05)
+
+        await asyncio.gather(*(subtask() for _ in range(3)))
+        await asyncio.sleep(0.05)
+        tracker.leave()
+
+    async def request():
+        tracker.enter()
+        await asyncio.sleep(0.02)
+        tracker.leave()
+
+    futures = [engine.submit(fan_out())] + [engine.submit(request()) for _ in range(3)]
+    for future in futures:
+        future.result(5)
+    assert tracker.peak == 1
+
+
+def test_nested_idle_releases_the_slot_once(engine):
+    tracker = Tracker()
+
+    async def nested():
+        async with engine.idle():
+            async with engine.idle():
+                await asyncio.sleep(0.05)
+        tracker.enter()
+        await asyncio.sleep(0.05)
+        tracker.leave()
+
+    async def request():
+        tracker.enter()
+        await asyncio.sleep(0.02)
+        tracker.leave()
+
+    futures = [engine.submit(nested())] + [engine.submit(request()) for _ in range(3)]
+    for future in futures:
+        future.result(5)
+    assert tracker.peak == 1
+
+
+# 每 delay 秒产出一项的阻塞生成器，记录是否被关闭
+class SlowStream:
+    def __init__(self, delay=0.2):
+        self.delay = delay
+        self.produced = 0
+        self.closed = threading.Event()
+
+    def __iter__(self):
+        try:
+            while True:
+                time.sleep(self.delay)
+                self.produced += 1
+                yield f"chunk {self.produced} "
+        finally:
+            self.closed.set()
+
+
+def test_cancelling_mid_stream_settles_promptly_and_closes_the_generator(engine):
+    stream = SlowStream()
+    received = []
+    first = threading.Event()
+
+    async def consume():
+        async for chunk in engine.iterate(iter, stream):
+            received.append(chunk)
+            first.set()
+
+    future = engine.submit(consume())
+    assert first.wait(5)
+    started = time.monotonic()
+    future.cancel()
+    with pytest.raises(concurrent.futures.CancelledError):
+        future.result(1)
+    assert time.monotonic() - started < 0.1
+
+    # 正在进行的 next() 返回后生成器被关闭，它的 finally 会执行
+    assert stream.closed.wait(1)
+    assert received and stream.produced <= len(received) + 1
+
+
+def test_cancelling_calls_abort_to_unblock_a_pending_read(engine):
+    unblock = threading.Event()
+    closed = threading.Event()
+    started = threading.Event()
+
+    def blocking_stream():
+        try:
+            yield "first"
+            started.set()
+            unblock.wait()      # 像一个等不到数据的 HTTP 读取
+            yield "never"
+        finally:
+            closed.set()
+
+    async def consume():
+        async for _ in engine.iterate(blocking_stream, abort=unblock.set):
+            pass
+
+    future = engine.submit(consume())
+    assert started.wait(5)
+    future.cancel()
+    assert unblock.wait(1)
+    assert closed.wait(1)
+
+
+def test_cancelling_runs_the_async_generators_finally(engine):
+    cleaned_up = threading.Event()
+    first = threading.Event()
+
+    async def replies():
+        try:
+            async for chunk in engine.iterate(iter, SlowStream()):
+                yield chunk
+        finally:
+            cleaned_up.set()
+
+    async def consume():
+        async for _ in replies():
+            first.set()
+
+    future = engine.submit(consume())
+    assert first.wait(5)
+    future.cancel()
+    assert cleaned_up.wait(1)
@@ -0,0 +1,98 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+
+import pytest
+
+from key_pool import ApiKey, key_pool
+from scheduler import PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE, RequestScheduler, _ModelQueue
+
+
+def drain(queue):
+    order = []
+    while (head := queue.head()) is not None:
+        order.append(queue.pop(*head)[2])
+    return order
+
+
+def test_queue_takes_turns_between_owners_within_a_priority():
+    queue = _ModelQueue("gpt-3.5-turbo")
+    waiters = [(PRIORITY_BACKGROUND, "widget", "w1"), (PRIORITY_INTERACTIVE, "tab 1", "a1"),
+               (PRIORITY_INTERACTIVE, "tab 1", "a2"), (PRIORITY_INTERACTIVE, "tab 1", "a3"),
+               (PRIORITY_INTERACTIVE, "tab 2", "b1"), (PRIORITY_INTERACTIVE, "tab 2", "b2"),
+               (PRIORITY_INTERACTIVE, "tab 3", "c1"), (PRIORITY_BACKGROUND, "widget", "w2")]
+    loop = asyncio.new_event_loop()
+    for priority, owner, name in waiters:
+        queue.classes.setdefault(priority, OrderedDict()).setdefault(owner, deque()).append(
+            (loop.create_future(), 0, name))
+    loop.close()
+
+    assert drain(queue) == ["a1", "b1", "c1", "a2", "b2", "a3", "w1", "w2"]
+
+
+@pytest.fixture
+def one_key(monkeypatch):
+    key = ApiKey("test", "sk-test")
+    monkeypatch.setattr(key_pool, "keys", [key])
+    return key
+
+
+# 密钥暂停期间排队的请求在恢复后按优先级、来源轮流的顺序放行
+def test_acquire_releases_waiters_round_robin(one_key):
+    scheduler = RequestScheduler()
+    order = []
+
+    async def request(owner, name, priority=PRIORITY_INTERACTIVE):
+        await scheduler.acquire("gpt-3.5-turbo", priority=priority, owner=owner)
+        order.append(name)
+
+    async def run():
+        key_pool.pause(one_key, 0.1)
+        tasks = [asyncio.create_task(request("widget", "w1", PRIORITY_BACKGROUND))]
+        for owner, name in [("tab 1", "a1"), ("tab 1", "a2"), ("tab 1", "a3"), ("tab 2", "b1"), ("tab 3", "c1")]:
+            tasks.append(asyncio.create_task(request(owner, name)))
+        await asyncio.sleep(0.02)
+        assert scheduler.queue_depth() == 6
+        await asyncio.gather(*tasks)
+
+    asyncio.run(run())
+    assert order == ["a1", "b1", "c1", "a2", "a3", "w1"]
+    assert scheduler.queue_depth() == 0
+    assert scheduler.average_wait() > 0.05
+
+
+def test_requests_beyond_the_rate_limit_wait_for_the_bucket_to_refill(one_key):
+    scheduler = RequestScheduler()
+    scheduler.configure(limits={"gpt-3.5-turbo": (600, 0)})   # 每 0.1 秒补充一个
+    one_key.buckets("gpt-3.5-turbo", scheduler.limits)[0].tokens = 0
+
+    async def run():
+        started = time.monotonic()
+        for _ in range(3):
+            await scheduler.acquire("gpt-3.5-turbo")
+        return time.monotonic() - started
+
+    assert 0.25 <= asyncio.run(run()) < 1.0
+
+
+def test_cancelled_waiter_does_not_block_the_queue(one_key):
+    scheduler = RequestScheduler()
+
+    async def run():
+        key_pool.pause(one_key, 0.1)
+        blocked = asyncio.create_task(scheduler.acquire("gpt-3.5-turbo", owner="tab 1"))
+        behind = asyncio.create_task(scheduler.acquire("gpt-3.5-turbo", owner="tab 1"))
+        await asyncio.sleep(0.02)
+        blocked.cancel()
+        return await asyncio.wait_for(behind, 1)
+
+    assert asyncio.run(run()) is one_key
+    assert scheduler.queue_depth() == 0
+
+
+def test_all_keys_quarantined_fails_the_waiter(one_key):
+    scheduler = RequestScheduler()
+    key_pool.quarantine(one_key)
+
+    with pytest.raises(RuntimeError, match="No usable API key"):
+        asyncio.run(scheduler.acquire("gpt-3.5-turbo"))
@@ -0,0 +1,76 @@
+import pytest
+
+from search_index import SearchIndex, fts_query, index_text, make_snippet, query_tokens
+
+MESSAGES = [("user", "今天天气很好，我们去公园散步吧"),
+            ("gpt", "The weather is nice today, let's take a walk in the park"),
+            ("translation", "天気がいいので公園を散歩しましょう"),
+            ("user", "机器学习和深度学习有什么区别？"),
+            ("gpt", "深度学习是机器学习的一个分支"),
+            ("user", "오늘 날씨가 좋아요")]
+
+
+@pytest.fixture
+def index(tmp_path):
+    index = SearchIndex(path=str(tmp_path / "search.db"))
+    source = index.source("Tab 1", tab=1)
+    for i, (role, text) in enumerate(MESSAGES):
+        source.add(i, role, text)
+    source.add(len(MESSAGES), "notice", "公园的提示不建索引")
+    assert index.flush()
+    yield index
+    index.close()
+
+
+def found(index, query):
+    return sorted(hit.index for hit in index.search(query))
+
+
+def test_cjk_runs_are_indexed_as_bigrams_plus_the_last_character():
+    assert index_text("学习机器").split() == ["学习", "习机", "机器", "器"]
+    assert query_tokens("机器学习") == ["机器", "器学", "学习"]
+    assert query_tokens("学") == ["学"]
+    assert query_tokens("GPT模型") == ["GPT", "模型"]
+
+
+def test_the_last_term_and_single_cjk_characters_match_as_prefixes():
+    assert fts_query("机器 学") == '"机器" "学" *'
+    assert fts_query("学 walk") == '"学" * "walk" *'
+    assert fts_query('say "hi"') == '"say" """hi""" *'
+    assert fts_query("   ") == ""
+
+
+def test_chinese_words_match_inside_longer_runs(index):
+    assert found(index, "公园") == [0]
+    assert found(index, "机器学习") == [3, 4]
+    assert found(index, "深度学习 分支") == [4]
+    assert found(index, "学习机器") == []     # 字都在，但不相邻
+
+
+def test_single_characters_match_anywhere_in_a_run(index):
+    assert found(index, "园") == [0]
+    assert found(index, "散") == [0, 2]      # 散步、散歩
+    assert found(index, "支") == [4]
+
+
+def test_japanese_korean_and_latin_text(index):
+    assert found(index, "公園") == [2]
+    assert found(index, "散歩") == [2]
+    assert found(index, "날씨가") == [5]
+    assert found(index, "Weather PAR") == [1]
+
+
+def test_hits_carry_the_source_and_a_snippet(index):
+    [hit] = index.search("分支")
+    assert (hit.source, hit.tab, hit.index, hit.role) == ("Tab 1", 1, 4, "gpt")
+    assert hit.snippet == "深度学习是机器学习的一个分支"
+    assert make_snippet("word " * 40 + "needle", "needle", width=20).startswith("…")
+
+
+# 标签页清空后消息仍然能搜索到，但没有可以跳转的标签页
+def test_detached_tab_keeps_its_messages_searchable(index):
+    index.source("Tab 1", tab=1).detach()
+    assert index.flush()
+    [hit] = index.search("公园")
+    assert hit.tab is None and hit.source == "Tab 1"
+    assert index.count() == len(MESSAGES)
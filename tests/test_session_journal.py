@@ -0,0 +1,94 @@
+import gzip
+import json
+import os
+
+import pytest
+
+from session_journal import JournalWriter, iter_messages, read_events, since_last_clear
+
+
+@pytest.fixture
+def writer(tmp_path):
+    writer = JournalWriter(folder=str(tmp_path), max_bytes=300, fsync_interval=0.05)
+    yield writer
+    writer.close()
+
+
+# 每条记录单独写入：写线程在一批记录写完后才检查大小，逐条写入时每个旧文件最多超出一行
+def record_messages(journal, start, count):
+    for i in range(start, start + count):
+        journal.record("message", index=i, role="user", text=f"message {i}")
+        assert journal.flush()
+
+
+# 超过 max_bytes 换新文件：旧文件按顺序编号，读回的记录和写入的顺序一致
+def test_journal_rotates_into_numbered_parts(writer):
+    journal = writer.open_session()
+    record_messages(journal, 0, 20)
+
+    paths = journal.paths()
+    root = os.path.splitext(journal.path)[0]
+    assert len(paths) > 3
+    assert paths[:-1] == [f"{root}.{n:03d}.jsonl" for n in range(1, len(paths))]
+    assert all(300 <= os.path.getsize(path) < 400 for path in paths[:-1])
+    assert [event["index"] for event in read_events(paths)] == list(range(20))
+
+
+def test_rotated_parts_are_compressed(writer):
+    writer.configure(compress=True)
+    journal = writer.open_session()
+    record_messages(journal, 0, 20)
+
+    paths = journal.paths()
+    assert all(path.endswith(".jsonl.gz") for path in paths[:-1])
+    assert not any(os.path.exists(path[:-3]) for path in paths[:-1])
+    with gzip.open(paths[0], "rt", encoding="utf-8") as f:
+        assert json.loads(f.readline())["index"] == 0
+    assert [event["index"] for event in read_events(paths)] == list(range(20))
+
+
+# 恢复的标签页接着写原来的日志：沿用已有的旧文件，编号接着往后排
+def test_reopened_journal_continues_after_existing_parts(writer):
+    journal = writer.open_session()
+    record_messages(journal, 0, 10)
+    journal.close()
+    parts = journal.paths()[:-1]
+
+    reopened = writer.open_session(journal.path)
+    assert reopened.paths() == journal.paths()
+    record_messages(reopened, 10, 10)
+    assert reopened.paths()[:len(parts)] == parts and len(reopened.paths()) > len(parts) + 1
+    assert [event["index"] for event in read_events(reopened.paths())] == list(range(20))
+
+
+# 程序崩溃时最后一行只写了一半：这一行被跳过，没有结束的流式回复保留已经写下的部分
+def test_recovery_skips_a_torn_last_line_and_keeps_partial_replies(tmp_path):
+    path = tmp_path / "session.jsonl"
+    events = [dict(event="message", index=0, role="user", text="hello", time=1.0),
+              dict(event="start", index=1, role="gpt", text="", time=2.0, model="gpt-4"),
+              dict(event="message", index=2, role="notice", text="queued", time=2.5),
+              dict(event="append", index=1, text="Hi", time=3.0),
+              dict(event="append", index=1, text=" there", time=3.5)]
+    path.write_text("".join(json.dumps(event) + "\n" for event in events) + '{"event": "append", "ind',
+                    encoding="utf-8")
+
+    messages = list(iter_messages(read_events([str(path)])))
+    assert [(message["role"], message["text"]) for message in messages] == [
+        ("user", "hello"), ("gpt", "Hi there"), ("notice", "queued")]
+    assert messages[1]["model"] == "gpt-4" and "finished" not in messages[1]
+
+
+# 交错的流式回复按编号顺序产出；清空后只导出最后一次清空之后的消息
+def test_messages_come_out_in_order_and_clear_starts_over(tmp_path):
+    path = tmp_path / "session.jsonl"
+    events = [dict(event="message", index=0, role="user", text="old", time=1.0),
+              dict(event="clear", time=2.0),
+              dict(event="start", index=0, role="gpt", text="A", time=3.0),
+              dict(event="message", index=1, role="notice", text="B", time=3.1),
+              dict(event="append", index=0, text="a", time=3.2),
+              dict(event="end", index=0, time=4.0, latency_ms=1000)]
+    path.write_text("".join(json.dumps(event) + "\n" for event in events), encoding="utf-8")
+
+    messages = list(iter_messages(since_last_clear([str(path)])))
+    assert [(message["role"], message["text"]) for message in messages] == [("gpt", "Aa"), ("notice", "B")]
+    assert messages[0]["finished"] == 4.0 and messages[0]["latency_ms"] == 1000
@@ -0,0 +1,78 @@
+import json
+import re
+import signal
+import threading
+
+import pytest
+
+import translate_cli
+from job_queue import job_queue
+from request_engine import engine
+from translation_cache import translation_cache
+
+
+# 命令行用的配置：密钥指向 fake_openai，缓存和任务队列放在临时目录；全局对象的设置在测试结束时恢复
+@pytest.fixture
+def cli(fake_openai, api_key, tmp_path, monkeypatch):
+    monkeypatch.setattr(translation_cache, "path", translation_cache.path)
+    monkeypatch.setattr(job_queue, "path", job_queue.path)
+    monkeypatch.setattr(engine, "max_concurrency", engine.max_concurrency)
+    config = tmp_path / "config.ini"
+    config.write_text(f"[API]\nkey = sk-test\nbase_url = {fake_openai.url}\n\n"
+                      f"[Cache]\npath = {tmp_path / 'translations.db'}\n\n"
+                      f"[Jobs]\npath = {tmp_path / 'jobs.db'}\n")
+    fake_openai.reply = lambda body: f"译文 {unit_number(body)}"
+
+    def main(*args):
+        return translate_cli.main([*args, "--config", str(config)])
+    return main
+
+
+def unit_number(body):
+    return int(re.search(r"Unit (\d+)", body["messages"][-1]["content"]).group(1))
+
+
+def write_units(path, count):
+    path.write_text("".join(json.dumps({"id": i, "text": f"Unit {i}"}) + "\n" for i in range(count)))
+    return path
+
+
+def read_translations(path):
+    return [(record["id"], record["translation"]) for record in map(json.loads, path.read_text().splitlines())]
+
+
+# 前面的单元回复得最慢，输出文件仍然按原文的顺序
+def test_units_are_written_in_source_order(cli, fake_openai, tmp_path):
+    fake_openai.delay = lambda body: 0.02 * (8 - unit_number(body))
+    source = write_units(tmp_path / "units.jsonl", 8)
+
+    assert cli(str(source), "-j", "4") == 0
+    assert read_translations(tmp_path / "units.Chinese.jsonl") == [(i, f"译文 {i}") for i in range(8)]
+
+
+def test_a_failed_unit_sets_the_exit_code_and_keeps_the_target_untouched(cli, fake_openai, tmp_path, capsys):
+    fake_openai.fail = lambda body, headers: (400, "bad unit") if unit_number(body) == 2 else None
+    source = write_units(tmp_path / "units.jsonl", 4)
+
+    assert cli(str(source)) == 1
+    assert not (tmp_path / "units.Chinese.jsonl").exists()
+    assert "units.jsonl: Error:" in capsys.readouterr().err
+
+
+# 翻译单元 3 时按下 Ctrl+C：已完成的单元留在任务队列里，--resume 只请求剩下的单元
+def test_resume_after_an_interrupt_translates_only_the_remaining_units(cli, fake_openai, tmp_path):
+    def reply(body):
+        if unit_number(body) == 3 and len(fake_openai.requests) == 4:
+            signal.pthread_kill(threading.main_thread().ident, signal.SIGINT)
+        return f"译文 {unit_number(body)}"
+    fake_openai.reply = reply
+    fake_openai.delay = lambda body: 0.5 if unit_number(body) == 3 else 0.0
+    source = write_units(tmp_path / "units.jsonl", 6)
+
+    assert cli(str(source), "--durable", "-j", "1") == 1
+    assert [unit_number(body) for _, body in fake_openai.requests] == [0, 1, 2, 3]
+    assert not (tmp_path / "units.Chinese.jsonl").exists()
+
+    assert cli("--resume", "-j", "1") == 0
+    assert [unit_number(body) for _, body in fake_openai.requests[4:]] == [3, 4, 5]
+    assert read_translations(tmp_path / "units.Chinese.jsonl") == [(i, f"译文 {i}") for i in range(6)]
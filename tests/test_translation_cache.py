@@ -0,0 +1,108 @@
+import os
+import sqlite3
+import time
+
+from translation_cache import TranslationCache, normalize_text
+
+
+def make_cache(tmp_path, **kwargs):
+    return TranslationCache(path=os.path.join(tmp_path, "translations.db"), **kwargs)
+
+
+def test_normalized_source_text_hits_the_same_entry(tmp_path):
+    cache = make_cache(tmp_path)
+    cache.put("Hello   world\n  second  line ", "Chinese", "Academic", "gpt-4", "你好世界")
+    assert cache.get(" Hello world\nsecond line", "Chinese", "academic", "gpt-4") == "你好世界"
+    assert normalize_text("Café ") == "Café"
+    assert cache.stats() == (1, 0)
+
+
+def test_language_style_and_model_are_part_of_the_key(tmp_path):
+    cache = make_cache(tmp_path)
+    cache.put("Hello", "Chinese", "Academic", "gpt-4", "你好")
+    assert cache.get("Hello", "Japanese", "Academic", "gpt-4") is None
+    assert cache.get("Hello", "Chinese", "Casual", "gpt-4") is None
+    assert cache.get("Hello", "Chinese", "Academic", "gpt-3.5-turbo") is None
+    assert cache.stats() == (0, 3)
+
+
+def test_memory_keeps_only_the_most_recently_used_entries(tmp_path):
+    cache = make_cache(tmp_path, memory_entries=2)
+    for text in ("a", "b", "c"):
+        cache.put(text, "Chinese", "", "gpt-4", text.upper())
+    assert [translation for translation, _ in cache._memory.values()] == ["B", "C"]
+    assert cache.get("a", "Chinese", "", "gpt-4") == "A"   # 从磁盘读回，放进内存
+    assert [translation for translation, _ in cache._memory.values()] == ["C", "A"]
+
+
+# 超出磁盘上限时按最久未使用的顺序删除到上限的 90%
+def test_disk_evicts_least_recently_used_entries_over_the_size_limit(tmp_path):
+    cache = make_cache(tmp_path, memory_entries=0, max_bytes=450)
+    for text in ("a", "b", "c", "d"):
+        cache.put(text, "Chinese", "", "gpt-4", text * 100)
+    assert cache.get("a", "Chinese", "", "gpt-4") == "a" * 100   # a 变成最近用过的
+
+    cache.put("e", "Chinese", "", "gpt-4", "e" * 100)
+    kept = [text for text in "abcde" if cache.get(text, "Chinese", "", "gpt-4") is not None]
+    assert kept == ["a", "c", "d", "e"]
+    assert cache._disk_bytes == 400
+
+
+def test_entries_older_than_max_age_are_misses(tmp_path):
+    cache = make_cache(tmp_path, memory_entries=0, max_age_days=0)
+    cache.put("Hello", "Chinese", "", "gpt-4", "你好")
+    assert cache.get("Hello", "Chinese", "", "gpt-4") is None
+
+
+# 内存中的条目也按写入时间过期，不会在进程运行期间一直命中
+def test_entries_in_memory_expire_too(tmp_path, monkeypatch):
+    cache = make_cache(tmp_path, max_age_days=1)
+    cache.put("Hello", "Chinese", "", "gpt-4", "你好")
+    assert cache.get("Hello", "Chinese", "", "gpt-4") == "你好"
+
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + 2 * 24 * 3600)
+    assert cache.get("Hello", "Chinese", "", "gpt-4") is None
+    assert not cache._memory and cache.stats() == (1, 1)
+
+
+def last_used(tmp_path):
+    with sqlite3.connect(os.path.join(tmp_path, "translations.db")) as conn:
+        return dict(conn.execute("SELECT translation, last_used FROM translations"))
+
+
+# 命中时不每次写盘：last_used 攒够一批、写入新条目或关闭时才提交
+def test_last_used_is_written_in_batches(tmp_path):
+    cache = make_cache(tmp_path, touch_batch=3)
+    for text in "abc":
+        cache.put(text, "Chinese", "", "gpt-4", text.upper())
+    written = last_used(tmp_path)
+
+    cache.get("a", "Chinese", "", "gpt-4")
+    cache.get("b", "Chinese", "", "gpt-4")
+    assert last_used(tmp_path) == written
+    cache.get("c", "Chinese", "", "gpt-4")
+    assert all(last_used(tmp_path)[text] > written[text] for text in "ABC")
+
+    written = last_used(tmp_path)
+    cache.get("a", "Chinese", "", "gpt-4")
+    assert last_used(tmp_path) == written
+    cache.close()
+    assert last_used(tmp_path)["A"] > written["A"]
+
+
+def test_entries_survive_a_restart(tmp_path):
+    cache = make_cache(tmp_path)
+    cache.put("Hello", "Chinese", "", "gpt-4", "你好")
+    cache.close()
+
+    reopened = make_cache(tmp_path)
+    assert reopened.get("Hello", "Chinese", "", "gpt-4") == "你好"
+    assert reopened._disk_bytes == len("你好".encode("utf-8"))
+
+
+def test_disabled_cache_stores_nothing(tmp_path):
+    cache = make_cache(tmp_path, enabled=False)
+    cache.put("Hello", "Chinese", "", "gpt-4", "你好")
+    cache.configure(enabled=True)
+    assert cache.get("Hello", "Chinese", "", "gpt-4") is None
@@ -0,0 +1,75 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from voice_activity import SAMPLE_WIDTH, SilenceTrimmer, VoiceActivityDetector  # noqa: E402
+
+RATE = 16000
+FRAME = RATE * 30 // 1000       # 30 ms 一帧
+KEEP = 10                       # max_silence=0.6 时静音两头各保留 0.3 秒，也就是 10 帧
+
+
+def tone(frames, amplitude=8000, frequency=440):
+    t = np.arange(frames * FRAME) / RATE
+    return (amplitude * np.sin(2 * np.pi * frequency * t)).astype("<i2").tobytes()
+
+
+def silence(frames):
+    return bytes(frames * FRAME * SAMPLE_WIDTH)
+
+
+def trim(pcm, chunk=1000, **settings):
+    trimmer = SilenceTrimmer(RATE, max_silence=0.6, **settings)
+    output = b"".join(trimmer.feed(pcm[i:i + chunk]) for i in range(0, len(pcm), chunk))
+    return trimmer, output + trimmer.finish()
+
+
+def test_tone_is_speech_and_digital_silence_is_not():
+    detector = VoiceActivityDetector(RATE)
+    samples = np.frombuffer(silence(3) + tone(3) + silence(3), dtype="<i2").reshape(9, FRAME)
+    assert detector.classify(samples).tolist() == [False] * 3 + [True] * 3 + [False] * 3
+
+
+# 开头 1.2 秒、中间 1.8 秒、结尾 1.5 秒的静音：开头和结尾只留紧挨着语音的 0.3 秒，中间留两头各 0.3 秒
+def test_long_silences_are_cut_to_max_silence_and_speech_is_unchanged():
+    first, second = tone(20), tone(20, amplitude=4000, frequency=300)
+    trimmer, output = trim(silence(40) + first + silence(60) + second + silence(50))
+
+    assert output == silence(KEEP) + first + silence(2 * KEEP) + second + silence(KEEP)
+    assert trimmer.speech_frames == 40
+    assert trimmer.removed_seconds == pytest.approx((40 + 60 + 50 - 4 * KEEP) * 0.03)
+
+
+def test_silences_shorter_than_max_silence_are_kept_whole():
+    pcm = tone(10) + silence(15) + tone(10)
+    assert trim(pcm)[1] == pcm
+
+
+def test_recording_without_speech_produces_nothing():
+    trimmer, output = trim(silence(100))
+    assert output == b"" and trimmer.speech_frames == 0
+
+
+# 帧被拆在两块数据之间时结果一样
+@pytest.mark.parametrize("chunk", [1, 333, FRAME * SAMPLE_WIDTH, 100000])
+def test_output_does_not_depend_on_how_the_input_is_chunked(chunk):
+    pcm = silence(30) + tone(7) + silence(25) + tone(5) + silence(12)
+    assert trim(pcm, chunk)[1] == trim(pcm, len(pcm))[1]
+
+
+# 停顿(语音之后 0.3 秒的静音)处把输出分开，用来边录边切段
+def test_split_starts_a_new_piece_after_each_pause():
+    first, second = tone(20), tone(20, frequency=300)
+    trimmer = SilenceTrimmer(RATE, max_silence=0.6)
+    pieces = trimmer.split(first + silence(60) + second + silence(5))
+    assert pieces == [first + silence(KEEP), silence(KEEP) + second + silence(5)]
+
+
+# 持续的背景噪声慢慢抬高阈值，之后同样响的噪声不再算作语音，比它响得多的说话仍然算
+def test_steady_background_noise_raises_the_threshold():
+    detector = VoiceActivityDetector(RATE, noise_rise_db=6.0)
+    noise = np.random.default_rng(0).normal(0, 300, 400 * FRAME).astype("<i2")
+    speech = detector.classify(noise.reshape(400, FRAME))
+    assert speech[:10].all() and not speech[-100:].any()
+    loud = np.frombuffer(tone(5, amplitude=12000), dtype="<i2").reshape(5, FRAME)
+    assert detector.classify(loud).all()
@@ -0,0 +1,170 @@
+import sqlite3
+
+# 导出为文本时各角色的前缀，和聊天记录中显示的一致
+PREFIXES = {"user": "You: ", "gpt": "GPT: ", "translation": "GPT: ", "error": "ERROR: ", "notice": ""}
+
+MESSAGES_TABLE = ("CREATE TABLE IF NOT EXISTS messages (tab INTEGER NOT NULL, idx INTEGER NOT NULL, role TEXT NOT NULL, "
+                  "text TEXT NOT NULL, PRIMARY KEY (tab, idx)) WITHOUT ROWID")
+
+
+# update_chat_log 的 message_type 对应的角色
+def message_role(message_type):
+    if message_type in ("user", "error", "notice"):
+        return message_type
+    return "translation" if message_type.endswith("translation") else "gpt"
+
+
+# 聊天记录的消息模型：每条消息是 (角色, 文本)，流式回复追加到最后一条消息上
+# 内存中最多保留 max_messages 条，更早的消息成批移到 archive(默认是临时的SQLite文件)中，按下标仍然可以读取；
+# 会话再长，内存中的消息数也不变。只在GUI线程中使用
+# 设置了 journal(会话日志)时，每次写入同时记入日志；设置了 search(全文索引的来源)时，每条消息完整之后交给它建索引
+class Transcript:
+    def __init__(self, max_messages=500, journal=None, archive=None, search=None):
+        self.max_messages = max(2, max_messages)
+        self.journal = journal
+        self.search = search
+        self.generation = 0     # 每次清空加一，视图据此丢弃缓存的排版
+        self._messages = []     # 内存中较新的消息 [role, text]
+        self._archive = archive or MessageArchive()  # 移到磁盘上的消息，它们的下标在内存中的消息之前
+        self._open = False      # 最后一条消息是否还在流式输出
+
+    def __len__(self):
+        return self._archive.count + len(self._messages)
+
+    # 按 update_chat_log 的约定写入：*-start 开始一条流式消息，gpt/gpt-translation 追加，*-end 结束
+    # details 是记入日志的附加信息：开始时的模型和参数，结束时的耗时
+    def write(self, message_type, message, details=None):
+        details = details or {}
+        role = message_role(message_type)
+        if message_type.startswith("gpt-start"):
+            self._add(role, message, True, details)
+        elif message_type.startswith("gpt"):
+            end = message_type.startswith("gpt-end")
+            if self._open and self._messages[-1][0] == role:
+                self._messages[-1][1] += message
+                if message and self.journal is not None:
+                    self.journal.record("append", index=len(self) - 1, text=message)
+            elif end and not message:
+                return  # 这条消息已经被后来的消息结束了
+            else:
+                self._add(role, message, True, {} if end else details)
+            if end:
+                self._open = False
+                if self.journal is not None:
+                    self.journal.record("end", index=len(self) - 1, **details)
+                self._index(len(self) - 1)
+        else:
+            self._add(role, message, False, details)
+
+    # 第 index 条消息的 (角色, 文本)
+    def message(self, index):
+        if index < self._archive.count:
+            return self._archive.get(index)
+        role, text = self._messages[index - self._archive.count]
+        return role, text
+
+    # 依次产出全部消息，磁盘上的部分逐行读取
+    def __iter__(self):
+        yield from self._archive
+        for role, text in list(self._messages):
+            yield role, text
+
+    # 依次产出导出用的文本，和原来 QTextEdit.toPlainText() 的格式相同
+    def iter_text(self, prefixes=PREFIXES):
+        for role, text in self:
+            yield f"{prefixes[role]}{text}\n\n"
+
+    def clear(self):
+        if self.journal is not None:
+            self.journal.record("clear")
+        if self.search is not None:
+            self.search.detach()
+        self._messages = []
+        self._archive.clear()
+        self._open = False
+        self.generation += 1
+
+    # 把内存中的消息全部写入 archive(退出时保存标签页)；还在输出的消息就此结束
+    def persist(self):
+        if self._open:
+            self._end()
+        if self._messages:
+            self._archive.extend(self._messages)
+            self._messages = []
+
+    def close(self):
+        self._archive.close()
+
+    def _add(self, role, text, streaming, details):
+        if self._open:
+            self._end()  # 没有结束标记就开始了下一条(例如回复被停止)
+        self._messages.append([role, text])
+        self._open = streaming
+        if self.journal is not None:
+            self.journal.record("start" if streaming else "message", index=len(self) - 1, role=role, text=text,
+                                **details)
+        if not streaming:
+            self._index(len(self) - 1)
+        if len(self._messages) > self.max_messages:
+            self._evict()
+
+    def _end(self):
+        self._open = False
+        if self.journal is not None:
+            self.journal.record("end", index=len(self) - 1)
+        self._index(len(self) - 1)
+
+    def _index(self, index):
+        if self.search is not None:
+            role, text = self._messages[index - self._archive.count]
+            self.search.add(index, role, text)
+
+    # 把较早的一半消息一次写到磁盘上；最后一条可能还在流式输出，总是留在内存中
+    def _evict(self):
+        count = len(self._messages) - self.max_messages // 2
+        self._archive.extend(self._messages[:count])
+        del self._messages[:count]
+
+
+# 移出内存的消息：SQLite 的 messages 表中按 (标签页, 下标) 存放
+# 默认使用空路径的数据库，它是一个临时文件，关闭连接时自动删除；
+# 恢复的标签页使用 session_store 的数据库，conn 由它管理，这里不关闭
+class MessageArchive:
+    def __init__(self, conn=None, tab=0, count=0):
+        self.tab = tab
+        self.count = count      # 已存入的消息数
+        self._conn = conn
+        self._temporary = conn is None
+
+    def get(self, index):
+        return self._connect().execute("SELECT role, text FROM messages WHERE tab = ? AND idx = ?",
+                                       (self.tab, index)).fetchone()
+
+    def __iter__(self):
+        if self.count:
+            yield from self._connect().execute(
+                "SELECT role, text FROM messages WHERE tab = ? AND idx < ? ORDER BY idx", (self.tab, self.count))
+
+    def extend(self, messages):
+        self._connect().executemany("INSERT OR REPLACE INTO messages (tab, idx, role, text) VALUES (?, ?, ?, ?)",
+                                    ((self.tab, self.count + i, role, text)
+                                     for i, (role, text) in enumerate(messages)))
+        self._conn.commit()
+        self.count += len(messages)
+
+    def clear(self):
+        if self._conn is not None:
+            self._conn.execute("DELETE FROM messages WHERE tab = ?", (self.tab,))
+            self._conn.commit()
+        self.count = 0
+
+    def close(self):
+        if self._temporary and self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect("")
+            self._conn.execute(MESSAGES_TABLE)
+        return self._conn
@@ -0,0 +1,278 @@
+import math
+from collections import OrderedDict
+
+from PySide6 import QtWidgets
+from PySide6.QtCore import QEvent, QPointF, QRectF, Qt
+from PySide6.QtGui import QColor, QGuiApplication, QPainter, QTextCharFormat, QTextLayout, QTextOption
+
+from transcript import PREFIXES
+
+# 各角色的显示样式：(前缀, 颜色, 是否斜体)
+CHAT_STYLES = {
+    "user": (PREFIXES["user"], "black", True),
+    "gpt": (PREFIXES["gpt"], "green", False),
+    "translation": (PREFIXES["translation"], "blue", False),
+    "error": (PREFIXES["error"], "red", False),
+    "notice": (PREFIXES["notice"], "grey", True),
+}
+
+SCROLL_STEPS = 100      # 滚动条上每条消息占的刻度数
+MARGIN = 4              # 文字和边框之间的距离，和 QTextEdit 的文档边距相同
+
+
+# 虚拟化的聊天记录视图：只排版和绘制视口中可见的几条消息，排版结果按 LRU 缓存
+# 滚动位置记为 (顶部的消息, 在这条消息内的像素偏移)，滚动条按消息计数，再长的会话也不需要计算全部消息的高度；
+# 停在底部时新内容到来后保持在底部。消息改变后调用 refresh()
+class TranscriptView(QtWidgets.QAbstractScrollArea):
+    def __init__(self, transcript, styles=CHAT_STYLES, parent=None, cached_layouts=256):
+        super().__init__(parent)
+        self.transcript = transcript
+        self.styles = styles
+        self.cached_layouts = cached_layouts
+        self._top = 0
+        self._offset = 0
+        self._follow = True
+        self._count = 0
+        self._generation = transcript.generation
+        self._layouts = OrderedDict()   # index -> (width, layout, height)
+        self.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+        self.setFocusPolicy(Qt.StrongFocus)
+        self.verticalScrollBar().valueChanged.connect(self._scrolled)
+
+    # 消息模型改变之后调用：丢弃可能变化的排版，停在底部时滚到新的底部
+    def refresh(self):
+        if self._generation != self.transcript.generation:
+            self._generation = self.transcript.generation
+            self._layouts.clear()
+            self._top, self._offset, self._follow = 0, 0, True
+        # 只有上次的最后一条消息可能被追加了内容，已经排版的部分接着排
+        layout = self._layouts.get(self._count - 1)
+        if layout is not None:
+            role, text = self.transcript.message(self._count - 1)
+            layout.update(display_text(self.styles[role][0], text))
+        self._count = len(self.transcript)
+        if self._follow:
+            self._top, self._offset = self._bottom()
+        self._place(self._top, self._offset)
+
+    def scroll_to_bottom(self):
+        self._follow = True
+        self._place(*self._bottom())
+
+    # 滚动到第 index 条消息的开头
+    def scroll_to_message(self, index):
+        self._place(min(max(0, index), self._count), 0)
+
+    # 视口中 y 处的消息下标，没有消息时为 None
+    def message_at(self, y):
+        index, top = self._top, -self._offset
+        while index < self._count:
+            top += self._height(index)
+            if y < top:
+                return index
+            index += 1
+        return None
+
+    # 上下滚动 pixels 个像素，跨过的消息才排版
+    def scroll_by(self, pixels):
+        top, offset = self._top, self._offset + pixels
+        while offset < 0 and top > 0:
+            top -= 1
+            offset += self._height(top)
+        while top < self._count and offset >= self._height(top):
+            offset -= self._height(top)
+            top += 1
+        self._place(top, max(0, offset))
+
+    def paintEvent(self, event):
+        painter = QPainter(self.viewport())
+        index, y = self._top, -self._offset
+        height = self.viewport().height()
+        while index < self._count and y < height:
+            self._layout(index).draw(painter, MARGIN, y + MARGIN, 0, height)
+            y += self._height(index)
+            index += 1
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        if self._follow:
+            self.scroll_to_bottom()
+        else:
+            self._place(self._top, self._offset)
+
+    def changeEvent(self, event):
+        super().changeEvent(event)
+        if event.type() == QEvent.FontChange:  # 样式表设置字号之后重新排版
+            self._layouts.clear()
+            self.refresh()
+
+    def wheelEvent(self, event):
+        pixels = event.pixelDelta().y()
+        if not pixels:
+            pixels = event.angleDelta().y() * 3 * self.fontMetrics().lineSpacing() // 120
+        self.scroll_by(-pixels)
+        event.accept()
+
+    def keyPressEvent(self, event):
+        page = max(1, self.viewport().height() - self.fontMetrics().lineSpacing())
+        if event.key() == Qt.Key_PageDown:
+            self.scroll_by(page)
+        elif event.key() == Qt.Key_PageUp:
+            self.scroll_by(-page)
+        elif event.key() == Qt.Key_Down:
+            self.scroll_by(self.fontMetrics().lineSpacing())
+        elif event.key() == Qt.Key_Up:
+            self.scroll_by(-self.fontMetrics().lineSpacing())
+        elif event.key() == Qt.Key_Home:
+            self._place(0, 0)
+        elif event.key() == Qt.Key_End:
+            self.scroll_to_bottom()
+        else:
+            super().keyPressEvent(event)
+
+    # 右键菜单：复制鼠标下的一条消息或全部记录
+    def contextMenuEvent(self, event):
+        index = self.message_at(event.pos().y())
+        menu = QtWidgets.QMenu(self)
+        copy_message = menu.addAction("Copy Message")
+        copy_message.setEnabled(index is not None)
+        copy_all = menu.addAction("Copy All")
+        copy_all.setEnabled(self._count > 0)
+        action = menu.exec(event.globalPos())
+        if action is copy_message:
+            role, text = self.transcript.message(index)
+            QGuiApplication.clipboard().setText(self.styles[role][0] + text)
+        elif action is copy_all:
+            prefixes = {role: style[0] for role, style in self.styles.items()}
+            QGuiApplication.clipboard().setText("".join(self.transcript.iter_text(prefixes)).rstrip("\n"))
+
+    def _scrolled(self, value):
+        top = min(value // SCROLL_STEPS, self._count)
+        offset = 0
+        if top < self._count:
+            offset = (value % SCROLL_STEPS) * self._height(top) // SCROLL_STEPS
+        self._place(top, offset, False)
+
+    # 设置滚动位置(不超过底部)并同步滚动条
+    def _place(self, top, offset, sync_scrollbar=True):
+        bottom = self._bottom()
+        self._top, self._offset = min((top, offset), bottom)
+        self._follow = (self._top, self._offset) == bottom
+        if sync_scrollbar:
+            scrollbar = self.verticalScrollBar()
+            scrollbar.blockSignals(True)
+            scrollbar.setRange(0, self._position(*bottom))
+            scrollbar.setPageStep(SCROLL_STEPS)
+            scrollbar.setSingleStep(max(1, SCROLL_STEPS // 10))
+            scrollbar.setValue(self._position(self._top, self._offset))
+            scrollbar.blockSignals(False)
+        self.viewport().update()
+
+    def _position(self, top, offset):
+        if top >= self._count:
+            return top * SCROLL_STEPS
+        return top * SCROLL_STEPS + offset * SCROLL_STEPS // self._height(top)
+
+    # 最后一屏的滚动位置：从最后一条消息往上排版，直到填满视口
+    def _bottom(self):
+        remaining = self.viewport().height()
+        index = self._count
+        while index > 0:
+            index -= 1
+            height = self._height(index)
+            if height >= remaining:
+                return index, height - remaining
+            remaining -= height
+        return 0, 0
+
+    # 一条消息占的高度，包括消息之间的一个空行
+    def _height(self, index):
+        return self._layout(index).height + self.fontMetrics().lineSpacing()
+
+    def _layout(self, index):
+        width = max(1, self.viewport().width() - 2 * MARGIN)
+        layout = self._layouts.get(index)
+        if layout is not None and layout.width == width:
+            self._layouts.move_to_end(index)
+            return layout
+        role, text = self.transcript.message(index)
+        prefix, color, italic = self.styles[role]
+        char_format = QTextCharFormat()
+        char_format.setForeground(QColor(color))
+        char_format.setFontItalic(italic)
+        layout = MessageLayout(self.font(), width, char_format)
+        layout.update(display_text(prefix, text))
+        self._layouts[index] = layout
+        if len(self._layouts) > self.cached_layouts:
+            self._layouts.popitem(last=False)
+        return layout
+
+
+# 显示的文字：QTextLayout 只在行分隔符处换行；逐字符替换，追加内容后前面的部分不变
+def display_text(prefix, text):
+    return (prefix + text).replace("\r", "").replace("\n", "\u2028")
+
+
+# 一条消息的排版，由若干段 QTextLayout 上下拼成
+# 流式消息追加内容时，最后一段中除最后一行以外的行不会再变，把它们固定成一段，只重新排版最后一行及之后的文字
+class MessageLayout:
+    def __init__(self, font, width, char_format):
+        self.font = font
+        self.width = width
+        self.char_format = char_format
+        self.pieces = []    # [top, height, layout, start]，start 是这一段在文字中的起点
+        self.height = 0
+        self.length = -1
+
+    # content 是完整的文字，只会在末尾追加
+    def update(self, content):
+        if len(content) == self.length:
+            return
+        self.length = len(content)
+        start = 0
+        if self.pieces:
+            top, _, _, start = self.pieces.pop()
+            self.height = top
+        layout, height = self._lay(content[start:])
+        if layout.lineCount() > 1:
+            # 固定的段沿用这次的排版，绘制时裁掉最后一行
+            last = layout.lineAt(layout.lineCount() - 1)
+            self._add(layout, math.ceil(last.y()), start)
+            start += len(content[start:].encode("utf-16-le")[:2 * last.textStart()].decode("utf-16-le"))  # Qt 按 UTF-16 计数
+            layout, height = self._lay(content[start:])
+        self._add(layout, height, start)
+
+    # 只绘制和 [clip_top, clip_bottom) 相交的段
+    def draw(self, painter, x, y, clip_top, clip_bottom):
+        for top, height, layout, _ in self.pieces:
+            if y + top >= clip_bottom:
+                break
+            if y + top + height > clip_top:
+                # 裁剪只按行跳过，起点正好在下边缘上的行也会画出来，所以少算半个像素
+                layout.draw(painter, QPointF(x, y + top), [], QRectF(x, y + top, self.width, height - 0.5))
+
+    def _add(self, layout, height, start):
+        self.pieces.append([self.height, height, layout, start])
+        self.height += height
+
+    def _lay(self, content):
+        layout = QTextLayout(content, self.font)
+        option = QTextOption()
+        option.setWrapMode(QTextOption.WrapAtWordBoundaryOrAnywhere)
+        layout.setTextOption(option)
+        format_range = QTextLayout.FormatRange()
+        format_range.start = 0
+        format_range.length = len(content.encode("utf-16-le")) // 2
+        format_range.format = self.char_format
+        layout.setFormats([format_range])
+        height = 0
+        layout.beginLayout()
+        while True:
+            line = layout.createLine()
+            if not line.isValid():
+                break
+            line.setLineWidth(self.width)
+            line.setPosition(QPointF(0, height))
+            height += line.height()
+        layout.endLayout()
+        return layout, math.ceil(height)
@@ -0,0 +1,219 @@
+import argparse
+import asyncio
+import os
+import sys
+from collections import deque
+
+from config import Configuration
+from document_translation import translate_text
+from file_formats import SUPPORTED_EXTENSIONS, atomic_writer, output_name, read_units, render_unit
+from job_queue import job_queue
+from key_pool import key_pool
+from openai_client import client_pool
+from request_engine import RequestParams, engine
+from scheduler import PRIORITY_BACKGROUND, scheduler
+from translation_cache import translation_cache
+
+# 命令行批量翻译：不创建 QApplication，和 ChatTab.translate 使用同样的提示词(目标语言 + 风格)
+# 输入和输出都按段流式读写，文件再大内存占用也有上限；译文先写入临时文件，完成后再原子地替换目标文件
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Translate .txt, .md, .jsonl and .srt files or directory trees.")
+    parser.add_argument("inputs", nargs="*", help="files or directories to translate")
+    parser.add_argument("-o", "--output", help="output file, or output directory when translating several files")
+    parser.add_argument("-l", "--language", default="Chinese", help="target language (default: Chinese)")
+    parser.add_argument("-s", "--style", default="Normal", help="Normal, Interesting, Academic or Simple")
+    parser.add_argument("-m", "--model", default="gpt-3.5-turbo", help="gpt-3.5-turbo, gpt-4 or local model")
+    parser.add_argument("--model-path", default="", help="local model file when --model is local model")
+    parser.add_argument("-j", "--concurrency", type=int, default=4, help="concurrent requests (default: 4)")
+    parser.add_argument("--field", default="text", help="field to translate in .jsonl records")
+    parser.add_argument("--output-field", default="translation", help="field that receives the translation")
+    parser.add_argument("--config", default="config.ini", help="configuration file (default: config.ini)")
+    parser.add_argument("--api-key", help="API key (default: OPENAI_API_KEY or [API] key in the configuration)")
+    parser.add_argument("--overwrite", action="store_true", help="translate files whose output already exists")
+    parser.add_argument("--no-cache", action="store_true", help="do not read the translation cache")
+    parser.add_argument("--durable", action="store_true",
+                        help="record progress in the job queue so an interrupted run can be resumed")
+    parser.add_argument("--resume", action="store_true", help="resume every unfinished job in the job queue")
+    parser.add_argument("--status", action="store_true", help="list the jobs in the job queue and exit")
+    return parser.parse_args(argv)
+
+
+# 要翻译的文件和对应的输出文件
+# 只翻译一个文件时 output 是输出文件，否则是输出目录(目录输入保留原来的子目录结构)
+def collect_jobs(inputs, output, language):
+    to_directory = len(inputs) > 1 or any(os.path.isdir(path) for path in inputs)
+    jobs = []
+    for path in inputs:
+        if os.path.isdir(path):
+            for folder, _, files in os.walk(path):
+                for name in sorted(files):
+                    source = os.path.join(folder, name)
+                    if not name.endswith(SUPPORTED_EXTENSIONS) or _is_output_name(name, language):
+                        continue
+                    target = os.path.join(output, os.path.relpath(source, path)) if output else None
+                    jobs.append((source, target or output_name(source, language)))
+        elif path.endswith(SUPPORTED_EXTENSIONS):
+            if output:
+                target = os.path.join(output, os.path.basename(path)) if to_directory else output
+            else:
+                target = output_name(path, language)
+            jobs.append((path, target))
+        else:
+            print(f"Skipping {path}: unsupported file type", file=sys.stderr)
+    return jobs
+
+
+def _is_output_name(name, language):
+    return os.path.splitext(os.path.splitext(name)[0])[1] == f".{language}"
+
+
+# 翻译一个文件：最多 concurrency 个请求同时进行，最多缓冲 concurrency*4 个单元，按原文顺序写出
+async def translate_file(source, target, params, args):
+    semaphore = asyncio.Semaphore(args.concurrency)
+    window = deque()
+    count = 0
+
+    async def translate_unit(unit):
+        if unit.text is None:
+            return render_unit(unit, None)
+        async with semaphore:
+            translation = await translate_text(params, unit.text, args.language, args.style,
+                                               bypass_cache=args.no_cache, priority=PRIORITY_BACKGROUND)
+        return render_unit(unit, translation)
+
+    try:
+        with atomic_writer(target) as out:
+            for unit in read_units(source, args.field, args.output_field):
+                window.append(asyncio.ensure_future(translate_unit(unit)))
+                count += unit.text is not None
+                while len(window) > args.concurrency * 4 or (window and window[0].done()):
+                    out.write(await window.popleft())
+            while window:
+                out.write(await window.popleft())
+    finally:
+        for task in window:
+            task.cancel()
+        await asyncio.gather(*window, return_exceptions=True)
+    return count
+
+
+# 通过任务队列翻译：进度写入数据库，中断后用 --resume 继续，已完成的单元不再请求
+async def run_durable(job_ids, api_key, args):
+    failed = 0
+    for job_id in job_ids:
+        job = job_queue.job(job_id)
+        try:
+            if await job_queue.run(job_id, api_key, args.concurrency, on_progress=_progress_printer(job_id)):
+                print(f"\n{job.source} -> {job.target} (job {job_id})", file=sys.stderr)
+            else:
+                failed += 1
+                print(f"\n{job.source}: job {job_id} failed: {job_queue.job(job_id).error}", file=sys.stderr)
+        except Exception as e:
+            failed += 1
+            print(f"\n{job.source}: Error: {str(e)}", file=sys.stderr)
+    return failed
+
+
+def _progress_printer(job_id):
+    def show(progress):
+        print(f"\rJob {job_id}: {format_progress(progress)}", end="", file=sys.stderr, flush=True)
+    return show
+
+
+# 进度、速度和预计剩余时间，例如 "12/40 units, 35 tokens/s, ETA 1m20s"
+def format_progress(progress):
+    text = f"{progress.done}/{progress.total} units"
+    if progress.failed:
+        text += f", {progress.failed} failed"
+    if progress.rate is not None:
+        minutes, seconds = divmod(int(progress.eta), 60)
+        text += f", {progress.rate:.0f} tokens/s, ETA {minutes}m{seconds:02d}s"
+    return text
+
+
+def print_status():
+    jobs = job_queue.jobs()
+    if not jobs:
+        print("No translation jobs")
+    for job in jobs:
+        progress = job_queue.progress(job.id)
+        line = f"{job.id}\t{job.status}\t{progress.done}/{progress.total}\t{job.source} -> {job.target}"
+        print(line + (f"\t{job.error}" if job.error else ""))
+
+
+async def run(jobs, params, args):
+    failed = 0
+    for source, target in jobs:
+        if os.path.exists(target) and not args.overwrite:
+            print(f"{source}: {target} exists, skipped", file=sys.stderr)
+            continue
+        try:
+            count = await translate_file(source, target, params, args)
+            print(f"{source} -> {target} ({count} units)", file=sys.stderr)
+        except Exception as e:
+            failed += 1
+            print(f"{source}: Error: {str(e)}", file=sys.stderr)
+    return failed
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.concurrency < 1:
+        raise SystemExit("--concurrency must be at least 1")
+    configuration = Configuration(args.config)
+    api_key = args.api_key or os.environ.get("OPENAI_API_KEY") or configuration.config.get("API", "key", fallback="")
+    if not api_key and args.model.lower() != "local model":
+        raise SystemExit("An API key is required: pass --api-key, set OPENAI_API_KEY or fill in config.ini")
+
+    client_pool.configure(**configuration.get_network_settings())
+    engine.max_concurrency = max(configuration.get_max_concurrency(), args.concurrency)
+    scheduler.configure(**configuration.get_rate_limit_settings())
+    if api_key:
+        key_pool.configure(**configuration.get_key_pool_settings(api_key))
+    translation_cache.configure(**configuration.get_cache_settings())
+    job_queue.configure(**configuration.get_job_settings())
+
+    if args.status:
+        try:
+            print_status()
+        finally:
+            job_queue.close()
+        return 0
+    if not args.inputs and not args.resume:
+        raise SystemExit("No input files: pass files or directories, or --resume")
+
+    jobs = collect_jobs(args.inputs, args.output, args.language)
+    params = RequestParams(model=args.model.lower(), api_key=api_key, model_path=args.model_path)
+    if args.durable or args.resume:
+        job_ids = [job.id for job in job_queue.jobs(unfinished_only=True)] if args.resume else []
+        # 同一个输出文件已经有未完成的任务时继续那个任务，不重新创建
+        unfinished = {job.target: job.id for job in job_queue.jobs(unfinished_only=True)}
+        for source, target in jobs:
+            if target in unfinished:
+                if unfinished[target] not in job_ids:
+                    job_ids.append(unfinished[target])
+            elif os.path.exists(target) and not args.overwrite:
+                print(f"{source}: {target} exists, skipped", file=sys.stderr)
+            else:
+                job_ids.append(job_queue.add_file(source, target, args.language, args.style, params,
+                                                  args.field, args.output_field))
+        coro = run_durable(job_ids, api_key, args)
+    else:
+        coro = run(jobs, params, args)
+    future = engine.submit(coro)
+    try:
+        failed = future.result()
+    except KeyboardInterrupt:
+        future.cancel()
+        print("\nInterrupted", file=sys.stderr)
+        failed = 1
+    finally:
+        engine.stop()
+        client_pool.close()
+        translation_cache.close()
+        job_queue.close()
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
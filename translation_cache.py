@@ -0,0 +1,191 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+from prompts import PROMPT_VERSION
+
+
+# 归一化原文：统一Unicode形式，去掉首尾空白并合并每行内部的连续空白
+def normalize_text(text):
+    text = unicodedata.normalize("NFC", text).strip()
+    return "\n".join(" ".join(line.split()) for line in text.splitlines())
+
+
+def make_key(text, language, style, model):
+    raw = "\x1f".join([normalize_text(text), language, (style or "").lower(), model, str(PROMPT_VERSION)])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+# 缓存键中的模型名：本地模型用模型文件区分
+def cache_model_name(params):
+    if params.model.lower() == "local model":
+        return f"local:{os.path.abspath(params.model_path)}"
+    return params.model
+
+
+# 两级翻译缓存：内存中的LRU + 磁盘上的SQLite
+# 键由归一化后的原文、目标语言、风格、模型和提示词版本组成；磁盘缓存按总大小和存放时间淘汰
+# 命中时的 last_used 先记在内存中，攒够 touch_batch 条、写入新条目或关闭时再一起提交，读缓存不必每次都写盘
+class TranslationCache:
+    def __init__(self, path="cache/translations.db", memory_entries=512, max_bytes=64 * 1024 * 1024,
+                 max_age_days=30, enabled=True, touch_batch=64):
+        self.path = path
+        self.memory_entries = memory_entries
+        self.max_bytes = max_bytes
+        self.max_age = max_age_days * 24 * 3600
+        self.enabled = enabled
+        self.touch_batch = touch_batch
+        self.hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()   # key -> (译文, 写入时间)
+        self._touched = {}             # key -> 还没有写入磁盘的 last_used
+        self._conn = None
+        self._disk_bytes = 0
+        self._puts_since_evict = 0
+        self._lock = threading.Lock()
+
+    def configure(self, path=None, memory_entries=None, max_bytes=None, max_age_days=None, enabled=None):
+        with self._lock:
+            if path is not None and path != self.path:
+                self._close()
+                self.path = path
+            if memory_entries is not None:
+                self.memory_entries = memory_entries
+            if max_bytes is not None:
+                self.max_bytes = max_bytes
+            if max_age_days is not None:
+                self.max_age = max_age_days * 24 * 3600
+            if enabled is not None:
+                self.enabled = enabled
+
+    def get(self, text, language, style, model):
+        if not self.enabled:
+            return None
+        key = make_key(text, language, style, model)
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and now - entry[1] > self.max_age:
+                del self._memory[key]
+                entry = None
+            if entry is not None:
+                self._memory.move_to_end(key)
+            else:
+                row = self._connect().execute(
+                    "SELECT translation, created FROM translations WHERE key = ?", (key,)).fetchone()
+                if row is None or now - row[1] > self.max_age:
+                    self.misses += 1
+                    return None
+                entry = row
+                self._remember(key, *entry)
+            self._touch(key, now)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, text, language, style, model, translation):
+        if not self.enabled or not translation:
+            return
+        key = make_key(text, language, style, model)
+        size = len(translation.encode("utf-8"))
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            old = conn.execute("SELECT size FROM translations WHERE key = ?", (key,)).fetchone()
+            conn.execute(
+                "INSERT OR REPLACE INTO translations (key, translation, size, created, last_used) "
+                "VALUES (?, ?, ?, ?, ?)", (key, translation, size, now, now))
+            self._touched.pop(key, None)
+            self._write_touched()
+            conn.commit()
+            self._disk_bytes += size - (old[0] if old else 0)
+            self._remember(key, translation, now)
+            self._puts_since_evict += 1
+            if self._disk_bytes > self.max_bytes or self._puts_since_evict >= 100:
+                self._evict(now)
+
+    def stats(self):
+        with self._lock:
+            return self.hits, self.misses
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._touched.clear()
+            self._connect().execute("DELETE FROM translations")
+            self._conn.commit()
+            self._disk_bytes = 0
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+    def _remember(self, key, translation, created):
+        self._memory[key] = (translation, created)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _touch(self, key, now):
+        self._touched[key] = now
+        if len(self._touched) >= self.touch_batch:
+            self._connect()
+            self._write_touched()
+            self._conn.commit()
+
+    # 把攒下的 last_used 写入磁盘，由调用方提交
+    def _write_touched(self):
+        if self._touched:
+            self._conn.executemany("UPDATE translations SET last_used = ? WHERE key = ?",
+                                   [(last_used, key) for key, last_used in self._touched.items()])
+            self._touched.clear()
+
+    def _connect(self):
+        if self._conn is None:
+            folder = os.path.dirname(self.path)
+            if folder and not os.path.exists(folder):
+                os.makedirs(folder)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS translations ("
+                "key TEXT PRIMARY KEY, translation TEXT NOT NULL, size INTEGER NOT NULL, "
+                "created REAL NOT NULL, last_used REAL NOT NULL)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS translations_last_used ON translations (last_used)")
+            self._disk_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM translations").fetchone()[0]
+        return self._conn
+
+    # 删除过期的条目，总大小仍超出上限时按最久未使用的顺序删除到上限的90%
+    def _evict(self, now):
+        self._puts_since_evict = 0
+        conn = self._conn
+        conn.execute("DELETE FROM translations WHERE created < ?", (now - self.max_age,))
+        self._disk_bytes = conn.execute("SELECT COALESCE(SUM(size), 0) FROM translations").fetchone()[0]
+        if self._disk_bytes > self.max_bytes:
+            target = self._disk_bytes - int(self.max_bytes * 0.9)
+            removed = 0
+            keys = []
+            for key, size in conn.execute("SELECT key, size FROM translations ORDER BY last_used"):
+                if removed >= target:
+                    break
+                keys.append((key,))
+                removed += size
+            conn.executemany("DELETE FROM translations WHERE key = ?", keys)
+            for (key,) in keys:
+                self._memory.pop(key, None)
+            self._disk_bytes -= removed
+        conn.commit()
+
+    def _close(self):
+        if self._conn is not None:
+            self._write_touched()
+            self._conn.commit()
+            self._conn.close()
+            self._conn = None
+        self._memory.clear()
+
+
+# 全局共享的翻译缓存
+translation_cache = TranslationCache()
@@ -0,0 +1,112 @@
+from collections import deque
+
+SAMPLE_WIDTH = 2    # 16 位 PCM
+
+
+# 每帧的能量(dBFS)，samples 为 (帧数, 每帧采样数) 的 int16 数组
+def frame_energy(samples):
+    import numpy as np  # 只在第一次处理音频时加载
+
+    x = samples.astype(np.float64)
+    return 20 * np.log10(np.maximum(np.sqrt(np.mean(x * x, axis=1)), 1.0) / 32768.0)
+
+
+# 按帧判断有没有说话：帧的能量(dBFS)超过阈值算作语音；能量稍低但过零率高的帧(清辅音 s、f 等)也算作语音
+# 阈值是 energy_db 和 噪声底 + margin_db 中较大的一个；噪声底遇到更安静的帧立即下降，之后每秒最多上升 noise_rise_db，
+# 持续的背景噪声(风扇、空调)会慢慢抬高阈值，说话本身不会
+class VoiceActivityDetector:
+    def __init__(self, rate, frame_ms=30, energy_db=-45.0, margin_db=12.0, zcr_threshold=0.3, zcr_margin_db=6.0,
+                 noise_rise_db=3.0):
+        self.rate = rate
+        self.frame_size = max(1, rate * frame_ms // 1000)     # 每帧的采样数
+        self.energy_db = energy_db
+        self.margin_db = margin_db
+        self.zcr_threshold = zcr_threshold
+        self.zcr_margin_db = zcr_margin_db
+        self.noise_rise = noise_rise_db * self.frame_size / rate    # 每帧噪声底最多上升的 dB
+        self.noise_db = energy_db - margin_db   # 开始时假定环境是安静的
+
+    @property
+    def frame_seconds(self):
+        return self.frame_size / self.rate
+
+    # samples 为 (帧数, frame_size) 的 int16 数组，返回每帧是否是语音
+    def classify(self, samples):
+        import numpy as np
+
+        energy = frame_energy(samples)
+        signs = samples >= 0
+        zcr = np.count_nonzero(signs[:, 1:] != signs[:, :-1], axis=1) / max(1, self.frame_size - 1)
+        speech = np.zeros(len(samples), dtype=bool)
+        for i, (level, crossings) in enumerate(zip(energy.tolist(), zcr.tolist())):
+            threshold = max(self.energy_db, self.noise_db + self.margin_db)
+            speech[i] = level >= threshold or (
+                level >= threshold - self.zcr_margin_db and crossings >= self.zcr_threshold)
+            self.noise_db = min(level, self.noise_db + self.noise_rise)
+        return speech
+
+
+# 边录边去掉长的静音：超过 max_silence 秒的静音只保留两头各一半，开头和结尾的静音只保留紧挨着语音的一半
+# 数据按块送进 feed()，返回可以写出的 PCM；只缓存一段静音的结尾，内存不随录音长度增长
+# 语音之后静音满 max_silence / 2 秒算作一次停顿，split() 在停顿处把输出分开，用来边录边切段
+class SilenceTrimmer:
+    def __init__(self, rate, max_silence=0.6, **detector_settings):
+        self.detector = VoiceActivityDetector(rate, **detector_settings)
+        self.frame_bytes = self.detector.frame_size * SAMPLE_WIDTH
+        self.keep = max(1, round(max_silence / 2 / self.detector.frame_seconds))   # 静音两头各保留的帧数
+        self.input_bytes = 0
+        self.output_bytes = 0
+        self.speech_frames = 0
+        self._partial = b""             # 不足一帧的数据，和下一块拼起来
+        self._head = 0                  # 语音之后已经写出的静音帧数，最多 keep 帧
+        self._tail = deque(maxlen=self.keep)    # 之后的静音只留最后 keep 帧
+        self._spoken = False
+
+    @property
+    def removed_seconds(self):
+        return (self.input_bytes - self.output_bytes) / (self.detector.rate * SAMPLE_WIDTH)
+
+    def feed(self, pcm):
+        return b"".join(self.split(pcm))
+
+    # 和 feed() 一样，但在停顿处分开：返回的第一项接着之前的输出，之后每一项都从一次停顿之后开始
+    def split(self, pcm):
+        import numpy as np
+
+        self.input_bytes += len(pcm)
+        data = self._partial + pcm
+        count = len(data) // self.frame_bytes
+        self._partial = data[count * self.frame_bytes:]
+        pieces = [[]]
+        if count:
+            samples = np.frombuffer(data, dtype="<i2", count=count * self.detector.frame_size)
+            speech = self.detector.classify(samples.reshape(count, self.detector.frame_size))
+            for i, is_speech in enumerate(speech.tolist()):
+                frame = data[i * self.frame_bytes:(i + 1) * self.frame_bytes]
+                if is_speech:
+                    pieces[-1].extend(self._tail)
+                    pieces[-1].append(frame)
+                    self._tail.clear()
+                    self._head = 0
+                    self._spoken = True
+                    self.speech_frames += 1
+                elif self._spoken and self._head < self.keep:
+                    pieces[-1].append(frame)
+                    self._head += 1
+                    if self._head == self.keep:
+                        pieces.append([])
+                else:
+                    self._tail.append(frame)
+        return [self._output(frames) for frames in pieces]
+
+    # 录音结束：不足一帧的尾巴丢弃
+    def finish(self):
+        self._head = 0
+        self._tail.clear()
+        self._partial = b""
+        return b""
+
+    def _output(self, frames):
+        data = b"".join(frames)
+        self.output_bytes += len(data)
+        return data